@@ -0,0 +1,189 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Microbenchmarks of the pure Python codecs.
+
+Times the ECC, LZARI, RC4, icon and icon.sys title code on fixed
+inputs and reports their throughput:
+
+    python benchmarks/bench_codecs.py -o baseline.json
+    python benchmarks/bench_codecs.py -c baseline.json
+
+The save used for the LZARI, icon and title benchmarks is taken from
+the test data, so the results reflect a real save rather than random
+bytes."""
+
+import sys
+import os
+import io
+import random
+import tarfile
+import struct
+
+import common
+
+from mymcplusplus.round import round_up
+from mymcplusplus import ps2mc_ecc
+from mymcplusplus import ps2icon
+from mymcplusplus import ps2iconsys
+from mymcplusplus import cardgen
+from mymcplusplus.save import ps2save
+from mymcplusplus.save import format_ems
+from mymcplusplus.save import format_codebreaker
+from mymcplusplus.save import lzari
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "..", "test")
+TEST_DATA = os.path.join(TEST_DIR, "data.tar.gz")
+TEST_SAVE = "BESCES-50501REZ.psu"
+
+PAGE_SIZE = 512
+ECC_PAGES = 2048
+RC4_SIZE = 256 * 1024
+SEED = 0x5053
+
+
+def load_test_save():
+    """Return the test save as a list of (name, data) pairs."""
+
+    tar = tarfile.open(TEST_DATA)
+    try:
+        data = tar.extractfile(TEST_SAVE).read()
+    finally:
+        tar.close()
+    sf = ps2save.PS2SaveFile()
+    format_ems.load(sf, io.BytesIO(data))
+    return [(ent[8].decode("ascii"), data) for (ent, data) in sf]
+
+
+def lzari_payload(files):
+    # The same layout format_max_drive.save() compresses.
+    s = b""
+    for (name, data) in files:
+        s += struct.pack("<L32s", len(data), name.encode("ascii"))
+        s += data
+        s += b"\0" * (round_up(len(s) + 8, 16) - 8 - len(s))
+    return s
+
+
+def compress_icon(data):
+    """Convert an icon with an uncompressed texture to a compressed one."""
+
+    icon = ps2icon.Icon(data)
+    if icon.tex_type != 0x7:
+        return data
+    rle = cardgen.rle_compress_texture(icon.texture)
+    # the texture type is the third word of the header
+    hdr = (data[:8] + struct.pack("<I", 0xF)
+           + data[12 : len(data) - len(icon.texture)])
+    return hdr + struct.pack("<I", len(rle)) + rle
+
+
+def bench_ecc(r, rng):
+    pages = [cardgen.random_bytes(rng, PAGE_SIZE) for i in range(ECC_PAGES)]
+    spares = [b"".join(map(bytes, ps2mc_ecc.ecc_calculate_page(page)))
+              for page in pages]
+    nbytes = PAGE_SIZE * ECC_PAGES
+
+    def calculate():
+        for page in pages:
+            ps2mc_ecc.ecc_calculate_page(page)
+
+    def check(pages):
+        for (page, spare) in zip(pages, spares):
+            ps2mc_ecc.ecc_check_page(page, spare)
+
+    def check_clean():
+        check(pages)
+
+    def flip_bits():
+        # flip one data bit in every page, so every page needs
+        # to be corrected
+        damaged = []
+        for page in pages:
+            page = bytearray(page)
+            page[rng.randrange(PAGE_SIZE)] ^= 1 << rng.randrange(8)
+            damaged.append(bytes(page))
+        return damaged
+
+    r.run("ecc/calculate", calculate, nbytes = nbytes)
+    r.run("ecc/check-clean", check_clean, nbytes = nbytes)
+    r.run("ecc/check-corrected", check, flip_bits, nbytes = nbytes)
+
+
+def bench_lzari(r, files):
+    data = lzari_payload(files)
+    compressed = lzari.encode(data)
+    r.run("lzari/encode", lambda: lzari.encode(data), nbytes = len(data))
+    r.run("lzari/encode-level1", lambda: lzari.encode(data, level = 1),
+          nbytes = len(data))
+    r.run("lzari/decode", lambda: lzari.decode(compressed, len(data)),
+          nbytes = len(data))
+
+
+def bench_rc4(r, rng):
+    data = cardgen.random_bytes(rng, RC4_SIZE)
+    r.run("rc4/crypt",
+          lambda: format_codebreaker._rc4_crypt(
+              format_codebreaker.PS2SAVE_CBS_RC4S, data),
+          nbytes = len(data))
+
+
+def bench_icons(r, files):
+    icons = [data for (name, data) in files if name.endswith(".ico")]
+    icon_sys = dict(files)["icon.sys"]
+
+    def parse_icons(icons):
+        def parse():
+            for data in icons:
+                ps2icon.Icon(data)
+        return parse
+
+    # The test save's icon has an uncompressed texture, so it's
+    # also timed with the texture RLE compressed.
+    compressed = [compress_icon(data) for data in icons]
+    for (name, l) in [("icon/parse", icons),
+                      ("icon/parse-compressed", compressed)]:
+        r.run(name, parse_icons(l), nbytes = sum(len(data) for data in l))
+
+    titles = ps2iconsys.IconSys(icon_sys)._title_sjis * 1000
+    for encoding in ("unicode", "ascii"):
+        r.run("iconsys/shift_jis_conv-" + encoding,
+              lambda: ps2iconsys.shift_jis_conv(titles, encoding),
+              nbytes = len(titles))
+
+
+def main(argv = sys.argv):
+    parser = common.make_option_parser(
+        "%prog [options]",
+        "Measure the throughput of the ECC, LZARI, RC4 and icon code.")
+    (opts, args) = parser.parse_args(argv[1:])
+    if args:
+        parser.error("Too many arguments.")
+
+    r = common.runner("codecs", opts)
+    rng = random.Random(SEED)
+    files = load_test_save()
+    bench_ecc(r, rng)
+    bench_lzari(r, files)
+    bench_rc4(r, rng)
+    bench_icons(r, files)
+    return r.finish()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
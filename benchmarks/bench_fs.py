@@ -0,0 +1,162 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Benchmarks of the memory card file system operations.
+
+Synthetic card images are built in a temporary directory for every
+combination of ECC mode, size and layout, then each command is timed
+through mymc.main() with its output discarded:
+
+    python benchmarks/bench_fs.py -o baseline.json
+    python benchmarks/bench_fs.py -c baseline.json
+
+Benchmark names look like "ecc-8M-half/import"."""
+
+import sys
+import os
+import io
+import random
+import shutil
+import tempfile
+import contextlib
+
+import common
+
+from mymcplusplus import ps2mc
+from mymcplusplus import mymc
+from mymcplusplus import cardgen
+
+SIZES = {"8M": 8192, "16M": 16384, "32M": 32768, "64M": 65536}
+DEFAULT_SIZES = "8M,32M"
+ECC_MODES = ("ecc", "noecc")
+
+ADD_SIZE = 65536
+SEED = 0x5053
+
+# cardgen.fill_card() arguments for each layout
+LAYOUTS = {"empty": {"saves": 1},
+           "half": {"fill": 0.5},
+           "fragmented": {"fill": 0.5, "fragmentation": 0.5}}
+LAYOUT_ORDER = ("empty", "half", "fragmented")
+
+
+def build_card(path, ecc, clusters, layout, seed = SEED):
+    """Build a card image, returning the name of one of its saves."""
+
+    f = open(path, "w+b")
+    try:
+        names = cardgen.generate(f, clusters, ecc, seed, **LAYOUTS[layout])
+    finally:
+        f.close()
+    return names[-1]
+
+
+def run_mymc(*args):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        ret = mymc.main(["mymc"] + list(args))
+    if ret:
+        raise RuntimeError("mymc %s failed: %s"
+                           % (" ".join(args), out.getvalue()))
+
+
+def open_card(path):
+    f = open(path, "rb")
+    try:
+        ps2mc.ps2mc(f).close()
+    finally:
+        f.close()
+
+
+def bench_card(r, tmpdir, ecc_name, size_name, layout):
+    prefix = "%s-%s-%s/" % (ecc_name, size_name, layout)
+    names = ["open", "ls", "dir", "extract", "add", "import", "export",
+             "delete", "check", "df", "format"]
+    if not any(r.wanted(prefix + name) for name in names):
+        return
+
+    clusters = SIZES[size_name]
+    template = os.path.join(tmpdir, "template.ps2")
+    work = os.path.join(tmpdir, "work.ps2")
+    out = os.path.join(tmpdir, "out.bin")
+    psu = os.path.join(tmpdir, "target.psu")
+    addfile = os.path.join(tmpdir, "add.bin")
+
+    target = build_card(template, ecc_name == "ecc", clusters, layout)
+    run_mymc(template, "export", "-f", "-o", psu, target)
+    f = open(addfile, "wb")
+    f.write(cardgen.random_bytes(random.Random(SEED), ADD_SIZE))
+    f.close()
+
+    def copy_template():
+        shutil.copyfile(template, work)
+
+    r.run(prefix + "open", lambda: open_card(template))
+    r.run(prefix + "ls", lambda: run_mymc(template, "ls", "/*"))
+    r.run(prefix + "dir", lambda: run_mymc(template, "dir"))
+    r.run(prefix + "extract",
+          lambda: run_mymc(template, "extract", "-o", out, target + "/*"))
+    r.run(prefix + "add",
+          lambda arg: run_mymc(work, "add", "-d", target, addfile),
+          copy_template)
+    r.run(prefix + "import",
+          lambda arg: run_mymc(work, "import", "-d", "BENCH-IMPORT", psu),
+          copy_template)
+    r.run(prefix + "export",
+          lambda: run_mymc(template, "export", "-f", "-o", out, target))
+    r.run(prefix + "delete",
+          lambda arg: run_mymc(work, "delete", target),
+          copy_template)
+    r.run(prefix + "check", lambda: run_mymc(template, "check"))
+    r.run(prefix + "df", lambda: run_mymc(template, "df"))
+
+    format_args = ["format", "-f", "-c", str(clusters)]
+    if ecc_name == "noecc":
+        format_args.append("-e")
+    r.run(prefix + "format", lambda: run_mymc(work, *format_args))
+
+
+def main(argv = sys.argv):
+    parser = common.make_option_parser(
+        "%prog [options]",
+        "Time memory card file system operations on synthetic cards.")
+    parser.add_option("-s", "--sizes", default = DEFAULT_SIZES,
+                      help = ("Comma separated card sizes, from "
+                              + ", ".join(sorted(SIZES, key = SIZES.get))
+                              + ". [default %default]"))
+    (opts, args) = parser.parse_args(argv[1:])
+    if args:
+        parser.error("Too many arguments.")
+    sizes = opts.sizes.split(",")
+    for size in sizes:
+        if size not in SIZES:
+            parser.error("Unknown card size %r." % size)
+
+    r = common.runner("fs", opts)
+    tmpdir = tempfile.mkdtemp(prefix = "mymc-bench-")
+    try:
+        for ecc_name in ECC_MODES:
+            for size_name in sizes:
+                for layout in LAYOUT_ORDER:
+                    bench_card(r, tmpdir, ecc_name, size_name, layout)
+    finally:
+        shutil.rmtree(tmpdir)
+    return r.finish()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Timing, reporting and baseline comparison shared by the benchmarks."""
+
+import sys
+import os
+import time
+import json
+import platform
+import optparse
+import fnmatch
+
+# Allow the benchmarks to be run from a source checkout.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                "..")))
+
+DEFAULT_REPEAT = 5
+DEFAULT_WARMUP = 1
+DEFAULT_THRESHOLD = 0.10
+
+
+class _option_parser(optparse.OptionParser):
+    def check_values(self, values, args):
+        if values.repeat < 1:
+            self.error("the repeat count must be at least 1")
+        return (values, args)
+
+
+def make_option_parser(usage, description):
+    """Return an option parser with the options common to all benchmarks."""
+
+    parser = _option_parser(usage = usage, description = description)
+    parser.add_option("-r", "--repeat", type = "int",
+                      default = DEFAULT_REPEAT,
+                      help = "Time each benchmark this many times."
+                      " [default %default]")
+    parser.add_option("-w", "--warmup", type = "int",
+                      default = DEFAULT_WARMUP,
+                      help = "Untimed runs before timing starts."
+                      " [default %default]")
+    parser.add_option("-k", "--select", metavar = "pattern",
+                      action = "append",
+                      help = "Only run benchmarks whose names match the"
+                      " glob pattern.  Can be given more than once.")
+    parser.add_option("-o", "--output", metavar = "file",
+                      help = "Write the results as JSON to file.")
+    parser.add_option("-c", "--compare", metavar = "file",
+                      help = "Compare the results to a baseline JSON file"
+                      " and exit with status 1 if any benchmark is slower.")
+    parser.add_option("-t", "--threshold", type = "float",
+                      default = DEFAULT_THRESHOLD,
+                      help = "Fraction a benchmark may slow down before"
+                      " it counts as a regression. [default %default]")
+    return parser
+
+
+def selected(name, patterns):
+    if not patterns:
+        return True
+    for pat in patterns:
+        if fnmatch.fnmatchcase(name, pat):
+            return True
+    return False
+
+
+def measure(fn, setup = None, repeat = DEFAULT_REPEAT,
+            warmup = DEFAULT_WARMUP):
+    """Time fn, returning a list of times in seconds.
+
+    If setup is given it's called, untimed, before every run and its
+    return value passed to fn."""
+
+    times = []
+    for i in range(warmup + repeat):
+        arg = None
+        if setup != None:
+            arg = setup()
+        start = time.perf_counter()
+        if setup != None:
+            fn(arg)
+        else:
+            fn()
+        t = time.perf_counter() - start
+        if i >= warmup:
+            times.append(t)
+    return times
+
+
+def summarize(name, times, nbytes = None):
+    """Return the result record of a benchmark."""
+
+    times = sorted(times)
+    n = len(times)
+    if n % 2:
+        median = times[n // 2]
+    else:
+        median = (times[n // 2 - 1] + times[n // 2]) / 2
+    result = {"name": name,
+              "repeat": n,
+              "min": times[0],
+              "median": median,
+              "mean": sum(times) / n,
+              "max": times[-1]}
+    if nbytes != None:
+        result["bytes"] = nbytes
+        if times[0] > 0:
+            result["mb_per_sec"] = nbytes / times[0] / 1e6
+    return result
+
+
+def format_result(result):
+    s = "%-44s %10.3f ms %10.3f ms" % (result["name"],
+                                       result["min"] * 1000,
+                                       result["median"] * 1000)
+    if "mb_per_sec" in result:
+        s += " %9.2f MB/s" % result["mb_per_sec"]
+    return s
+
+
+def load_results(filename):
+    f = open(filename, "r")
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def write_results(filename, suite, results):
+    doc = {"suite": suite,
+           "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+           "python": platform.python_version(),
+           "implementation": platform.python_implementation(),
+           "platform": platform.platform(),
+           "results": results}
+    f = open(filename, "w")
+    try:
+        json.dump(doc, f, indent = 1, sort_keys = True)
+        f.write("\n")
+    finally:
+        f.close()
+
+
+def compare(baseline, results, threshold, out = sys.stdout):
+    """Compare results to a baseline, returning the number of regressions.
+
+    Benchmarks are compared by their median times."""
+
+    base = {}
+    for result in baseline["results"]:
+        base[result["name"]] = result
+    regressions = 0
+    out.write("%-44s %12s %12s %8s\n"
+              % ("benchmark", "baseline", "current", "change"))
+    for result in results:
+        name = result["name"]
+        old = base.get(name)
+        if old == None:
+            out.write("%-44s %12s %9.3f ms %8s\n"
+                      % (name, "-", result["median"] * 1000, "new"))
+            continue
+        change = result["median"] / old["median"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        out.write("%-44s %9.3f ms %9.3f ms %+7.1f%%%s\n"
+                  % (name, old["median"] * 1000, result["median"] * 1000,
+                     change * 100, flag))
+    return regressions
+
+
+class runner(object):
+    """Runs a suite of benchmarks and reports the results."""
+
+    def __init__(self, suite, opts):
+        self.suite = suite
+        self.opts = opts
+        self.results = []
+
+    def wanted(self, name):
+        return selected(name, self.opts.select)
+
+    def run(self, name, fn, setup = None, nbytes = None):
+        if not self.wanted(name):
+            return None
+        times = measure(fn, setup, self.opts.repeat, self.opts.warmup)
+        result = summarize(name, times, nbytes)
+        self.results.append(result)
+        print(format_result(result))
+        sys.stdout.flush()
+        return result
+
+    def finish(self):
+        """Write and compare the results, returning the exit status."""
+
+        opts = self.opts
+        if opts.output != None:
+            write_results(opts.output, self.suite, self.results)
+        if opts.compare != None:
+            print()
+            regressions = compare(load_results(opts.compare), self.results,
+                                  opts.threshold)
+            if regressions:
+                print("%d regression(s)" % regressions)
+                return 1
+        return 0
@@ -0,0 +1,296 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""An incremental, deduplicating backup store for memory cards.
+
+A store is a directory holding two things.  objects/ holds the
+contents of every file ever backed up, compressed with zlib and named
+by the SHA-256 hash of the uncompressed contents, so a file is only
+stored once however many cards or backups it appears in.
+manifests/NAME/ holds a JSON manifest for each backup of the card
+called NAME, recording the card's geometry and the directory entries
+of its saves, with the hash of each file's contents.
+
+A save whose directory entries are the same as in the card's last
+backup isn't read at all, and a card whose image hasn't changed since
+its last backup isn't read either, so the time and space a backup
+takes grows with what changed rather than with the number of cards."""
+
+import sys
+import os
+import json
+import time
+import zlib
+import hashlib
+from errno import ENOENT, EINVAL
+
+from . import ps2mc
+from .save import ps2save
+from .ps2mc_dir import *
+
+MANIFEST_VERSION = 1
+
+def _object_path(store, hash):
+    return os.path.join(store, "objects", hash[:2], hash[2:])
+
+def _write_file(path, data):
+    """Write a file atomically, so that a backup that's interrupted,
+    or another one running at the same time, never leaves a partly
+    written file behind."""
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _store_object(store, data):
+    """Add data to the store, returning its hash and the number of
+    bytes written, which is 0 if the store already had it."""
+
+    hash = hashlib.sha256(data).hexdigest()
+    path = _object_path(store, hash)
+    if os.path.exists(path):
+        return (hash, 0)
+    data = zlib.compress(data)
+    _write_file(path, data)
+    return (hash, len(data))
+
+def read_object(store, hash):
+    """Return the contents stored under a hash."""
+
+    path = _object_path(store, hash)
+    with open(path, "rb") as f:
+        data = zlib.decompress(f.read())
+    if hashlib.sha256(data).hexdigest() != hash:
+        raise ps2mc.corrupt("backup object doesn't match its hash",
+                    f)
+    return data
+
+def check_name(name):
+    if (name in ["", ".", ".."] or "/" in name
+        or (os.sep != "/" and os.sep in name)):
+        raise ValueError("invalid card name: %r" % name)
+
+def _run_key(run):
+    # IDs are a timestamp, followed by a counter if there was more than
+    # one backup in the same second
+    (stamp, sep, n) = run.partition("-")
+    if n.isdigit():
+        return (stamp, int(n))
+    return (stamp, 0, n)
+
+def runs(store, name):
+    """Return the IDs of the backups of a card, oldest first."""
+
+    check_name(name)
+    try:
+        files = os.listdir(os.path.join(store, "manifests", name))
+    except FileNotFoundError:
+        return []
+    return sorted((fn[:-5] for fn in files if fn.endswith(".json")),
+              key = _run_key)
+
+def load_manifest(store, name, run = None):
+    """Load the manifest of a backup, by default the latest one."""
+
+    if run == None:
+        ids = runs(store, name)
+        if len(ids) == 0:
+            raise ps2mc.io_error(ENOENT, "no backups of %s" % name,
+                         store)
+        run = ids[-1]
+    check_name(run)
+    path = os.path.join(store, "manifests", name, run + ".json")
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ps2mc.io_error(EINVAL, "unsupported manifest version",
+                     path)
+    return manifest
+
+def _entry(ent):
+    return {"name": ent[8].decode("ascii"), "mode": ent[0], "attr": ent[7],
+        "created": list(ent[3]), "modified": list(ent[6])}
+
+def _save_entries(mc, ent):
+    """Describe a save directory and its files, without their hashes."""
+
+    dirname = "/" + ent[8].decode("ascii")
+    save = _entry(ent)
+    save["files"] = []
+    dir = mc.dir_open(dirname)
+    try:
+        ents = list(dir)[2:]
+    finally:
+        dir.close()
+    for e in ents:
+        if not mode_is_file(e[0]):
+            if e[0] & DF_EXISTS:
+                print("warning: %s/%s is not a file, ignored."
+                      % (dirname, e[8].decode("ascii")))
+            continue
+        f = _entry(e)
+        f["size"] = e[2]
+        save["files"].append(f)
+    return save
+
+def _unhashed(save):
+    save = dict(save)
+    save["files"] = [dict((k, v) for (k, v) in f.items() if k != "hash")
+             for f in save["files"]]
+    return save
+
+def _source(mc):
+    try:
+        st = os.stat(mc.f.name)
+    except (AttributeError, TypeError, EnvironmentError):
+        return None
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+def _create_manifest(store, name, data):
+    """Write a new manifest for the card called name, returning its ID.
+
+    The file is created exclusively, so backups of the same card
+    running at the same time each get their own ID rather than one
+    overwriting the other."""
+
+    dir = os.path.join(store, "manifests", name)
+    os.makedirs(dir, exist_ok = True)
+    stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    run = stamp
+    n = 1
+    while True:
+        path = os.path.join(dir, run + ".json")
+        try:
+            fd = os.open(path, (os.O_WRONLY | os.O_CREAT | os.O_EXCL
+                        | getattr(os, "O_BINARY", 0)), 0o666)
+        except FileExistsError:
+            n += 1
+            run = "%s-%03d" % (stamp, n)
+            continue
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except:
+            os.remove(path)
+            raise
+        return run
+
+def backup(mc, store, name):
+    """Back up the saves on an open ps2mc object to store as a new
+    backup of the card called name.
+
+    Returns a dictionary with the new backup's ID, the number of saves
+    backed up, how many of them were unchanged since the last backup,
+    and the number of files and bytes added to the store."""
+
+    check_name(name)
+    mc.flush()
+    try:
+        last = load_manifest(store, name)
+    except EnvironmentError:
+        last = None
+    source = _source(mc)
+    stats = {"saves": 0, "unchanged": 0, "objects": 0, "bytes": 0}
+
+    if last != None and source != None and last.get("source") == source:
+        # the image itself hasn't changed
+        saves = last["saves"]
+        stats["unchanged"] = len(saves)
+    else:
+        old = {}
+        if last != None:
+            old = dict((save["name"], save) for save in last["saves"])
+        root = mc.dir_open("/")
+        try:
+            ents = list(root)[2:]
+        finally:
+            root.close()
+        saves = []
+        for ent in ents:
+            if not mode_is_dir(ent[0]):
+                if ent[0] & DF_EXISTS:
+                    sys.stderr.write("warning: /%s is not a directory,"
+                             " ignored.\n" % ent[8].decode("ascii"))
+                continue
+            save = _save_entries(mc, ent)
+            prev = old.get(save["name"])
+            if prev != None and _unhashed(prev) == save:
+                saves.append(prev)
+                stats["unchanged"] += 1
+                continue
+            for f in save["files"]:
+                path = "/%s/%s" % (save["name"], f["name"])
+                mcf = mc.open(path, "rb")
+                try:
+                    data = mcf.read(f["size"])
+                finally:
+                    mcf.close()
+                (f["hash"], n) = _store_object(store, data)
+                if n != 0:
+                    stats["objects"] += 1
+                    stats["bytes"] += n
+            saves.append(save)
+    stats["saves"] = len(saves)
+
+    manifest = {"version": MANIFEST_VERSION,
+            "card": name,
+            "time": int(time.time()),
+            "source": source,
+            "geometry": {"page_size": mc.page_size,
+                     "pages_per_erase_block": mc.pages_per_erase_block,
+                     "pages_per_card": (mc.clusters_per_card
+                            * mc.pages_per_cluster),
+                     "ecc": mc.spare_size != 0},
+            "saves": saves}
+    stats["run"] = _create_manifest(store, name,
+                    json.dumps(manifest, indent = 1,
+                           sort_keys = True).encode("ascii"))
+    return stats
+
+def _dirent(entry, length):
+    return [entry["mode"], 0, length, tuple(entry["created"]), 0, 0,
+        tuple(entry["modified"]), entry["attr"],
+        entry["name"].encode("ascii")]
+
+def restore(f, store, name, run = None, with_ecc = None):
+    """Rebuild a backup of the card called name as a new image in f.
+
+    By default the latest backup is restored, to an image with the
+    same geometry as the card had.  Returns the number of saves
+    restored."""
+
+    manifest = load_manifest(store, name, run)
+    geometry = manifest["geometry"]
+    if with_ecc == None:
+        with_ecc = geometry["ecc"]
+    params = (with_ecc, geometry["page_size"],
+          geometry["pages_per_erase_block"], geometry["pages_per_card"])
+    mc = ps2mc.ps2mc(f, True, params)
+    try:
+        for save in manifest["saves"]:
+            files = save["files"]
+            sf = ps2save.PS2SaveFile()
+            sf.set_directory(_dirent(save, len(files)))
+            for (i, entry) in enumerate(files):
+                data = read_object(store, entry["hash"])
+                sf.set_file(i, _dirent(entry, len(data)), data)
+            mc.import_save_file(sf, False)
+    finally:
+        mc.close()
+    return len(manifest["saves"])
@@ -0,0 +1,408 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Generate synthetic memory card images for testing and benchmarks.
+
+The images are filled with made up saves, each with a valid icon.sys
+file, a 3D icon and a number of data files.  Everything, including
+the timestamps and the layout of the clusters, is derived from a
+seed, so the same parameters always produce the same image.
+
+File data is written a run of clusters at a time rather than through
+the file objects used by the rest of the file system code, so large
+images can be built quickly."""
+
+import random
+import struct
+from errno import ENOSPC, EEXIST
+
+from . import ps2mc
+from .ps2mc import io_error
+from .ps2mc_dir import *
+from .round import div_round_up
+from .save import ps2save
+from .ps2icon import TEXTURE_WIDTH, TEXTURE_HEIGHT
+
+DEFAULT_SAVES = 10
+DEFAULT_MIN_FILES = 1
+DEFAULT_MAX_FILES = 3
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_MAX_SIZE = 64 * 1024
+DEFAULT_HOLE_SIZE = 8
+
+ICON_VERTICES = 96
+
+# 2004-01-01 00:00:00 UTC, the timestamps of the generated saves are
+# spread over the following year.
+BASE_TIME = 1072915200
+TIME_SPREAD = 365 * 24 * 3600
+
+_ICON_MAGIC = 0x010000
+_TEX_UNCOMPRESSED = 0x07
+_TEX_COMPRESSED = 0x0F
+
+_icon_sys_struct = struct.Struct("<4sHHII"
+                                 "4I4I4I4I"
+                                 "4f4f4f"
+                                 "4f4f4f4f"
+                                 "68s64s64s64s512s")
+
+_GAME_CODES = ["BASLUS", "BESLES", "BESCES", "BASCUS", "BISLPS"]
+
+
+def random_bytes(rng, n):
+    """Return n random bytes."""
+
+    if n <= 0:
+        return b""
+    return rng.getrandbits(n * 8).to_bytes(n, "little")
+
+
+def _fullwidth(s):
+    """Convert ASCII to the fullwidth characters most titles use."""
+
+    a = []
+    for c in s:
+        if c == " ":
+            a.append("\u3000")
+        elif "!" <= c <= "~":
+            a.append(chr(ord(c) + 0xFEE0))
+        else:
+            a.append(c)
+    return "".join(a)
+
+
+def make_icon_sys(title1, title2, icon_name):
+    """Return the contents of an icon.sys file.
+
+    The title lines are given as ASCII strings and stored as fullwidth
+    Shift-JIS characters."""
+
+    line1 = _fullwidth(title1).encode("shift_jis")
+    line2 = _fullwidth(title2).encode("shift_jis")
+    icon_name = icon_name.encode("ascii")
+    return _icon_sys_struct.pack(
+        b"PS2D", 0, len(line1), 0, 0,
+        0x40, 0x20, 0x60, 0, 0x20, 0x40, 0x60, 0,
+        0x20, 0x60, 0x40, 0, 0x60, 0x20, 0x40, 0,
+        0.5, 0.5, 0.5, 0.0, 0.0, -0.4, -0.1, 0.0, -0.5, -0.5, 0.5, 0.0,
+        0.3, 0.3, 0.3, 0.0, 0.4, 0.4, 0.4, 0.0, 0.5, 0.5, 0.5, 0.0,
+        0.2, 0.2, 0.2, 0.0,
+        line1 + line2, icon_name, icon_name, icon_name, b"")
+
+
+def make_texture(rng):
+    """Return a random 128x128 texture made of horizontal bands.
+
+    Like real icon textures it has long runs of the same colour,
+    so it compresses reasonably well."""
+
+    words = []
+    count = TEXTURE_WIDTH * TEXTURE_HEIGHT
+    while len(words) < count:
+        colour = rng.getrandbits(15) | 0x8000
+        if rng.random() < 0.25:
+            # a short stretch of noise
+            n = rng.randrange(1, 32)
+            words += [rng.getrandbits(15) | 0x8000 for i in range(n)]
+        else:
+            words += [colour] * rng.randrange(1, 200)
+    return struct.pack("<%dH" % count, *words[:count])
+
+
+def rle_compress_texture(texture):
+    """Compress a texture with the RLE scheme used by PS2 icons."""
+
+    words = struct.unpack("<%dH" % (len(texture) // 2), texture)
+    out = []
+    literal = []
+
+    def flush_literal():
+        while literal:
+            run = literal[:256]
+            del literal[:256]
+            out.append(struct.pack("<H", 0x10000 - len(run)))
+            out.append(struct.pack("<%dH" % len(run), *run))
+
+    i = 0
+    n = len(words)
+    while i < n:
+        j = i + 1
+        while j < n and words[j] == words[i] and j - i < 0x7FFF:
+            j += 1
+        if j - i >= 2:
+            flush_literal()
+            out.append(struct.pack("<HH", j - i, words[i]))
+        else:
+            literal.append(words[i])
+        i = j
+    flush_literal()
+    return b"".join(out)
+
+
+def make_icon(rng, vertex_count = ICON_VERTICES, compressed = True):
+    """Return the contents of a random, but valid, 3D icon file."""
+
+    vertex_count -= vertex_count % 3
+    out = [struct.pack("<IIIII", _ICON_MAGIC, 1,
+                       _TEX_COMPRESSED if compressed
+                       else _TEX_UNCOMPRESSED,
+                       0x3F800000, vertex_count)]
+    for i in range(vertex_count):
+        out.append(struct.pack("<hhhH",
+                               rng.randrange(-4096, 4096),
+                               rng.randrange(-4096, 4096),
+                               rng.randrange(-4096, 4096), 0))
+        out.append(struct.pack("<hhhHhhBBBB",
+                               rng.randrange(-4096, 4096),
+                               rng.randrange(-4096, 4096),
+                               rng.randrange(-4096, 4096), 0,
+                               rng.randrange(4096),
+                               rng.randrange(4096),
+                               rng.randrange(256), rng.randrange(256),
+                               rng.randrange(256), 0x80))
+    # a single frame with one key
+    out.append(struct.pack("<IIfII", 1, 1, 1.0, 0, 1))
+    out.append(struct.pack("<IIII", 0, 2, 0, 0))
+    out.append(struct.pack("<ff", 1.0, 1.0))
+    texture = make_texture(rng)
+    if compressed:
+        rle = rle_compress_texture(texture)
+        out.append(struct.pack("<I", len(rle)))
+        out.append(rle)
+    else:
+        out.append(texture)
+    return b"".join(out)
+
+
+def make_data(rng, size):
+    """Return size bytes of made up save data.
+
+    The data is a mix of random bytes and runs of zeros."""
+
+    out = []
+    left = size
+    while left > 0:
+        n = min(rng.randrange(16, 1024), left)
+        if rng.random() < 0.3:
+            out.append(b"\0" * n)
+        else:
+            out.append(random_bytes(rng, n))
+        left -= n
+    return b"".join(out)
+
+
+def make_save(rng, index, files = (DEFAULT_MIN_FILES, DEFAULT_MAX_FILES),
+              sizes = (DEFAULT_MIN_SIZE, DEFAULT_MAX_SIZE)):
+    """Return a PS2SaveFile object for a synthetic save."""
+
+    code = rng.choice(_GAME_CODES)
+    serial = rng.randrange(100000)
+    dirname = "%s-%05dGEN%04d" % (code, serial, index)
+    tod = time_to_tod(BASE_TIME + rng.randrange(TIME_SPREAD))
+    icon_name = "icon%d.ico" % index
+
+    contents = [("icon.sys",
+                 make_icon_sys("SYNTHETIC %04d" % index,
+                               "SLOT %d" % rng.randrange(1, 10),
+                               icon_name)),
+                (icon_name, make_icon(rng, compressed = rng.random() < 0.5))]
+    for i in range(rng.randint(files[0], files[1])):
+        contents.append(("DATA%02d" % i,
+                         make_data(rng, rng.randint(sizes[0], sizes[1]))))
+
+    sf = ps2save.PS2SaveFile()
+    sf.set_directory((DF_RWX | DF_DIR | DF_0400 | DF_EXISTS,
+                      0, len(contents), tod, 0, 0, tod, 0,
+                      dirname.encode("ascii")))
+    for (i, (name, data)) in enumerate(contents):
+        sf.set_file(i, (DF_RWX | DF_FILE | DF_0400 | DF_EXISTS,
+                        0, len(data), tod, 0, 0, tod, 0,
+                        name.encode("ascii")),
+                    data)
+    return sf
+
+
+class _cluster_allocator(object):
+    """Allocate clusters, interleaving them with filler clusters.
+
+    After each cluster allocated for real data, a run of up to
+    hole_size clusters is allocated as filler with probability
+    fragmentation.  Freeing the filler after a save has been written,
+    as if a save written at the same time had been deleted, leaves the
+    save fragmented and holes in the free space for the next save to
+    fall into."""
+
+    def __init__(self, mc, rng, fragmentation, hole_size):
+        self.mc = mc
+        self.rng = rng
+        self.fragmentation = fragmentation
+        self.hole_size = hole_size
+        self.filler = []
+
+    def allocate(self, count):
+        """Allocate a chain of count clusters."""
+
+        mc = self.mc
+        if self.fragmentation == 0:
+            clusters = mc.allocate_clusters(count)
+            if clusters == None:
+                raise io_error(ENOSPC, "out of space on image")
+            return clusters
+        clusters = []
+        for i in range(count):
+            cluster = mc.allocate_cluster()
+            if cluster == None:
+                raise io_error(ENOSPC, "out of space on image")
+            clusters.append(cluster)
+            if self.rng.random() < self.fragmentation:
+                for j in range(self.rng.randint(1, self.hole_size)):
+                    cluster = mc.allocate_cluster()
+                    if cluster == None:
+                        break
+                    self.filler.append(cluster)
+        mc.link_clusters(clusters)
+        return clusters
+
+    def free_filler(self):
+        self.mc.free_clusters(self.filler)
+        self.filler = []
+
+
+def _write_file(mc, dirloc, data, allocator):
+    count = div_round_up(len(data), mc.cluster_size)
+    if count == 0:
+        return
+    clusters = allocator.allocate(count)
+    mc.write_chain(clusters, data)
+    mc.update_dirent(dirloc, None, clusters[0], len(data), False)
+
+
+def write_save(mc, sf, allocator):
+    """Write a save file to the root directory of a memory card.
+
+    This does what ps2mc.import_save_file() does, but writes the
+    file data with bulk cluster writes."""
+
+    dir_ent = sf.get_directory()
+    dirname = dir_ent[8].decode("ascii")
+    (root_dirloc, ent, is_dir) = mc.path_search("/" + dirname)
+    if ent != None:
+        raise io_error(EEXIST, "directory exists", dirname)
+    (dir_dirloc, ent) = mc.create_dir_entry(root_dirloc, dirname,
+                                            dir_ent[0])
+    for i in range(len(sf)):
+        (ent, data) = sf.get_file(i)
+        (dirloc, new_ent) = mc.create_dir_entry(dir_dirloc,
+                                                ent[8].decode("ascii"),
+                                                ent[0])
+        _write_file(mc, dirloc, data, allocator)
+
+    # set modes and timestamps to those of the save file, including
+    # the "." and ".." entries so the image is reproducible
+    times = (None, None, None, dir_ent[3], None, None, dir_ent[6],
+             None, None)
+    dir = mc._opendir_dirloc(dir_dirloc, "r+b")
+    try:
+        dir[0] = times
+        dir[1] = times
+        for i in range(len(sf)):
+            dir[i + 2] = sf.get_file(i)[0]
+    finally:
+        dir.close()
+    dir = mc._opendir_dirloc(root_dirloc, "r+b")
+    try:
+        dir[dir_dirloc[1]] = dir_ent
+    finally:
+        dir.close()
+    mc.flush()
+
+
+def _set_root_times(mc, tod):
+    # The root directory is created by format() with the current
+    # time, which would make the image different every time.
+    mc.flush()
+    buf = mc.read_allocatable_cluster(0)
+    out = []
+    for i in range(2):
+        ent = unpack_dirent(buf[i * PS2MC_DIRENT_LENGTH
+                                : (i + 1) * PS2MC_DIRENT_LENGTH])
+        ent[3] = ent[6] = tod
+        out.append(pack_dirent(ent))
+    mc.write_allocatable_cluster(0, b"".join(out)
+                                 + buf[2 * PS2MC_DIRENT_LENGTH:])
+
+
+def fill_card(mc, saves = None, fill = None, seed = 0,
+              files = (DEFAULT_MIN_FILES, DEFAULT_MAX_FILES),
+              sizes = (DEFAULT_MIN_SIZE, DEFAULT_MAX_SIZE),
+              fragmentation = 0.0, hole_size = DEFAULT_HOLE_SIZE):
+    """Add synthetic saves to the root directory of a memory card.
+
+    Saves are added until the given number of saves have been
+    written or, if fill is given, until about that fraction of the
+    card is used.  If neither is given DEFAULT_SAVES saves are added.
+    Returns the directory names of the saves written."""
+
+    if saves == None and fill == None:
+        saves = DEFAULT_SAVES
+    rng = random.Random(seed)
+    allocator = _cluster_allocator(mc, rng, fragmentation, hole_size)
+    cluster_size = mc.cluster_size
+    total = mc.get_allocatable_space() // cluster_size
+    free = mc.get_free_space() // cluster_size
+    names = []
+    while saves == None or len(names) < saves:
+        if fill != None and total - free >= total * fill:
+            break
+        sf = make_save(rng, len(names), files, sizes)
+        # the save's directory, its files and maybe another
+        # cluster for the root directory
+        need = 2 + sum(div_round_up(len(sf[i][1]), cluster_size)
+                       for i in range(len(sf)))
+        if fill != None and need > free:
+            break
+        write_save(mc, sf, allocator)
+        allocator.free_filler()
+        names.append(sf.get_directory()[8].decode("ascii"))
+        free -= need
+    mc.flush()
+    return names
+
+
+def generate(f, clusters = None, with_ecc = True, seed = 0, **kw):
+    """Format and fill a synthetic memory card image.
+
+    The keyword arguments are passed on to fill_card().  Returns the
+    directory names of the saves written."""
+
+    pages_per_card = ps2mc.PS2MC_STANDARD_PAGES_PER_CARD
+    if clusters != None:
+        pages_per_cluster = (ps2mc.PS2MC_CLUSTER_SIZE
+                             // ps2mc.PS2MC_STANDARD_PAGE_SIZE)
+        pages_per_card = clusters * pages_per_cluster
+    params = (with_ecc,
+              ps2mc.PS2MC_STANDARD_PAGE_SIZE,
+              ps2mc.PS2MC_STANDARD_PAGES_PER_ERASE_BLOCK,
+              pages_per_card)
+    mc = ps2mc.ps2mc(f, True, params)
+    try:
+        names = fill_card(mc, seed = seed, **kw)
+        _set_root_times(mc, time_to_tod(BASE_TIME))
+    finally:
+        mc.close()
+    return names
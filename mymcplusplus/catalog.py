@@ -0,0 +1,316 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""A searchable catalog of the saves on a library of memory cards.
+
+The catalog is an SQLite database listing every save on every memory
+card image found under a directory, with its game ID, title, size,
+modification time and a hash of its contents.  Images are read in
+parallel by a pool of processes, and an image is only read again if
+its modification time or size has changed since it was last indexed.
+Even then, only the saves on it that have changed are hashed again."""
+
+import os
+import re
+import sqlite3
+import binascii
+import unicodedata
+
+from . import ps2mc
+from . import ps2iconsys
+from . import ps2mc_sync
+from .ps2mc_dir import *
+
+# the default name of the database, in the library's directory
+CATALOG_NAME = "mymc-catalog.sqlite"
+
+IMAGE_EXTENSIONS = [".ps2", ".mc2", ".mcd"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS saves (
+    image TEXT NOT NULL REFERENCES images(path) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    game_id TEXT,
+    title TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    modified INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (image, name)
+);
+CREATE INDEX IF NOT EXISTS saves_game_id ON saves (game_id);
+CREATE INDEX IF NOT EXISTS saves_name ON saves (name);
+"""
+
+# the columns returned by search()
+COLUMNS = ["image", "name", "game_id", "title", "size", "modified", "hash"]
+
+# A save's directory name starts with a region letter, a type letter
+# and the game's product code, eg. BASLUS-20312 for SLUS-20312.
+_game_id_re = re.compile(r"^B[A-Z]([A-Z]{4})[-_]?([0-9]{3})\.?([0-9]{2})")
+
+def game_id(name):
+    """Return the product code in a save's directory name, or None."""
+
+    m = _game_id_re.match(name.upper())
+    if m == None:
+        return None
+    return "%s-%s%s" % m.groups()
+
+def _title(mc, dirname):
+    s = mc.get_icon_sys(dirname)
+    if s == None:
+        return ""
+    try:
+        icon_sys = ps2iconsys.IconSys(s)
+    except ps2iconsys.Error:
+        return ""
+    # most titles are in fullwidth characters, which NFKC turns into
+    # the ASCII letters people search with
+    title = " ".join(icon_sys.get_title("unicode"))
+    return " ".join(unicodedata.normalize("NFKC", title).split())
+
+def _read_save(mc, name, cached):
+    dirname = "/" + name
+    dir = mc.dir_open(dirname)
+    try:
+        ents = [ent for ent in list(dir) if ent[0] & DF_EXISTS]
+    finally:
+        dir.close()
+    modified = int(max(tod_to_time(ent[6]) for ent in ents))
+    size = mc.dir_size(dirname)
+    if cached.get(name) == (modified, size):
+        # the save hasn't changed, so neither has its hash
+        return None
+    return (name, game_id(name), _title(mc, dirname), size, modified,
+        binascii.hexlify(ps2mc_sync.save_hash(mc, name)).decode("ascii"))
+
+def read_image(path, cached = {}):
+    """Return a row for each save on the memory card image in path.
+
+    cached maps the names of saves already in the catalog to their
+    modification times and sizes.  If neither has changed the save
+    isn't read again, and None is returned in place of its row."""
+
+    rows = []
+    with open(path, "rb") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            root = mc.dir_open("/")
+            try:
+                dirs = [ent for ent in list(root)[2:]
+                    if mode_is_dir(ent[0])]
+            finally:
+                root.close()
+            for ent in dirs:
+                name = ent[8].decode("ascii")
+                rows.append((name, _read_save(mc, name, cached)))
+        finally:
+            mc.close()
+    return rows
+
+def _index_image(args):
+    (root, path, cached) = args
+    try:
+        return (path, read_image(os.path.join(root, path), cached), None)
+    except (EnvironmentError, ps2mc.error, ps2iconsys.Error,
+        UnicodeDecodeError) as e:
+        return (path, [], str(e))
+
+def find_images(root):
+    """Find the memory card images under root, as paths relative to
+    it, mapped to their modification times and sizes."""
+
+    images = {}
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            if os.path.splitext(fn)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(dirpath, fn)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            images[os.path.relpath(path, root)] = (st.st_mtime_ns,
+                                   st.st_size)
+    return images
+
+def open_catalog(path):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA foreign_keys = ON")
+    db.executescript(_SCHEMA)
+    return db
+
+def update(db, root, jobs = None):
+    """Bring the catalog up to date with the images under root.
+
+    New images, images whose modification time or size changed and
+    images that couldn't be read last time are read, using jobs
+    processes (by default one per CPU), and images that no longer
+    exist are removed.  Only the saves on a changed image whose
+    modification time or size changed are hashed again.
+    Returns a dictionary counting the images indexed, unchanged,
+    removed and failed and the saves hashed, and a list of
+    (path, error) tuples for the images that couldn't be read."""
+
+    images = find_images(root)
+    known = {}
+    failed = set()
+    for (path, mtime_ns, size, error) in db.execute(
+        "SELECT path, mtime_ns, size, error FROM images"):
+        known[path] = (mtime_ns, size)
+        if error != None:
+            failed.add(path)
+    removed = [path for path in known if path not in images]
+    # images that couldn't be read before are tried again, so they
+    # keep being reported until they're fixed or removed
+    todo = [path for path in sorted(images)
+        if known.get(path) != images[path] or path in failed]
+
+    if jobs == None:
+        jobs = os.cpu_count() or 1
+    args = []
+    for path in todo:
+        cached = {}
+        if path in known:
+            cached = dict((name, (modified, size))
+                      for (name, modified, size) in db.execute(
+                          "SELECT name, modified, size FROM saves"
+                          " WHERE image = ?", (path,)))
+        args.append((root, path, cached))
+    if jobs == 1 or len(args) <= 1:
+        results = map(_index_image, args)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(args)))
+        results = pool.imap_unordered(_index_image, args)
+
+    errors = []
+    hashed = 0
+    try:
+        with db:
+            for path in removed:
+                db.execute("DELETE FROM images WHERE path = ?", (path,))
+            for (path, rows, error) in results:
+                (mtime_ns, size) = images[path]
+                unchanged = [name for (name, row) in rows if row == None]
+                hashed += len(rows) - len(unchanged)
+                old = dict((row[0], row) for row in db.execute(
+                    "SELECT name, game_id, title, size, modified, hash"
+                    " FROM saves WHERE image = ?", (path,))
+                       if row[0] in unchanged)
+                db.execute("DELETE FROM images WHERE path = ?", (path,))
+                db.execute("INSERT INTO images VALUES (?, ?, ?, ?)",
+                       (path, mtime_ns, size, error))
+                db.executemany("INSERT INTO saves VALUES"
+                           " (?, ?, ?, ?, ?, ?, ?)",
+                           [(path,) + (old[name] if row == None
+                               else row)
+                        for (name, row) in rows])
+                if error != None:
+                    errors.append((path, error))
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+    return {"indexed": len(todo) - len(errors),
+        "unchanged": len(images) - len(todo),
+        "removed": len(removed),
+        "failed": len(errors),
+        "hashed": hashed,
+        "errors": errors}
+
+def search(db, terms):
+    """Find the saves matching all of the terms.
+
+    A term that looks like a game ID (eg. SLUS-20312 or SLUS_203.12)
+    matches that game's saves, any other term matches the saves whose
+    directory name or title contains it, ignoring case.  Returns a
+    list of dictionaries with the keys in COLUMNS."""
+
+    where = []
+    params = []
+    for term in terms:
+        gid = game_id("BA" + term)
+        if gid != None and re.match(r"^[A-Za-z]{4}[-_]?[0-9.]+$", term):
+            where.append("game_id = ?")
+            params.append(gid)
+        else:
+            where.append("(name LIKE ? ESCAPE '\\' OR title LIKE ?"
+                     " ESCAPE '\\')")
+            like = ("%" + term.replace("\\", "\\\\").replace("%", "\\%")
+                .replace("_", "\\_") + "%")
+            params += [like, like]
+    sql = "SELECT %s FROM saves" % ", ".join(COLUMNS)
+    if len(where) > 0:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY image, name"
+    return [dict(zip(COLUMNS, row)) for row in db.execute(sql, params)]
+
+def dedupe_report(db):
+    """Find the saves that appear more than once in the catalog.
+
+    Returns a dictionary with three entries.  "identical" lists the
+    groups of saves with the same contents, each a dictionary giving
+    their hash, size and copies.  "near_identical" lists the directory
+    names found with different contents, each a dictionary giving the
+    name and its versions.  "reclaimable" maps each image to the bytes
+    that could be freed on it by deleting its identical copies, keeping
+    the copy on the first image (by path) that has one."""
+
+    by_hash = {}
+    by_name = {}
+    for (image, name, size, modified, hash) in db.execute(
+        "SELECT image, name, size, modified, hash FROM saves"
+        " ORDER BY image, name"):
+        copy = {"image": image, "name": name, "modified": modified}
+        by_hash.setdefault(hash, (size, []))[1].append(copy)
+        by_name.setdefault(name, {}).setdefault(hash, []).append(copy)
+
+    identical = []
+    reclaimable = {}
+    for (hash, (size, copies)) in sorted(by_hash.items(),
+                         key = lambda item: (item[1][1][0]["name"],
+                                  item[0])):
+        if len(copies) < 2:
+            continue
+        identical.append({"hash": hash, "size": size, "copies": copies})
+        for copy in copies[1:]:
+            image = copy["image"]
+            reclaimable[image] = reclaimable.get(image, 0) + size
+
+    near_identical = []
+    for (name, hashes) in sorted(by_name.items()):
+        if len(hashes) < 2:
+            continue
+        versions = [{"hash": hash,
+                 "modified": max(c["modified"] for c in copies),
+                 "images": [c["image"] for c in copies]}
+                for (hash, copies) in hashes.items()]
+        versions.sort(key = lambda v: (-v["modified"], v["hash"]))
+        near_identical.append({"name": name, "versions": versions})
+
+    return {"identical": identical,
+        "near_identical": near_identical,
+        "reclaimable": reclaimable}
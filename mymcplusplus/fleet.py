@@ -0,0 +1,146 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Run a command over many memory card images at once.
+
+Each card is handled by a call to mymc.main() in a pool of worker
+processes, with its output captured, so a run over hundreds of cards
+starts the interpreter once and uses every CPU.  The results come back
+in the order of the cards, whichever worker finishes first."""
+
+import os
+import io
+import glob
+import traceback
+import contextlib
+
+# the commands that can be run over many cards, all of which only
+# read the cards.  backup writes to its store, giving each card its
+# own name there with card_names().
+COMMANDS = ["backup", "check", "df", "diff", "dir", "ls", "scan"]
+
+def find_cards(patterns):
+    """Return the files matching any of the glob patterns, sorted and
+    without duplicates.  "**" matches any number of directories."""
+
+    cards = set()
+    for pattern in patterns:
+        cards.update(path for path in glob.glob(pattern, recursive = True)
+                 if os.path.isfile(path))
+    return sorted(cards)
+
+def card_names(cards):
+    """Return a name for each card that tells it apart from the others.
+
+    The name is the card's path relative to the directory holding all
+    of the cards, without its extension and with "_" in place of the
+    directory separators, so a single card is named after its file
+    as it would be on its own."""
+
+    paths = [os.path.abspath(card) for card in cards]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    names = []
+    for path in paths:
+        name = os.path.splitext(os.path.relpath(path, root))[0]
+        for sep in [os.sep, os.altsep]:
+            if sep != None:
+                name = name.replace(sep, "_")
+        names.append(name)
+    return names
+
+def _run_card(args):
+    (options, card, command) = args
+    # imported here, as mymc imports this module
+    from . import mymc
+
+    out = io.StringIO()
+    err = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            ret = mymc.main(["mymcplusplus"] + options + [card] + command)
+        except SystemExit as e:
+            ret = e.code
+        except Exception:
+            # a card damaged in some unexpected way shouldn't stop
+            # the rest of the cards from being checked
+            traceback.print_exc()
+            ret = 1
+    if ret == None:
+        ret = 0
+    elif not isinstance(ret, int):
+        ret = 1
+    return (card, ret, out.getvalue(), err.getvalue())
+
+def run(cards, command, options = [], jobs = None, card_options = None):
+    """Run a command over each of the cards.
+
+    command is the command name and its arguments, and options are
+    the global options to use, as they'd be given to mymc.main().
+    card_options, if given, is a list of more options for each card's
+    command.  jobs is the number of processes to use, by default one
+    per CPU.  Yields a (card, exit status, stdout, stderr) tuple for
+    each card, in order."""
+
+    if jobs == None:
+        jobs = os.cpu_count() or 1
+    args = []
+    for (i, card) in enumerate(cards):
+        cmd = command
+        if card_options != None:
+            cmd = command[:1] + card_options[i] + command[1:]
+        args.append((options, card, cmd))
+    if jobs == 1 or len(args) <= 1:
+        for result in map(_run_card, args):
+            yield result
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(min(jobs, len(args)))
+    try:
+        for result in pool.imap(_run_card, args):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def summary(command, results):
+    """Return the results of a run as a dictionary for JSON output."""
+
+    cards = [{"card": card, "status": ret, "stdout": out, "stderr": err}
+         for (card, ret, out, err) in results]
+    return {"command": command,
+        "total": len(cards),
+        "failed": sum(1 for c in cards if c["status"] != 0),
+        "status": max([c["status"] for c in cards] + [0]),
+        "cards": cards}
+
+def write_results(f, ferr, results):
+    """Write the output of each card as it arrives, each line prefixed
+    with the card's name.  Returns the highest exit status."""
+
+    status = 0
+    for (card, ret, out, err) in results:
+        prefix = card + ": "
+        for line in out.splitlines():
+            # some commands, like df, already name the card
+            if not line.startswith(prefix):
+                line = prefix + line
+            f.write(line + "\n")
+        ferr.write(err)
+        f.flush()
+        status = max(status, ret)
+    return status
@@ -42,12 +42,13 @@ class DirListControl(wx.ListCtrl):
             PS2 = 0
             PS1 = 1
 
-        def __init__(self, type, dirent, icon_sys, size, title):
+        def __init__(self, type, dirent, icon_sys, size, title, index):
             self.type = type
             self.dirent = dirent
             self.icon_sys = icon_sys
             self.size = size
             self.title = title
+            self.index = index
 
     def __init__(self, parent, evt_focus, evt_select, config):
         self.config = config
@@ -65,15 +66,40 @@ class DirListControl(wx.ListCtrl):
         self.Bind(wx.EVT_LIST_ITEM_SELECTED, self.evt_item_selected)
         self.Bind(wx.EVT_LIST_ITEM_DESELECTED, self.evt_item_deselected)
 
-    def _update_dirtable(self, mc, dir):
+    def _reusable_entries(self, changed):
+        """Return the entries of the current table that aren't affected
+           by the changed dirlocs, indexed by their root directory index.
+
+           Returns an empty dictionary if the changes can't be tied to
+           entries in the table."""
+
+        by_cluster = dict((a.dirent[4], a) for a in self.dirtable)
+        stale = set()
+        for (cluster, index) in changed:
+            if cluster == 0:
+                stale.add(index)
+            elif cluster in by_cluster:
+                stale.add(by_cluster[cluster].index)
+            else:
+                # somewhere deeper in the directory tree
+                return {}
+        return dict((a.index, a) for a in self.dirtable
+                    if a.index not in stale)
+
+    def _update_dirtable(self, mc, dir, reusable):
         self.dirtable = table = []
         enc = "unicode"
         if self.config.get_ascii():
             enc = "ascii"
-        for ent in dir:
+        for (index, ent) in enumerate(dir):
             if not ps2mc.mode_is_dir(ent[0]):
                 continue
 
+            old = reusable.get(index)
+            if old is not None and old.dirent == ent:
+                table.append(old)
+                continue
+
             dirname = ent[8].decode("ascii")
             dirpath = "/" + dirname
 
@@ -90,15 +116,19 @@ class DirListControl(wx.ListCtrl):
                 title = icon_sys.get_title(enc)
 
             size = mc.dir_size(dirpath)
-            table.append(self.TableEntry(type, ent, icon_sys, size, title))
+            table.append(self.TableEntry(type, ent, icon_sys, size, title,
+                                         index))
 
-    def update_dirtable(self, mc):
+    def update_dirtable(self, mc, changed=None):
+        reusable = {}
+        if mc is not None and changed is not None:
+            reusable = self._reusable_entries(changed)
         self.dirtable = []
         if mc is None:
             return
         dir = mc.dir_open("/")
         try:
-            self._update_dirtable(mc, dir)
+            self._update_dirtable(mc, dir, reusable)
         finally:
             dir.close()
 
@@ -218,9 +248,12 @@ class DirListControl(wx.ListCtrl):
         self.selected.discard(event.GetData())
         self.evt_select(event)
 
-    def update(self, mc):
+    def update(self, mc, changed=None):
         """Update the ListCtrl according to the contents of the
-           memory card image."""
+           memory card image.
+
+           If changed is a set of dirlocs, only the saves they belong to
+           are read from the memory card again."""
 
         self.ClearAll()
         self.selected = set()
@@ -245,7 +278,7 @@ class DirListControl(wx.ListCtrl):
         self.sort_reverse = False
         self.update_column_headers()
 
-        self.update_dirtable(mc)
+        self.update_dirtable(mc, changed)
 
         empty = len(self.dirtable) == 0
         self.Enable(not empty)
@@ -40,7 +40,7 @@ if os.name == "nt":
 
 import wx
 
-from .. import ps2mc, ps2iconsys
+from .. import ps2mc, ps2iconsys, ps2mc_image
 from ..round import *
 from ..save import ps2save
 from .icon_window import IconWindow
@@ -140,6 +140,8 @@ class GuiFrame(wx.Frame):
         self.mc = None
         self.mcname = None
         self.icon_win = None
+        self.changed_dirlocs = None
+        self.free_space = None
 
         wx.Frame.__init__(self, parent, wx.ID_ANY, title)
         self.SetClientSize(self.FromDIP((800, 400)))
@@ -354,6 +356,8 @@ class GuiFrame(wx.Frame):
             except EnvironmentError as value:
                 self.mc_error(value)
             self.mc = None
+        self.changed_dirlocs = None
+        self.free_space = None
         if self.f is not None:
             try:
                 self.f.close()
@@ -362,9 +366,32 @@ class GuiFrame(wx.Frame):
             self.f = None
         self.mcname = None
 
-    def refresh(self):
+    def evt_mc_changed(self, mc, changes):
+        """Record what changed on the memory card, so the next refresh
+           only has to reread the affected saves."""
+
+        if self.changed_dirlocs is not None:
+            for event in ("dirent_created", "dirent_modified",
+                          "dirent_deleted"):
+                self.changed_dirlocs |= changes.get(event, set())
+        if "fat_changed" in changes:
+            self.free_space = None
+
+    def refresh(self, full=False):
+        """Update the save list and status bar.
+
+        Unless full is true, only the saves that have changed since the
+        last refresh are reread."""
+
         try:
-            self.dirlist.update(self.mc)
+            changed = None
+            if self.mc is not None:
+                # delivers any pending changes to evt_mc_changed
+                self.mc.flush()
+                if not full:
+                    changed = self.changed_dirlocs
+            self.changed_dirlocs = set()
+            self.dirlist.update(self.mc, changed)
         except EnvironmentError as value:
             self.mc_error(value)
             self._close_mc()
@@ -378,7 +405,9 @@ class GuiFrame(wx.Frame):
         if mc is None:
             status = "No memory card image"
         else:
-            free = mc.get_free_space() // 1024
+            if self.free_space is None:
+                self.free_space = mc.get_free_space()
+            free = self.free_space // 1024
             limit = mc.get_allocatable_space() // 1024
             status = "%dK of %dK free" % (free, limit)
         self.statusbar.SetStatusText(status, 1)
@@ -404,8 +433,11 @@ class GuiFrame(wx.Frame):
         self.f = f
         self.mc = mc
         self.mcname = filename
+        mc.subscribe(self.evt_mc_changed,
+                     ["dirent_created", "dirent_modified",
+                      "dirent_deleted", "fat_changed"])
         self.SetTitle(filename + " - " + self.title)
-        self.refresh()
+        self.refresh(full=True)
 
     def delete_selected(self):
         mc = self.mc
@@ -751,32 +783,15 @@ class GuiFrame(wx.Frame):
         )
         if fn == "":
             return
+        if os.path.abspath(fn) == os.path.abspath(self.mcname):
+            self.error_box(fn + ": Can't save over the open image.")
+            return
 
         try:
-            # Use the current card geometry, but flip the ECC setting.
-            page_size = mc.page_size
-            pages_per_erase_block = mc.pages_per_erase_block
-            pages_per_card = mc.clusters_per_card * mc.pages_per_cluster
-
-            params = (
-                target_with_ecc,
-                page_size,
-                pages_per_erase_block,
-                pages_per_card,
-            )
-
-            with open(fn, "w+b") as f:
-                new_mc = ps2mc.ps2mc(f, True, params)
-                # Copy all saves from current card to new card.
-                for dir_tab_entry in self.dirlist.dirtable:
-                    dirname = dir_tab_entry.dirent[8].decode("ascii")
-                    new_mc.import_save_file(
-                        mc.export_save_file("/" + dirname),
-                        False,
-                    )
-
-                new_mc.flush()
-                new_mc.close()
+            # Copy the image page by page, adding or removing the
+            # spare areas.
+            with open(fn, "wb") as f:
+                ps2mc_image.convert_ecc(mc, f, target_with_ecc)
 
             dirname = os.path.dirname(fn)
             if os.path.isabs(dirname):
@@ -806,30 +821,14 @@ class GuiFrame(wx.Frame):
         )
         if fn == "":
             return
+        if os.path.abspath(fn) == os.path.abspath(self.mcname):
+            self.error_box(fn + ": Can't save over the open image.")
+            return
         try:
             filename = fn.lower()
-            if filename.endswith(".mc2;*.mcd"):
-                ecc = False
-            else:
-                ecc = True
-            params = (
-                ecc,
-                mc.page_size,
-                mc.pages_per_erase_block,
-                mc.clusters_per_card * mc.pages_per_cluster,
-            )
-
-            with open(fn, "w+b") as f:
-                new_mc = ps2mc.ps2mc(f, True, params)
-                for dir_tab_entry in self.dirlist.dirtable:
-                    dirname = dir_tab_entry.dirent[8].decode("ascii")
-                    new_mc.import_save_file(
-                        mc.export_save_file("/" + dirname),
-                        False,
-                    )
-
-                new_mc.flush()
-                new_mc.close()
+            ecc = not filename.endswith((".mc2", ".mcd"))
+            with open(fn, "wb") as f:
+                ps2mc_image.convert_ecc(mc, f, ecc)
         except EnvironmentError as value:
             self.mc_error(value, fn)
             return
@@ -1000,7 +999,7 @@ class GuiFrame(wx.Frame):
 
     def evt_cmd_ascii(self, event):
         self.config.set_ascii(not self.config.get_ascii())
-        self.refresh()
+        self.refresh(full=True)
 
     def evt_cmd_force_import(self, event):
         new_value = not self.config.get_force_import()
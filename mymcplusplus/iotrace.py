@@ -0,0 +1,318 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Record and replay the block level I/O of a ps2mc object.
+
+A trace is a file of newline delimited JSON records, one per event.
+The first record describes the card and the cache sizes in use, the
+rest have the event name in "e" and the page, cluster or FAT entry
+number in "n":
+
+    page_read, page_write           raw page reads and writes
+    cluster_read, cluster_write     raw cluster reads and writes
+    fat_cache_read                  a FAT cluster lookup ("hit" is
+                                    true if it was in the cache)
+    fat_cache_write                 a FAT cluster modified in the cache
+    cluster_cache_read              an allocatable cluster lookup
+    cluster_cache_write             an allocatable cluster written to
+                                    the cache
+    fat_lookup, fat_set             a FAT entry read or changed
+    flush                           the caches were written back
+
+Traces are recorded with the --trace option of mymc, and replayed
+through caches of other sizes and replacement policies with:
+
+    python -m mymcplusplus.iotrace replay trace.ndjson
+
+Tracing starts after the card has been opened, so the replayed caches
+start out empty while the real ones weren't, and the first few
+accesses in a replay may miss where the recorded ones hit."""
+
+import sys
+import json
+import heapq
+import optparse
+from collections import OrderedDict
+
+POLICIES = ["lru", "fifo", "opt"]
+
+# the records whose accesses go through each cache
+_CACHE_EVENTS = {
+    "fat": ("fat_cache_read", "fat_cache_write"),
+    "cluster": ("cluster_cache_read", "cluster_cache_write")
+}
+
+class io_tracer(object):
+    """Write trace records for a ps2mc object to a file."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def header(self, mc, fat_cache_size, cluster_cache_size):
+        self.f.write(json.dumps({"e": "open",
+                     "page_size": mc.page_size,
+                     "pages_per_cluster": mc.pages_per_cluster,
+                     "clusters_per_card": mc.clusters_per_card,
+                     "ecc": mc.spare_size != 0,
+                     "fat_cache": fat_cache_size,
+                     "cluster_cache": cluster_cache_size},
+                    sort_keys = True) + "\n")
+
+    def record(self, event, n):
+        self.f.write('{"e":"%s","n":%d}\n' % (event, n))
+
+    def record_hit(self, event, n, hit):
+        self.f.write('{"e":"%s","n":%d,"hit":%s}\n'
+                 % (event, n, "true" if hit else "false"))
+
+    def flush(self):
+        self.f.write('{"e":"flush"}\n')
+
+    def close(self):
+        self.f.close()
+
+def load(f):
+    """Return the records of a trace as a list of dictionaries."""
+
+    records = []
+    for (lineno, line) in enumerate(f, 1):
+        line = line.strip()
+        if line == "":
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError as e:
+            raise ValueError("line %d: %s" % (lineno, e))
+    return records
+
+def cache_accesses(records, cache):
+    """Return the accesses to the named cache ("fat" or "cluster").
+
+    Each access is a (key, write) tuple.  Flushes are returned as
+    None."""
+
+    (read_event, write_event) = _CACHE_EVENTS[cache]
+    accesses = []
+    for r in records:
+        e = r["e"]
+        if e == read_event:
+            accesses.append((r["n"], False))
+        elif e == write_event:
+            accesses.append((r["n"], True))
+        elif e == "flush":
+            accesses.append(None)
+    return accesses
+
+def _next_uses(accesses):
+    """For each access, the index of the next access of the same key."""
+
+    never = len(accesses)
+    next_use = [never] * len(accesses)
+    last = {}
+    for i in range(len(accesses) - 1, -1, -1):
+        a = accesses[i]
+        if a == None:
+            continue
+        key = a[0]
+        next_use[i] = last.get(key, never)
+        last[key] = i
+    return next_use
+
+def simulate(accesses, size, policy = "lru"):
+    """Run accesses through a write-back cache of the given size.
+
+    Returns a dictionary with the number of hits and misses, the number
+    of clusters that would be read from the card, and the number of
+    dirty clusters written back by evictions and flushes."""
+
+    if policy not in POLICIES:
+        raise ValueError("unknown cache policy: %s" % policy)
+    if size < 1:
+        raise ValueError("cache size must be at least 1")
+
+    cache = OrderedDict()        # key -> dirty
+    if policy == "opt":
+        next_use = _next_uses(accesses)
+        heap = []                # (-next use, key)
+        key_next = {}
+    hits = misses = reads = writebacks = 0
+    for (i, a) in enumerate(accesses):
+        if a == None:
+            for key in cache:
+                if cache[key]:
+                    writebacks += 1
+                    cache[key] = False
+            continue
+        (key, write) = a
+        if key in cache:
+            hits += 1
+            if policy == "lru":
+                cache.move_to_end(key)
+            cache[key] = cache[key] or write
+        else:
+            misses += 1
+            if not write:
+                # a write replaces the whole cluster, so it
+                # doesn't have to be read first
+                reads += 1
+            if len(cache) >= size:
+                if policy == "opt":
+                    while True:
+                        (nu, victim) = heapq.heappop(heap)
+                        if (victim in cache
+                            and key_next[victim] == -nu):
+                            break
+                else:
+                    victim = next(iter(cache))
+                if cache.pop(victim):
+                    writebacks += 1
+            cache[key] = write
+        if policy == "opt":
+            key_next[key] = next_use[i]
+            heapq.heappush(heap, (-next_use[i], key))
+
+    writebacks += sum(1 for dirty in cache.values() if dirty)
+    total = hits + misses
+    return {"accesses": total,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+        "reads": reads,
+        "writebacks": writebacks}
+
+def summarize(records):
+    """Count the records of each event type."""
+
+    counts = {}
+    for r in records:
+        e = r["e"]
+        counts[e] = counts.get(e, 0) + 1
+        if r.get("hit"):
+            e += "_hit"
+            counts[e] = counts.get(e, 0) + 1
+    return counts
+
+def replay(records, sizes, policies):
+    """Simulate each cache with every size and policy.
+
+    Returns a list of (cache, policy, size, result) tuples, where
+    result is the dictionary returned by simulate()."""
+
+    results = []
+    for cache in ["fat", "cluster"]:
+        accesses = cache_accesses(records, cache)
+        for policy in policies:
+            for size in sizes[cache]:
+                results.append((cache, policy, size,
+                        simulate(accesses, size, policy)))
+    return results
+
+def _parse_sizes(s):
+    try:
+        sizes = [int(n) for n in s.split(",")]
+    except ValueError:
+        raise ValueError("invalid list of cache sizes: %s" % s)
+    if min(sizes) < 1:
+        raise ValueError("cache sizes must be at least 1")
+    return sizes
+
+def _write_results(out, header, results):
+    for cache in ["fat", "cluster"]:
+        actual = header.get(cache + "_cache")
+        out.write("%s cache (currently %s):\n" % (cache, actual))
+        out.write("  %-6s %6s %9s %9s %8s %9s %10s\n"
+              % ("policy", "size", "accesses", "hits", "hit rate",
+                 "reads", "writebacks"))
+        for (c, policy, size, r) in results:
+            if c != cache:
+                continue
+            out.write("  %-6s %6d %9d %9d %7.2f%% %9d %10d\n"
+                  % (policy, size, r["accesses"], r["hits"],
+                     r["hit_rate"] * 100, r["reads"],
+                     r["writebacks"]))
+
+def main(argv = sys.argv):
+    usage = ("%prog replay [options] trace.ndjson\n"
+         "       %prog summary trace.ndjson")
+    parser = optparse.OptionParser(prog = "python -m mymcplusplus.iotrace",
+                       usage = usage)
+    parser.add_option("--fat-sizes", metavar = "N,N,...",
+              default = "4,8,12,16,32,64",
+              help = ("FAT cache sizes to simulate."
+                  " [default: %default]"))
+    parser.add_option("--cluster-sizes", metavar = "N,N,...",
+              default = "16,32,64,128,256,512",
+              help = ("Allocatable cluster cache sizes to simulate."
+                  " [default: %default]"))
+    parser.add_option("-p", "--policies", metavar = "P,P,...",
+              default = ",".join(POLICIES),
+              help = ("Replacement policies to simulate, any of "
+                  + ", ".join(POLICIES) + ". [default: %default]"))
+    parser.add_option("-j", "--json", action = "store_true",
+              default = False,
+              help = "Write the results as JSON.")
+    (opts, args) = parser.parse_args(argv[1:])
+    if len(args) != 2 or args[0] not in ["replay", "summary"]:
+        parser.error("Incorrect arguments.")
+    (cmd, filename) = args
+
+    try:
+        sizes = {"fat": _parse_sizes(opts.fat_sizes),
+             "cluster": _parse_sizes(opts.cluster_sizes)}
+    except ValueError as e:
+        parser.error(str(e))
+    policies = opts.policies.split(",")
+    for policy in policies:
+        if policy not in POLICIES:
+            parser.error("unknown cache policy: %s" % policy)
+
+    try:
+        with open(filename, "r") as f:
+            records = load(f)
+    except EnvironmentError as e:
+        sys.stderr.write("%s: %s\n" % (filename, e.strerror))
+        return 1
+    except ValueError as e:
+        sys.stderr.write("%s: %s\n" % (filename, e))
+        return 1
+    header = {}
+    if len(records) > 0 and records[0]["e"] == "open":
+        header = records[0]
+
+    if cmd == "summary":
+        counts = summarize(records)
+        if opts.json:
+            json.dump(counts, sys.stdout, indent = 2, sort_keys = True)
+            sys.stdout.write("\n")
+        else:
+            for e in sorted(counts):
+                sys.stdout.write("%-24s %d\n" % (e, counts[e]))
+        return 0
+
+    results = replay(records, sizes, policies)
+    if opts.json:
+        json.dump([{"cache": cache, "policy": policy, "size": size,
+                "result": r}
+               for (cache, policy, size, r) in results],
+              sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write("\n")
+    else:
+        _write_results(sys.stdout, header, results)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
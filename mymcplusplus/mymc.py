@@ -20,15 +20,27 @@
 import sys
 import os
 import optparse
+import json
 import textwrap
-from errno import EEXIST, EIO
+import time
+from errno import EEXIST, EIO, ENOENT
 
 from . import ps2mc
 from .save import ps2save
 from .ps2mc_dir import *
 from .save import format_codebreaker, format_ems, format_max_drive, format_sharkport, format_psv
+from .save import lzari
+from .save import lzari_cache
 from . import verbuild
+from . import cardgen
+from . import iotrace
+from . import ps2mc_scan
+from . import ps2mc_image
+from . import ps2mc_sync
 from . import ps2iconsys
+from . import catalog
+from . import fleet
+from . import backup
 
 class subopt_error(Exception):
     pass
@@ -226,6 +238,179 @@ def do_import(cmd, mc, opts, args, opterr):
             print (filename + ": already in memory card image,"
                    " ignored.")
 
+def do_copy(cmd, mc, opts, args, opterr):
+    if len(args) < 2:
+        opterr("Destination memory card and directory name required.")
+
+    destname = args[0]
+    args = glob_args(args[1:], mc.glob)
+    if opts.directory != None and len(args) > 1:
+        opterr("The -d option can only be used with a"
+               " single directory.")
+    if os.path.abspath(destname) == os.path.abspath(mc.f.name):
+        opterr("The destination must be a different memory card.")
+
+    f = open(destname, "r+b")
+    try:
+        dest = ps2mc.ps2mc(f)
+        try:
+            copied = mc.copy_saves_to(dest, args, opts.ignore_existing,
+                          opts.directory)
+        finally:
+            dest.close()
+    finally:
+        f.close()
+    for dirname in args:
+        if dirname in copied:
+            print("Copied", dirname, "to", destname)
+        else:
+            print(dirname + ": already in " + destname + ", ignored.")
+
+def _open_other(mc, othername, mode, opterr):
+    if os.path.abspath(othername) == os.path.abspath(mc.f.name):
+        opterr("The other memory card must be a different file.")
+    f = open(othername, mode)
+    try:
+        return (f, ps2mc.ps2mc(f))
+    except:
+        f.close()
+        raise
+
+def do_diff(cmd, mc, opts, args, opterr):
+    if len(args) != 1:
+        opterr("Incorrect number of arguments.")
+    (f, other) = _open_other(mc, args[0], "rb", opterr)
+    try:
+        result = ps2mc_sync.diff(mc, other)
+    finally:
+        other.close()
+        f.close()
+
+    names = {"a": mc.f.name, "b": args[0]}
+    if opts.json:
+        json.dump([{"name": d.name, "state": d.state, "newer": d.newer}
+               for d in result],
+              sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write("\n")
+    else:
+        for d in result:
+            if d.state == "same":
+                if opts.all:
+                    print("Same: %s" % d.name)
+            elif d.state == "changed":
+                if d.newer == None:
+                    print("Changed: %s" % d.name)
+                else:
+                    print("Changed: %s (newer in %s)"
+                          % (d.name, names[d.newer]))
+            else:
+                print("Only in %s: %s" % (names[d.state[-1]], d.name))
+    if any(d.state != "same" for d in result):
+        return 1
+    return 0
+
+def do_sync(cmd, mc, opts, args, opterr):
+    if len(args) != 1:
+        opterr("Incorrect number of arguments.")
+    if opts.push and opts.pull:
+        opterr("--push and --pull can't be used together.")
+    conflict = {"newer": "newer", "this": "a", "other": "b",
+            "skip": "skip"}[opts.conflict]
+    othername = args[0]
+    (f, other) = _open_other(mc, othername,
+                 "rb" if opts.dry_run else "r+b", opterr)
+    try:
+        actions = ps2mc_sync.sync(mc, other, not opts.push,
+                      not opts.pull, conflict, opts.dry_run)
+    finally:
+        other.close()
+        f.close()
+
+    if opts.dry_run:
+        verb = "Would copy"
+    else:
+        verb = "Copied"
+    names = {"to_a": mc.f.name, "to_b": othername}
+    for (d, action) in actions:
+        if action == None:
+            print("%s: differs, not copied." % d.name)
+        else:
+            print("%s %s to %s" % (verb, d.name, names[action]))
+    return 0
+
+def _dirloc_paths(mc):
+    """Map the dirlocs of the entries on the card to their paths.
+
+    The "." and ".." entries of a directory map to the directory."""
+
+    paths = {(0, 0): "/", (0, 1): "/"}
+    stack = [("/", 0)]
+    while len(stack) > 0:
+        (dirname, cluster) = stack.pop()
+        dir = mc.dir_open(dirname)
+        try:
+            ents = list(dir)
+        finally:
+            dir.close()
+        for (i, ent) in enumerate(ents):
+            if i < 2 or not ent[0] & DF_EXISTS:
+                continue
+            path = dirname + ent[8].decode("ascii")
+            paths[(cluster, i)] = path
+            if mode_is_dir(ent[0]):
+                paths[(ent[4], 0)] = paths[(ent[4], 1)] = path
+                stack.append((path + "/", ent[4]))
+    return paths
+
+def do_watch(cmd, mc, opts, args, opterr):
+    if len(args) != 0:
+        opterr("Incorrect number of arguments.")
+    if opts.interval <= 0:
+        opterr("Invalid interval (%s)." % opts.interval)
+    events = [("dirent_created", "created"),
+          ("dirent_modified", "modified"),
+          ("dirent_deleted", "deleted")]
+    batches = []
+    mc.subscribe(lambda mc, changes: batches.append(changes),
+             [event for (event, what) in events])
+    mc.refresh_if_changed()
+    paths = _dirloc_paths(mc)
+
+    polls = 0
+    try:
+        while opts.count == None or polls < opts.count:
+            time.sleep(opts.interval)
+            polls += 1
+            if not mc.refresh_if_changed():
+                continue
+            old_paths = paths
+            paths = _dirloc_paths(mc)
+            now = time.time()
+            changes = set()
+            for batch in batches:
+                for (event, what) in events:
+                    for dirloc in batch.get(event, []):
+                        path = paths.get(dirloc)
+                        if path == None:
+                            path = old_paths.get(dirloc,
+                                         "(%d, %d)" % dirloc)
+                        changes.add((path, what))
+            del batches[:]
+            for (path, what) in sorted(changes):
+                if opts.json:
+                    print(json.dumps({"time": now, "event": what,
+                              "path": path},
+                             sort_keys = True))
+                else:
+                    print("%s %-8s %s"
+                          % (time.strftime("%H:%M:%S",
+                                   time.localtime(now)),
+                         what, path))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
 #re_num = re.compile("[0-9]+")
 
 def do_export(cmd, mc, opts, args, opterr):
@@ -241,6 +426,12 @@ def do_export(cmd, mc, opts, args, opterr):
             opterr("Only one directory can be exported when the -o option is used.")
         if opts.longnames:
             opterr("The -o and -l options are mutually exclusive.")
+    if opts.level is not None:
+        if opts.type != "max":
+            opterr("The -L option can only be used with the -m option.")
+        if not lzari.MIN_LEVEL <= opts.level <= lzari.MAX_LEVEL:
+            opterr("Compression level must be from %d to %d."
+                   % (lzari.MIN_LEVEL, lzari.MAX_LEVEL))
 
     if opts.directory is not None:
         os.chdir(opts.directory)
@@ -269,7 +460,10 @@ def do_export(cmd, mc, opts, args, opterr):
             print("Exporing", dirname, "to", filename)
             
             if opts.type == "max":
-                format_max_drive.save(sf, f)
+                if opts.level is None:
+                    format_max_drive.save(sf, f)
+                else:
+                    format_max_drive.save(sf, f, opts.level)
             elif opts.type == "psv":
                 format_psv.save(sf, f)
             else:
@@ -446,6 +640,47 @@ def do_format(cmd, mcname, opts, args, opterr):
     finally:
         f.close()
 
+def _parse_range(s, what, opterr):
+    a = s.split("-", 1)
+    try:
+        lo = int(a[0])
+        hi = int(a[-1])
+    except ValueError:
+        opterr("Invalid %s (%s)." % (what, s))
+    if lo < 0 or lo > hi:
+        opterr("Invalid %s (%s)." % (what, s))
+    return (lo, hi)
+
+def do_generate(cmd, mcname, opts, args, opterr):
+    if len(args) != 0:
+        opterr("Incorrect number of arguments.")
+    if opts.fill != None and not 0 <= opts.fill <= 1:
+        opterr("The fill fraction must be between 0 and 1.")
+    if not 0 <= opts.fragmentation <= 1:
+        opterr("The fragmentation must be between 0 and 1.")
+    files = _parse_range(opts.files, "file count", opterr)
+    sizes = _parse_range(opts.sizes, "file size", opterr)
+
+    if not opts.overwrite_existing:
+        exists = True
+        try:
+            open(mcname, "rb").close()
+        except EnvironmentError:
+            exists = False
+        if exists:
+            raise io_error(EEXIST, "file exists", mcname)
+
+    f = open(mcname, "w+b")
+    try:
+        names = cardgen.generate(f, opts.clusters, not opts.no_ecc,
+                     opts.seed, saves = opts.saves,
+                     fill = opts.fill, files = files,
+                     sizes = sizes,
+                     fragmentation = opts.fragmentation)
+    finally:
+        f.close()
+    print("Generated", len(names), "saves.")
+
 def do_gui(cmd, mcname, opts, args, opterr):
     if len(args) != 0:
         opterr("Incorrect number of arguments.")
@@ -499,12 +734,283 @@ def do_print_good_blocks(cmd, mc, opts, args, opterr):
     print("good_block1:")
     _print_erase_block(mc, mc.good_block1)
 
-def do_ecc_check(cmd, mc, opts, args, opterr):
-    for i in range(mc.clusters_per_card * mc.pages_per_cluster):
+def do_scan(cmd, mc, opts, args, opterr):
+    if len(args) != 0:
+        opterr("Incorrect number of arguments.")
+    if opts.jobs != None and opts.jobs < 1:
+        opterr("--jobs must be at least 1.")
+    if mc.spare_size == 0:
+        raise io_error(EIO, "memory card image has no ECC data",
+                       mc.f.name)
+    report = ps2mc_scan.scan(mc, opts.jobs)
+    if opts.json:
+        json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write("\n")
+    else:
+        ps2mc_scan.write_report(sys.stdout, report, opts.all_blocks)
+    if report["health"] == "bad":
+        return 1
+    return 0
+
+def do_scrub(cmd, mc, opts, args, opterr):
+    if len(args) != 0:
+        opterr("Incorrect number of arguments.")
+    if opts.jobs != None and opts.jobs < 1:
+        opterr("--jobs must be at least 1.")
+    if mc.spare_size == 0:
+        raise io_error(EIO, "memory card image has no ECC data",
+                       mc.f.name)
+    report = ps2mc_scan.scrub(mc, opts.jobs, opts.dry_run)
+    if opts.json:
+        json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write("\n")
+    else:
+        ps2mc_scan.write_scrub_report(sys.stdout, report)
+    if report["failed_pages"]:
+        return 1
+    return 0
+
+def _kb(n):
+    return "%dKB" % ((n + 1023) // 1024)
+
+def _catalog_path(library, opts):
+    if opts.db != None:
+        return opts.db
+    return os.path.join(library, catalog.CATALOG_NAME)
+
+def do_index(cmd, library, opts, args, opterr):
+    if len(args) != 0:
+        opterr("Incorrect number of arguments.")
+    if opts.jobs != None and opts.jobs < 1:
+        opterr("--jobs must be at least 1.")
+    if not os.path.isdir(library):
+        opterr("%s is not a directory." % library)
+    db = catalog.open_catalog(_catalog_path(library, opts))
+    try:
+        stats = catalog.update(db, library, opts.jobs)
+        (saves,) = db.execute("SELECT COUNT(*) FROM saves").fetchone()
+    finally:
+        db.close()
+    stats["saves"] = saves
+    if opts.json:
+        json.dump(stats, sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write("\n")
+    else:
+        for (path, error) in stats["errors"]:
+            write_error(path, error)
+        print("Indexed %d images, %d unchanged, %d removed, %d failed;"
+              " %d saves in the catalog."
+              % (stats["indexed"], stats["unchanged"], stats["removed"],
+             stats["failed"], saves))
+    if stats["failed"]:
+        return 1
+    return 0
+
+def do_search(cmd, library, opts, args, opterr):
+    if len(args) == 0:
+        opterr("Search term required.")
+    path = _catalog_path(library, opts)
+    if not os.path.exists(path):
+        raise io_error(ENOENT, "no catalog, run the index command first",
+                   path)
+    db = catalog.open_catalog(path)
+    try:
+        results = catalog.search(db, args)
+    finally:
+        db.close()
+    if opts.json:
+        json.dump(results, sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write("\n")
+    else:
+        for r in results:
+            print("%s: %-32s %-10s %9s %s  %s"
+                  % (r["image"], r["name"], r["game_id"] or "",
+                 _kb(r["size"]),
+                 time.strftime("%Y-%m-%d %H:%M",
+                       time.localtime(r["modified"])),
+                 r["title"]))
+    if len(results) == 0:
+        return 1
+    return 0
+
+def do_dedupe_report(cmd, library, opts, args, opterr):
+    if len(args) != 0:
+        opterr("Incorrect number of arguments.")
+    if opts.jobs != None and opts.jobs < 1:
+        opterr("--jobs must be at least 1.")
+    if not os.path.isdir(library):
+        opterr("%s is not a directory." % library)
+    db = catalog.open_catalog(_catalog_path(library, opts))
+    try:
+        stats = catalog.update(db, library, opts.jobs)
+        report = catalog.dedupe_report(db)
+    finally:
+        db.close()
+    for (path, error) in stats["errors"]:
+        write_error(path, error)
+
+    if opts.json:
+        json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write("\n")
+        return 0
+    if len(report["identical"]) > 0:
+        print("Identical saves:")
+        for group in report["identical"]:
+            copies = group["copies"]
+            print("  %s (%s, %d copies)"
+                  % (copies[0]["name"], _kb(group["size"]), len(copies)))
+            for c in copies:
+                print("    %s: %s" % (c["image"], c["name"]))
+    if len(report["near_identical"]) > 0:
+        print("Same directory, different files:")
+        for group in report["near_identical"]:
+            print("  %s (%d versions)"
+                  % (group["name"], len(group["versions"])))
+            for v in group["versions"]:
+                print("    %s %s  %s"
+                      % (v["hash"][:12],
+                     time.strftime("%Y-%m-%d %H:%M",
+                           time.localtime(v["modified"])),
+                     ", ".join(v["images"])))
+    reclaimable = report["reclaimable"]
+    if len(reclaimable) == 0:
+        print("No duplicate saves.")
+        return 0
+    print("Reclaimable space:")
+    for image in sorted(reclaimable):
+        print("  %8s %s" % (_kb(reclaimable[image]), image))
+    print("  %8s total" % _kb(sum(reclaimable.values())))
+    return 0
+
+def do_convert_ecc(cmd, mc, opts, args, opterr):
+    if len(args) != 1:
+        opterr("Incorrect number of arguments.")
+    if opts.add and opts.remove:
+        opterr("--add and --remove can't be used together.")
+    with_ecc = None
+    if opts.add:
+        with_ecc = True
+    elif opts.remove:
+        with_ecc = False
+    outname = args[0]
+    if os.path.abspath(outname) == os.path.abspath(mc.f.name):
+        opterr("The output file must be a different file.")
+
+    f = open(outname, "wb" if opts.overwrite_existing else "xb")
+    try:
+        stats = ps2mc_image.convert_ecc(mc, f, with_ecc)
+    finally:
+        f.close()
+    if stats["corrected"]:
+        print("Corrected %d page%s." % (stats["corrected"],
+                        "" if stats["corrected"] == 1 else "s"))
+    if stats["failed"]:
+        write_error(mc.f.name, "%d pages with uncorrectable ECC errors"
+                    " were copied unchanged" % stats["failed"])
+        return 1
+    return 0
+
+def do_clone(cmd, mc, opts, args, opterr):
+    if len(args) != 1:
+        opterr("Incorrect number of arguments.")
+    if opts.ecc and opts.no_ecc:
+        opterr("--ecc and --no-ecc can't be used together.")
+    with_ecc = None
+    if opts.ecc:
+        with_ecc = True
+    elif opts.no_ecc:
+        with_ecc = False
+    outname = args[0]
+    if os.path.abspath(outname) == os.path.abspath(mc.f.name):
+        opterr("The output file must be a different file.")
+
+    f = open(outname, "w+b" if opts.overwrite_existing else "x+b")
+    try:
+        try:
+            stats = ps2mc_image.clone(mc, f, with_ecc, opts.clusters)
+        finally:
+            f.close()
+    except:
+        os.remove(outname)
+        raise
+    relocated = len(stats["relocated"])
+    if relocated:
+        print("Relocated %d cluster%s." % (relocated,
+                           "" if relocated == 1 else "s"))
+    if stats["corrected"]:
+        print("Corrected %d page%s." % (stats["corrected"],
+                        "" if stats["corrected"] == 1 else "s"))
+    if stats["failed"]:
+        write_error(mc.f.name, "%d pages with uncorrectable ECC errors"
+                    " were copied unchanged" % stats["failed"])
+        return 1
+    return 0
+
+def _card_name(path, opts, opterr):
+    name = opts.name
+    if name == None:
+        name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        backup.check_name(name)
+    except ValueError as e:
+        opterr(str(e))
+    return name
+
+def _list_runs(store, name):
+    ids = backup.runs(store, name)
+    if len(ids) == 0:
+        raise io_error(ENOENT, "no backups of %s" % name, store)
+    for run in ids:
+        print(run)
+    return 0
+
+def do_backup(cmd, mc, opts, args, opterr):
+    if len(args) != 1:
+        opterr("Incorrect number of arguments.")
+    store = args[0]
+    name = _card_name(mc.f.name, opts, opterr)
+    if opts.list:
+        return _list_runs(store, name)
+    stats = backup.backup(mc, store, name)
+    print("Backed up %d saves (%d unchanged) as %s/%s, adding %d files"
+          " (%s) to the store."
+          % (stats["saves"], stats["unchanged"], name, stats["run"],
+         stats["objects"], _kb(stats["bytes"])))
+    return 0
+
+def do_restore(cmd, mcname, opts, args, opterr):
+    if len(args) != 1:
+        opterr("Incorrect number of arguments.")
+    if opts.ecc and opts.no_ecc:
+        opterr("--ecc and --no-ecc can't be used together.")
+    store = args[0]
+    name = _card_name(mcname, opts, opterr)
+    if opts.list:
+        return _list_runs(store, name)
+    if opts.run != None:
         try:
-            mc.read_page(i)
-        except ps2mc.ecc_error:
-            print("bad: %05x" % i)
+            backup.check_name(opts.run)
+        except ValueError as e:
+            opterr(str(e))
+    with_ecc = None
+    if opts.ecc:
+        with_ecc = True
+    elif opts.no_ecc:
+        with_ecc = False
+
+    # check the backup exists before creating the image
+    backup.load_manifest(store, name, opts.run)
+    f = open(mcname, "w+b" if opts.overwrite_existing else "x+b")
+    try:
+        try:
+            n = backup.restore(f, store, name, opts.run, with_ecc)
+        finally:
+            f.close()
+    except:
+        os.remove(mcname)
+        raise
+    print("Restored %d saves." % n)
+    return 0
 
 opt = optparse.make_option
 
@@ -521,6 +1027,36 @@ cmd_table = {
            "List the contents of a directory.",
            [opt("-c", "--creation-time", action="store_true",
             help = "Display creation times.")]),
+    "clone": (do_clone, "rb",
+          "output",
+          "Copy the memory card to a new image, optionally"
+          " resizing it.",
+          [opt("-c", "--clusters", type="int",
+           help = ("Size in clusters of the new memory card."
+               "  [default: the same size]")),
+           opt("-E", "--ecc", action="store_true",
+           help = "Create an image with ECC."),
+           opt("-e", "--no-ecc", action="store_true",
+           help = "Create an image without ECC."),
+           opt("-f", "--overwrite-existing", action="store_true",
+           help = "Overwrite any existing file")]),
+    "copy": (do_copy, "rb",
+         "dest.ps2 directory ...",
+         "Copy save files to another memory card.",
+         [opt("-i", "--ignore-existing", action="store_true",
+          help = ("Ignore directories that already exist"
+              " on the destination.")),
+          opt("-d", "--directory", metavar="DEST",
+          help = 'Copy to "DEST".')]),
+    "convert-ecc": (do_convert_ecc, "rb",
+            "output",
+            "Copy the memory card image, adding or removing ECC.",
+            [opt("-a", "--add", action="store_true",
+             help = "Add ECC.  [default if the image has no ECC]"),
+             opt("-r", "--remove", action="store_true",
+             help = "Remove ECC.  [default if the image has ECC]"),
+             opt("-f", "--overwrite-existing", action="store_true",
+             help = "Overwrite any existing file")]),
     "extract": (do_extract, "rb",
             "filename ...",
             "Extract files from the memory card.",
@@ -571,10 +1107,37 @@ cmd_table = {
             opt("-m", "--max-drive", action = "store_const",
             dest = "type", const = "max",
             help = "Use the MAX Drive save file format."),
+            opt("-L", "--level", type = "int", metavar = "level",
+            help = ("MAX Drive compression level, 1 (fastest)"
+                " to 9 (smallest). [default 9]")),
             #opt("-s", "--psv", action="store_const",
             #dest="type", const="psv",
             #help="Use the PSV (PlayStation 3) save file format.")
             ]),
+    "backup": (do_backup, "rb",
+           "store",
+           "Back up the saves on the memory card to a backup store.",
+           [opt("-n", "--name",
+            help = ("The name of the card in the store."
+                "  [default: the image's file name]")),
+            opt("-l", "--list", action="store_true",
+            help = "List the card's backups instead.")]),
+    "restore": (do_restore, None,
+            "store",
+            "Create a memory card image from a backup.",
+            [opt("-n", "--name",
+             help = ("The name of the card in the store."
+                 "  [default: the image's file name]")),
+             opt("-r", "--run", metavar="ID",
+             help = "The backup to restore.  [default: the latest]"),
+             opt("-l", "--list", action="store_true",
+             help = "List the card's backups instead."),
+             opt("-E", "--ecc", action="store_true",
+             help = "Create an image with ECC."),
+             opt("-e", "--no-ecc", action="store_true",
+             help = "Create an image without ECC."),
+             opt("-f", "--overwrite-existing", action="store_true",
+             help = "Overwrite any existing file")]),
     "delete": (do_delete, "r+b",
            "dirname ...",
            "Recursively delete a directory (save file).",
@@ -617,6 +1180,27 @@ cmd_table = {
              help = "Clear executable flag"),
          opt("-X", dest="hex_value", default=None,
              help = optparse.SUPPRESS_HELP)]),
+    "diff": (do_diff, "rb",
+         "other.ps2",
+         "Compare the saves on two memory cards.",
+         [opt("-a", "--all", action="store_true",
+          help = "List the saves that are the same as well."),
+          opt("--json", action="store_true",
+          help = "Write the comparison as JSON.")]),
+    "sync": (do_sync, "r+b",
+         "other.ps2",
+         "Copy the saves that differ between two memory cards.",
+         [opt("-n", "--dry-run", action="store_true",
+          help = "Only list the saves that would be copied."),
+          opt("--push", action="store_true",
+          help = "Only copy saves to the other memory card."),
+          opt("--pull", action="store_true",
+          help = "Only copy saves from the other memory card."),
+          opt("-c", "--conflict", type="choice",
+          choices = ["newer", "this", "other", "skip"],
+          default = "newer",
+          help = ("Which copy of a save that differs wins: newer,"
+              " this, other or skip.  [default: %default]"))]),
     "dir": (do_dir, "rb",
         None,
         "Display save file information.",
@@ -630,6 +1214,16 @@ cmd_table = {
           "",
           "Check for file system errors.",
           []),
+    "watch": (do_watch, "rb",
+          "",
+          "Report changes made to the memory card by other programs.",
+          [opt("-t", "--interval", type="float", default=1.0,
+           metavar="SECONDS",
+           help = "How often to check the image. [default: %default]"),
+           opt("-c", "--count", type="int",
+           help = "Stop after checking COUNT times."),
+           opt("--json", action="store_true",
+           help = "Write each change as a line of JSON.")]),
     "format": (do_format, None,
            "",
            "Creates a new memory card image.",
@@ -639,6 +1233,88 @@ cmd_table = {
             help = "Overwrite any existing file"),
             opt("-e", "--no-ecc", action="store_true",
             help = "Create an image without ECC")]),
+    "generate": (do_generate, None,
+             "",
+             "Create a memory card image filled with synthetic saves.",
+             [opt("-c", "--clusters", type="int",
+              help = "Size in clusters of the memory card."),
+              opt("-f", "--overwrite-existing", action="store_true",
+              help = "Overwrite any existing file"),
+              opt("-e", "--no-ecc", action="store_true",
+              help = "Create an image without ECC"),
+              opt("-n", "--saves", type="int",
+              help = ("Number of saves to create. [default %d,"
+                  " or no limit with -F]" % cardgen.DEFAULT_SAVES)),
+              opt("-F", "--fill", type="float", metavar="FRACTION",
+              help = "Add saves until this fraction of the card is used."),
+              opt("--files", metavar="MIN-MAX",
+              default = "%d-%d" % (cardgen.DEFAULT_MIN_FILES,
+                           cardgen.DEFAULT_MAX_FILES),
+              help = ("Number of data files in each save,"
+                  " besides the icon files. [default %default]")),
+              opt("--sizes", metavar="MIN-MAX",
+              default = "%d-%d" % (cardgen.DEFAULT_MIN_SIZE,
+                           cardgen.DEFAULT_MAX_SIZE),
+              help = ("Size in bytes of the data files."
+                  " [default %default]")),
+              opt("-r", "--fragmentation", type="float", default = 0.0,
+              help = ("Chance, from 0 to 1, of leaving a hole after"
+                  " each cluster written. [default %default]")),
+              opt("-s", "--seed", type="int", default = 0,
+              help = "Random number seed. [default %default]")]),
+    "scan": (do_scan, "rb",
+         "",
+         "Check the ECC of every page and report the health of"
+         " each erase block.",
+         [opt("-j", "--jobs", type="int",
+          help = ("Number of processes to use."
+              " [default: one per CPU]")),
+          opt("--json", action="store_true",
+          help = "Write the report as JSON."),
+          opt("-a", "--all-blocks", action="store_true",
+          help = ("List every erase block, not just those"
+              " with errors."))]),
+    "scrub": (do_scrub, "r+b",
+          "",
+          "Rewrite pages with correctable ECC errors.",
+          [opt("-n", "--dry-run", action="store_true",
+           help = "Only report the pages that would be rewritten."),
+           opt("-j", "--jobs", type="int",
+           help = ("Number of processes to use for the scan."
+               " [default: one per CPU]")),
+           opt("--json", action="store_true",
+           help = "Write the report as JSON.")]),
+    "index": (do_index, None,
+          "",
+          "Catalog the saves on the memory card images in a directory.",
+          [opt("--db", metavar="FILE",
+           help = ("The catalog database.  [default: %s in the"
+               " directory]" % catalog.CATALOG_NAME)),
+           opt("-j", "--jobs", type="int",
+           help = ("Number of processes to use."
+               " [default: one per CPU]")),
+           opt("--json", action="store_true",
+           help = "Write the summary as JSON.")]),
+    "dedupe-report": (do_dedupe_report, None,
+              "",
+              "Report the saves duplicated across the memory card"
+              " images in a directory.",
+              [opt("--db", metavar="FILE",
+               help = ("The catalog database.  [default: %s in the"
+                   " directory]" % catalog.CATALOG_NAME)),
+               opt("-j", "--jobs", type="int",
+               help = ("Number of processes to use."
+                   " [default: one per CPU]")),
+               opt("--json", action="store_true",
+               help = "Write the report as JSON.")]),
+    "search": (do_search, None,
+           "term ...",
+           "Search a directory's catalog by game ID or title.",
+           [opt("--db", metavar="FILE",
+            help = ("The catalog database.  [default: %s in the"
+                " directory]" % catalog.CATALOG_NAME)),
+            opt("--json", action="store_true",
+            help = "Write the results as JSON.")]),
     "gui": (do_gui, None,
         "",
         "Starts the graphical user interface.",
@@ -657,10 +1333,6 @@ debug_cmd_table = {
                   "",
                   None,
                   []),
-    "ecc_check": (do_ecc_check, "rb",
-              "",
-              None,
-              []),
     "create_pad": (do_create_pad, "r+b",
                "",
                None,
@@ -704,9 +1376,104 @@ class my_help_formatter(optparse.IndentedHelpFormatter):
             lines.append(line)
         return "\n".join(lines) + "\n"
 
+class phase_timer(object):
+    """Record the wall-clock time spent in each phase of a command."""
+
+    def __init__(self):
+        self.phases = []
+        self.current = None
+        self.started = None
+
+    def start(self, name):
+        now = time.perf_counter()
+        self._end(now)
+        self.current = name
+        self.started = now
+
+    def stop(self):
+        self._end(time.perf_counter())
+        self.current = None
+
+    def _end(self, now):
+        if self.current != None:
+            self.phases.append((self.current, now - self.started))
+
+    def write(self, f):
+        total = sum(t for (name, t) in self.phases)
+        for (name, t) in self.phases:
+            f.write("%-8s %9.3f ms\n" % (name, t * 1000))
+        f.write("%-8s %9.3f ms\n" % ("total", total * 1000))
+
+def write_profile(profiler, opts):
+    import pstats
+
+    if opts.profile_output != None:
+        profiler.dump_stats(opts.profile_output)
+        return
+    stats = pstats.Stats(profiler, stream = sys.stderr)
+    stats.sort_stats("cumulative").print_stats(opts.profile_top)
+
+def write_stats(stats):
+    width = max(len(name) for name in ps2mc.STAT_NAMES)
+    for name in ps2mc.STAT_NAMES:
+        sys.stderr.write("%-*s %d\n" % (width, name, stats[name]))
+
+def run_fleet(optparser, opts, args):
+    if len(args) < 1:
+        optparser.error("Incorrect number of arguments.")
+    if args[0] not in fleet.COMMANDS:
+        optparser.error('Command "%s" can\'t be used with --cards.'
+                % args[0])
+    if opts.jobs != None and opts.jobs < 1:
+        optparser.error("--jobs must be at least 1.")
+    if (opts.trace != None or opts.profile
+        or opts.profile_output != None):
+        optparser.error("--trace and --profile can't be used"
+                " with --cards.")
+
+    cards = fleet.find_cards(opts.cards)
+    if len(cards) == 0:
+        write_error(None, "No memory cards match "
+                + ", ".join(opts.cards) + ".")
+        return 1
+    card_options = None
+    if args[0] == "backup":
+        # the cards need a name each, as a card's backups are found
+        # by its name
+        subopt_parser = suboption_parser(option_list = cmd_table["backup"][4])
+        subopt_parser.disable_interspersed_args()
+        try:
+            (subopts, subargs) = subopt_parser.parse_args(args[1:])
+        except subopt_error as e:
+            return e.args[0]
+        if subopts.name != None:
+            optparser.error("backup --name can't be used with --cards.")
+        names = fleet.card_names(cards)
+        if len(set(names)) != len(names):
+            optparser.error("Some of the cards would have the same name"
+                    " in the backup store.")
+        card_options = [["--name", name] for name in names]
+
+    options = []
+    if opts.ignore_ecc:
+        options.append("-i")
+    if opts.stats:
+        options.append("--stats")
+    if opts.timings:
+        options.append("--timings")
+    results = fleet.run(cards, args, options, opts.jobs, card_options)
+    if opts.json:
+        summary = fleet.summary(args, results)
+        json.dump(summary, sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write("\n")
+        return summary["status"]
+    return fleet.write_results(sys.stdout, sys.stderr, results)
+
 def main(argv=sys.argv):
     prog = argv[0]
-    usage = "usage: %prog [-ih] memcard.ps2 command [...]"
+    usage = ("usage: %prog [-ih] memcard.ps2 command [...]\n"
+         "       %prog [-ih] --cards pattern [-j N] [--json]"
+         " command [...]")
     description = ("Manipulate PS2 memory card images.\n\n"
                "Supported commands: ")
     for cmd in sorted(cmd_table.keys()):
@@ -724,6 +1491,52 @@ def main(argv=sys.argv):
                  default = False, help = optparse.SUPPRESS_HELP)
     optparser.add_option("-i", "--ignore-ecc", action = "store_true",
                  help = "Ignore ECC errors while reading.")
+    optparser.add_option("--profile", action = "store_true",
+                 default = False,
+                 help = ("Run the command under cProfile and print"
+                     " the functions with the most cumulative"
+                     " time to stderr."))
+    optparser.add_option("--profile-output", metavar = "file",
+                 help = ("Save the profile to \"file\" in pstats"
+                     " format instead of printing it."
+                     "  Implies --profile."))
+    optparser.add_option("--profile-top", metavar = "N", type = "int",
+                 default = 25,
+                 help = ("The number of functions printed by"
+                     " --profile. [default: %default]"))
+    optparser.add_option("--timings", action = "store_true",
+                 default = False,
+                 help = ("Print the time spent opening the memory"
+                     " card, running the command and closing"
+                     " the card to stderr."))
+    optparser.add_option("--trace", metavar = "file",
+                 help = ("Record the memory card's page, cluster, cache"
+                     " and FAT accesses to \"file\".  See"
+                     " mymcplusplus/iotrace.py."))
+    optparser.add_option("--stats", action = "store_true",
+                 default = False,
+                 help = ("Print the memory card's I/O and cache"
+                     " statistics to stderr on exit."))
+    optparser.add_option("--lzari-cache", metavar = "directory",
+                 help = ("Cache MAX Drive compression results in"
+                     ' "directory".  The size of the cache is'
+                     " limited by the "
+                     + lzari_cache.ENV_SIZE
+                     + " environment variable. [default: "
+                     + lzari_cache.ENV_DIR + "]"))
+    optparser.add_option("--cards", metavar = "pattern",
+                 action = "append",
+                 help = ("Run the command on every memory card"
+                     " matching \"pattern\" instead of one card."
+                     "  Can be given more than once.  Commands: "
+                     + ", ".join(fleet.COMMANDS) + "."))
+    optparser.add_option("-j", "--jobs", type = "int",
+                 help = ("Number of processes to use with --cards."
+                     " [default: one per CPU]"))
+    optparser.add_option("--json", action = "store_true",
+                 default = False,
+                 help = ("With --cards, write a JSON summary of each"
+                     " card's exit status and output."))
                  
     optparser.disable_interspersed_args()
     (opts, args) = optparser.parse_args(args=argv[1:])
@@ -737,9 +1550,30 @@ def main(argv=sys.argv):
             gui.run()
             sys.exit(0)
 
+    if opts.cards != None:
+        return run_fleet(optparser, opts, args)
+    if opts.jobs != None or opts.json:
+        optparser.error("-j and --json can only be used with --cards.")
+
     if len(args) < 2:
         optparser.error("Incorrect number of arguments.")
 
+    if opts.lzari_cache != None:
+        try:
+            lzari_cache.set_cache(opts.lzari_cache)
+        except ValueError as e:
+            optparser.error(str(e))
+        except EnvironmentError as e:
+            optparser.error("%s: %s" % (opts.lzari_cache, e.strerror))
+
+    if opts.profile_top < 1:
+        optparser.error("--profile-top must be at least 1.")
+    profiler = None
+    if opts.profile or opts.profile_output != None:
+        import cProfile
+        profiler = cProfile.Profile()
+    timer = phase_timer()
+
     if opts.debug:
         cmd_table.update(debug_cmd_table)
     cmd = args[1]
@@ -760,26 +1594,45 @@ def main(argv=sys.argv):
     
     f = None
     mc = None
+    tracer = None
     ret = 0
     mcname = args[0]
 
     try:
         (subopts, subargs) = subopt_parser.parse_args(args[2:])
+        if profiler != None:
+            profiler.enable()
         try:
             if mode == None:
+                timer.start("command")
                 ret = fn(cmd, mcname, subopts, subargs,
                      subopt_parser.error)
             else:
+                timer.start("open")
                 f = open(mcname, mode)
                 mc = ps2mc.ps2mc(f, opts.ignore_ecc)
+                if opts.trace != None:
+                    tracer = iotrace.io_tracer(open(opts.trace, "w"))
+                    mc.set_trace(tracer)
+                timer.start("command")
                 ret = fn(cmd, mc, subopts, subargs,
                      subopt_parser.error)
         finally:
-            if mc != None:
-                mc.close()
-            if f != None:
-                # print "f.close()"
-                f.close()
+            timer.start("close")
+            try:
+                if mc != None:
+                    mc.close()
+                if f != None:
+                    # print "f.close()"
+                    f.close()
+                if tracer != None:
+                    tracer.close()
+            finally:
+                timer.stop()
+                if profiler != None:
+                    profiler.disable()
+                if mc != None and opts.stats:
+                    write_stats(mc.stats())
 
     except EnvironmentError as value:
         if getattr(value, "filename", None) != None:
@@ -807,6 +1660,11 @@ def main(argv=sys.argv):
             raise
         ret = 1
 
+    if opts.timings:
+        timer.write(sys.stderr)
+    if profiler != None:
+        write_profile(profiler, opts)
+
     if ret == None:
         ret = 0
 
@@ -18,10 +18,12 @@
 """Manipulate PS2 memory card images."""
 
 import sys
+import os
 import array
 import struct
+import zlib
 from errno import EACCES, ENOENT, EEXIST, ENOTDIR, EISDIR, EROFS, ENOTEMPTY,\
-     ENOSPC, EIO, EBUSY
+     ENOSPC, EIO, EBUSY, EINVAL
 import fnmatch
 import traceback
 
@@ -43,6 +45,40 @@ PS2MC_STANDARD_PAGE_SIZE = 512
 PS2MC_STANDARD_PAGES_PER_CARD = 16384
 PS2MC_STANDARD_PAGES_PER_ERASE_BLOCK = 16
 
+# The number of FAT and allocatable clusters kept in memory.
+FAT_CACHE_SIZE = 12
+ALLOC_CLUSTER_CACHE_SIZE = 64
+
+# format() keeps the images it builds for reuse, as many as fit in
+# this many bytes: enough for a standard 8 MB card with and without ECC.
+# Larger images aren't kept.
+FORMAT_TEMPLATE_CACHE_SIZE = (PS2MC_STANDARD_PAGES_PER_CARD
+                  * (PS2MC_STANDARD_PAGE_SIZE
+                 + PS2MC_STANDARD_PAGE_SIZE // 128 * 4) * 2)
+
+_format_templates = {}
+
+def clear_format_templates():
+    """Free the images format() has kept for reuse."""
+
+    _format_templates.clear()
+
+# The changes that can be subscribed to with ps2mc.subscribe().
+EVENTS = ["dirent_created", "dirent_modified", "dirent_deleted",
+      "cluster_written", "fat_changed", "flush"]
+
+# The counters returned by ps2mc.stats(), in the order they're reported.
+STAT_NAMES = ["pages_read", "pages_written",
+          "clusters_read", "clusters_written",
+          "bytes_read", "bytes_written",
+          "ecc_pages_checked", "ecc_pages_corrected", "ecc_pages_failed",
+          "fat_cache_hits", "fat_cache_misses",
+          "fat_cache_evictions", "fat_cache_writebacks",
+          "cluster_cache_hits", "cluster_cache_misses",
+          "cluster_cache_evictions", "cluster_cache_writebacks",
+          "clusters_allocated", "clusters_freed",
+          "flushes", "superblock_writes"]
+
 class error(Exception):
     pass
 
@@ -122,6 +158,31 @@ def pack_superblock(sb):
 unpack_fat = unpack_32bit_array
 pack_fat = pack_32bit_array
 
+class check_finding(object):
+    """A problem found by ps2mc.check_findings().
+
+    kind is one of "bad directory", "bad file" or "lost clusters".
+    path is the name of the bad file or directory, why describes the
+    problem and clusters lists the lost clusters."""
+
+    def __init__(self, kind, path, why, clusters = None):
+        self.kind = kind
+        self.path = path
+        self.why = why
+        self.clusters = clusters
+
+    def __repr__(self):
+        return "check_finding(%r, %r, %r, %r)" % (self.kind, self.path,
+                              self.why, self.clusters)
+
+    def __str__(self):
+        if self.kind == "lost clusters":
+            return ("".join("%d " % i for i in self.clusters)
+                + "\nfound %d lost clusters" % len(self.clusters))
+        if self.kind == "bad directory":
+            return "bad directory: %s: %s" % (self.path, self.why)
+        return "bad file: %s: %s" % (self.path, self.why)
+
 class lru_cache(object):
     def __init__(self, length):
         self._lru_list = [[i - 1, None, None, i + 1]
@@ -189,6 +250,29 @@ class lru_cache(object):
         return [(elt[1], elt[2])
             for elt in self._lru_list[1 : -1]
             if elt[2] != None]
+
+    def remove(self, key):
+        """Remove key from the cache and return its value, or None
+        if it wasn't in the cache."""
+
+        i = self._index_map.pop(key, None)
+        if i == None:
+            return None
+        lru_list = self._lru_list
+        elt = lru_list[i]
+        value = elt[2]
+        elt[1] = None
+        elt[2] = None
+        # move the empty entry to the end so it's reused first
+        lru_list[elt[0]][3] = elt[3]
+        lru_list[elt[3]][0] = elt[0]
+        tail = len(lru_list) - 1
+        last = lru_list[tail][0]
+        elt[0] = last
+        elt[3] = tail
+        lru_list[last][3] = i
+        lru_list[tail][0] = i
+        return value
         
 class fat_chain(object):
     """A class for accessing a file's FAT entries as a simple sequence."""
@@ -584,6 +668,11 @@ class _root_directory(ps2mc_directory):
     def real_close(self):
         ps2mc_directory.close(self)
         
+def _watch_is_dir(mode):
+    # deleted directories aren't followed, their clusters may have
+    # been reused
+    return mode_is_dir(mode) and mode & DF_EXISTS
+
 class ps2mc(object):
     """A PlayStation 2 memory card filesystem implementation.
 
@@ -593,6 +682,10 @@ class ps2mc(object):
     
     open_files = None
     fat_cache = None
+    trace = None
+    subscribers = None
+    pending_changes = None
+    watch = None
     
     def _calculate_derived(self):
         self.spare_size = div_round_up(self.page_size, 128) * 4
@@ -607,9 +700,11 @@ class ps2mc(object):
         self.allocatable_cluster_limit = limit
 
     def __init__(self, f, ignore_ecc = False, params = None):
+        self.counters = dict.fromkeys(STAT_NAMES, 0)
+        self.subscribers = []
         self.open_files = {}
-        self.fat_cache = lru_cache(12)
-        self.alloc_cluster_cache = lru_cache(64)
+        self.fat_cache = lru_cache(FAT_CACHE_SIZE)
+        self.alloc_cluster_cache = lru_cache(ALLOC_CLUSTER_CACHE_SIZE)
         self.modified = False
         self.f = None
         self.rootdir = None
@@ -664,7 +759,84 @@ class ps2mc(object):
         self.fat_cursor = 0
         self.curdir = (0, 0)
 
-    def write_superblock(self):
+    def stats(self):
+        """Return a dictionary of the I/O and cache counters.
+
+        The counters, named in STAT_NAMES, start at zero when the
+        object is created and keep counting after it is closed."""
+
+        return dict(self.counters)
+
+    def reset_stats(self):
+        for name in STAT_NAMES:
+            self.counters[name] = 0
+
+    def subscribe(self, callback, events = None):
+        """Call callback when the memory card image is changed.
+
+        Changes are collected and passed to the callback in a batch
+        when the image is next flushed, as callback(mc, changes).
+        changes is a dictionary that maps the names of the events that
+        occurred, out of those listed in events (default all of
+        EVENTS), to sets of:
+
+            dirent_created      dirlocs of new directory entries
+            dirent_modified     dirlocs of changed directory entries
+            dirent_deleted      dirlocs of deleted directory entries
+            cluster_written     allocatable cluster numbers
+            fat_changed         FAT entry numbers
+            flush               nothing; always passed if subscribed
+
+        A deleted entry may also be reported as modified.  The
+        callback isn't called if none of the events occurred."""
+
+        if events == None:
+            events = EVENTS
+        for event in events:
+            if event not in EVENTS:
+                raise ValueError("unknown event: %s" % event)
+        self.subscribers.append((callback, frozenset(events)))
+        if self.pending_changes == None:
+            self.pending_changes = self._empty_changes()
+
+    def unsubscribe(self, callback):
+        if self.subscribers == None:
+            return
+        self.subscribers = [(cb, events)
+                    for (cb, events) in self.subscribers
+                    if cb != callback]
+        if len(self.subscribers) == 0:
+            self.pending_changes = None
+
+    def _empty_changes(self):
+        return dict((event, set()) for event in EVENTS)
+
+    def _notify(self, event, key):
+        pending = self.pending_changes
+        if pending != None:
+            pending[event].add(key)
+
+    def _deliver_changes(self):
+        changes = self.pending_changes
+        self.pending_changes = self._empty_changes()
+        for (callback, events) in list(self.subscribers):
+            batch = dict((event, changes[event])
+                     for event in events
+                     if event == "flush" or changes[event])
+            if len(batch) != 0:
+                callback(self, batch)
+
+    def set_trace(self, tracer):
+        """Record I/O and cache accesses with an iotrace.io_tracer.
+
+        Tracing is stopped if tracer is None."""
+
+        self.trace = tracer
+        if tracer != None:
+            tracer.header(self, FAT_CACHE_SIZE,
+                      ALLOC_CLUSTER_CACHE_SIZE)
+
+    def _superblock_page(self):
         s = pack_superblock((PS2MC_MAGIC,
                      self.version,
                      self.page_size,
@@ -681,8 +853,10 @@ class ps2mc(object):
                      self.bad_erase_block_list,
                      2,
                      0x2B))
-        s += b"\x00" * (self.page_size - len(s))
-        self.write_page(0, s)
+        return s + b"\x00" * (self.page_size - len(s))
+
+    def write_superblock(self):
+        self.write_page(0, self._superblock_page())
 
         page = b"\xFF" * self.raw_page_size
         self.f.seek(self.good_block2 * self.pages_per_erase_block
@@ -690,6 +864,11 @@ class ps2mc(object):
         for i in range(self.pages_per_erase_block):
             self.f.write(page)
 
+        counters = self.counters
+        counters["superblock_writes"] += 1
+        counters["pages_written"] += self.pages_per_erase_block
+        counters["bytes_written"] += (self.pages_per_erase_block
+                          * self.raw_page_size)
         self.modified = False
         return
         
@@ -751,7 +930,7 @@ class ps2mc(object):
         self.pages_per_erase_block = pages_per_erase_block
         self.clusters_per_card = clusters_per_card
         self.allocatable_cluster_offset = allocatable_cluster_offset
-        self.allocatable_cluster_end = allocatable_clusters
+        self.allocatable_cluster_end = allocatable_cluster_end
         self.rootdir_fat_cluster = 0
         self.good_block1 = good_block1
         self.good_block2 = good_block2
@@ -762,20 +941,83 @@ class ps2mc(object):
         self._calculate_derived()
 
         self.ignore_ecc = not with_ecc
-        erased = b"\0" * page_size
         if not with_ecc:
             self.spare_size = 0
             self.raw_page_size = self.page_size
-        else:
-            ecc = b"".join([bytes(s) for s in ecc_calculate_page(erased)])
-            erased += ecc + b"\0" * (self.spare_size - len(ecc))
+
+        key = (with_ecc, page_size, pages_per_erase_block, pages_per_card)
+        image = _format_templates.get(key)
+        if image == None:
+            image = self._format_image(pages_per_card, first_ifc,
+                           indirect_fat_clusters,
+                           fat_clusters,
+                           allocatable_cluster_end)
+            if len(image) <= FORMAT_TEMPLATE_CACHE_SIZE:
+                kept = sum(len(t) for t in _format_templates.values())
+                while kept + len(image) > FORMAT_TEMPLATE_CACHE_SIZE:
+                    oldest = next(iter(_format_templates))
+                    kept -= len(_format_templates.pop(oldest))
+                _format_templates[key] = image
 
         self.f.seek(0)
-        for page in range(pages_per_card):
-            self.f.write(erased)
+        self.f.write(image)
+
+        now = tod_now()
+        s = pack_dirent((DF_RWX | DF_DIR | DF_0400 | DF_EXISTS,
+                 0, 2, now,
+                 0, 0, now, 0, b"."))
+        s += pack_dirent((DF_WRITE | DF_EXECUTE | DF_DIR | DF_0400
+                  | DF_HIDDEN | DF_EXISTS,
+                  0, 0, now,
+                  0, 0, now, 0, b".."))
+        s += b"\0" * (cluster_size - len(s))
+        self.write_cluster(allocatable_cluster_offset, s)
+
+        counters = self.counters
+        counters["pages_written"] += pages_per_card
+        counters["bytes_written"] += len(image)
+        counters["superblock_writes"] += 1
+        self.modified = False
+        self.f.flush()
+
+    def _format_image(self, pages_per_card, first_ifc,
+              indirect_fat_clusters, fat_clusters,
+              allocatable_cluster_end):
+        """Build the contents of a freshly formatted image.
+
+        Everything but the root directory is the same for every card
+        with the same parameters, so the image is built as one buffer
+        and can be reused by later calls to format()."""
+
+        page_size = self.page_size
+        raw_page_size = self.raw_page_size
+        pages_per_cluster = self.pages_per_cluster
+        epc = self.entries_per_cluster
+        spare_size = self.spare_size
+        ecc_cache = {}
+
+        def raw_page(page):
+            if spare_size == 0:
+                return page
+            spare = ecc_cache.get(page)
+            if spare == None:
+                spare = b"".join([bytes(s)
+                          for s in ecc_calculate_page(page)])
+                spare += b"\0" * (spare_size - len(spare))
+                ecc_cache[page] = spare
+            return page + spare
+
+        def raw_cluster(data):
+            return b"".join([raw_page(data[i * page_size
+                              : (i + 1) * page_size])
+                     for i in range(pages_per_cluster)])
+
+        image = bytearray(raw_page(b"\0" * page_size) * pages_per_card)
+        raw_cluster_size = raw_page_size * pages_per_cluster
+        def put_cluster(n, data):
+            offset = n * raw_cluster_size
+            image[offset : offset + raw_cluster_size] = raw_cluster(data)
 
-        self.modified = True
-        
         first_fat_cluster = first_ifc + indirect_fat_clusters
         remainder = fat_clusters % epc
         for i in range(indirect_fat_clusters):
@@ -785,33 +1027,26 @@ class ps2mc(object):
                 and remainder != 0):
                 del buf[remainder:]
                 buf.fromlist([0xFFFFFFFF] * (epc - remainder))
-            self._write_fat_cluster(ifc_list[i], buf)
-
-        
-        # go through the fat backwards for better cache usage
-        for i in range(allocatable_clusters - 1,
-                   allocatable_cluster_end - 1, -1):
-            self.set_fat(i, PS2MC_FAT_CHAIN_END)
-        for i in range(allocatable_cluster_end - 1, 0, -1):
-            self.set_fat(i, PS2MC_FAT_CLUSTER_MASK)
-        self.set_fat(0, PS2MC_FAT_CHAIN_END)
-
-        self.allocatable_cluster_end = allocatable_cluster_end
-        
-        now = tod_now()
-        s = pack_dirent((DF_RWX | DF_DIR | DF_0400 | DF_EXISTS,
-                 0, 2, now,
-                 0, 0, now, 0, b"."))
-        s += b"\0" * (cluster_size - len(s))
-        self.write_allocatable_cluster(0, s)
-        dir = self._directory((0, 0), 0, 2, "wb", "/")
-        dir.write_raw_ent(1, (DF_WRITE | DF_EXECUTE | DF_DIR | DF_0400
-                      | DF_HIDDEN | DF_EXISTS,
-                      0, 0, now,
-                      0, 0, now, 0, b".."), False)
-        dir.close()
-
-        self.flush()
+            put_cluster(self.indirect_fat_cluster_list[i], pack_fat(buf))
+
+        # Cluster 0 holds the root directory, the clusters up to the
+        # end of the allocatable space are free and the rest of the
+        # FAT is marked as in use.
+        for i in range(fat_clusters):
+            lo = max(i * epc, 1)
+            hi = min((i + 1) * epc, allocatable_cluster_end)
+            fat = [PS2MC_FAT_CHAIN_END] * epc
+            if lo < hi:
+                fat[lo - i * epc : hi - i * epc] = (
+                    [PS2MC_FAT_CLUSTER_MASK] * (hi - lo))
+            put_cluster(first_fat_cluster + i, pack_fat(unpack_fat(fat)))
+
+        image[0 : raw_page_size] = raw_page(self._superblock_page())
+        offset = (self.good_block2 * self.pages_per_erase_block
+              * raw_page_size)
+        length = self.pages_per_erase_block * raw_page_size
+        image[offset : offset + length] = b"\xFF" * length
+        return image
 
     def read_page(self, n):
         # print "@@@ page", n
@@ -821,16 +1056,26 @@ class ps2mc(object):
         if len(page) != self.page_size:
             raise corrupt("attempted to read past EOF"
                     " (page %05X)" % n, f)
+        counters = self.counters
+        counters["pages_read"] += 1
+        if self.trace != None:
+            self.trace.record("page_read", n)
         if self.ignore_ecc:
+            counters["bytes_read"] += self.page_size
             return page
         spare = f.read(self.spare_size)
         if len(spare) != self.spare_size:
             raise corrupt("attempted to read past EOF"
                     " (page %05X)" % n, f)
+        counters["bytes_read"] += self.raw_page_size
         if n == 0 and spare == b'\xff' * 16:
             raise ecc_error("ECC data absent")
         (status, page, spare) = ecc_check_page(page, spare)
-        if status == ECC_CHECK_FAILED:
+        counters["ecc_pages_checked"] += 1
+        if status == ECC_CHECK_CORRECTED:
+            counters["ecc_pages_corrected"] += 1
+        elif status == ECC_CHECK_FAILED:
+            counters["ecc_pages_failed"] += 1
             raise ecc_error("Unrecoverable ECC error (page %d)"
                       % n)
         return page
@@ -842,6 +1087,10 @@ class ps2mc(object):
         if len(buf) != self.page_size:
             raise error("internal error: write_page:"
                       " %d != %d" % (len(buf), self.page_size))
+        self.counters["pages_written"] += 1
+        self.counters["bytes_written"] += self.raw_page_size
+        if self.trace != None:
+            self.trace.record("page_write", n)
         f.write(buf)
         if self.spare_size != 0:
             a = array.array('B')
@@ -853,7 +1102,12 @@ class ps2mc(object):
     def read_cluster(self, n):
         pages_per_cluster = self.pages_per_cluster
         cluster_size = self.cluster_size
+        self.counters["clusters_read"] += 1
+        if self.trace != None:
+            self.trace.record("cluster_read", n)
         if self.spare_size == 0:
+            self.counters["pages_read"] += pages_per_cluster
+            self.counters["bytes_read"] += cluster_size
             self.f.seek(cluster_size * n)
             return self.f.read(cluster_size)
         n *= pages_per_cluster
@@ -865,12 +1119,19 @@ class ps2mc(object):
     def write_cluster(self, n, buf):
         pages_per_cluster = self.pages_per_cluster
         cluster_size = self.cluster_size
+        self.counters["clusters_written"] += 1
+        if self.trace != None:
+            self.trace.record("cluster_write", n)
+        if self.watch != None:
+            self.watch["written"].add(n)
         if self.spare_size == 0:
             self.f.seek(cluster_size * n)
             if len(buf) != cluster_size:
                 raise error("internal error: write_cluster:"
                           " %d != %d" % (len(buf),
                                  cluster_size))
+            self.counters["pages_written"] += pages_per_cluster
+            self.counters["bytes_written"] += cluster_size
             return self.f.write(buf)
         n *= pages_per_cluster
         pgsize = self.page_size
@@ -882,21 +1143,29 @@ class ps2mc(object):
     def _add_fat_cluster_to_cache(self, n, fat, dirty):
         old = self.fat_cache.add(n, [fat, dirty])
         if old != None:
+            self.counters["fat_cache_evictions"] += 1
             (n, [fat, dirty]) = old
             if dirty:
+                self.counters["fat_cache_writebacks"] += 1
                 self.write_cluster(n, pack_fat(fat))
 
     def _read_fat_cluster(self, n):
         v = self.fat_cache.get(n)
+        if self.trace != None:
+            self.trace.record_hit("fat_cache_read", n, v != None)
         if v != None:
             # print "@@@ fat hit", n
+            self.counters["fat_cache_hits"] += 1
             return v[0]
         # print "@@@ fat miss", n
+        self.counters["fat_cache_misses"] += 1
         fat = unpack_fat(self.read_cluster(n))
         self._add_fat_cluster_to_cache(n, fat, False)
         return fat
 
     def _write_fat_cluster(self, n, fat):
+        if self.trace != None:
+            self.trace.record("fat_cache_write", n)
         self._add_fat_cluster_to_cache(n, fat, True)
 
     def flush_fat_cache(self):
@@ -905,36 +1174,102 @@ class ps2mc(object):
         for (n, v) in list(self.fat_cache.items()):
             [fat, dirty] = v
             if dirty:
+                self.counters["fat_cache_writebacks"] += 1
                 self.write_cluster(n, pack_fat(fat))
                 v[1] = False
 
     def _add_alloc_cluster_to_cache(self, n, buf, dirty):
         old = self.alloc_cluster_cache.add(n, [buf, dirty])
         if old != None:
+            self.counters["cluster_cache_evictions"] += 1
             (n, [buf, dirty]) = old
             if dirty:
+                self.counters["cluster_cache_writebacks"] += 1
                 n += self.allocatable_cluster_offset
                 self.write_cluster(n, buf)
         
     def read_allocatable_cluster(self, n):
         a = self.alloc_cluster_cache.get(n)
+        if self.trace != None:
+            self.trace.record_hit("cluster_cache_read", n, a != None)
         if a != None:
             # print "@@@ cache hit", n
+            self.counters["cluster_cache_hits"] += 1
             return a[0]
         # print "@@@ cache miss", n
+        self.counters["cluster_cache_misses"] += 1
         buf = self.read_cluster(n + self.allocatable_cluster_offset)
         self._add_alloc_cluster_to_cache(n, buf, False)
         return buf
         
     def write_allocatable_cluster(self, n, buf):
+        if self.pending_changes != None:
+            self.pending_changes["cluster_written"].add(n)
+        if self.trace != None:
+            self.trace.record("cluster_cache_write", n)
         self._add_alloc_cluster_to_cache(n, buf, True)
 
+    def write_allocatable_clusters(self, n, buf):
+        """Write a run of consecutive allocatable clusters starting at n.
+
+        The clusters are written to the image directly with a single
+        write, rather than one page at a time through the cache."""
+
+        cluster_size = self.cluster_size
+        count = len(buf) // cluster_size
+        if count * cluster_size != len(buf):
+            raise error("internal error: write_allocatable_clusters:"
+                      " %d %% %d != 0" % (len(buf), cluster_size))
+        if self.pending_changes != None:
+            self.pending_changes["cluster_written"].update(
+                range(n, n + count))
+        cache = self.alloc_cluster_cache
+        for i in range(count):
+            a = cache.get(n + i)
+            if a != None:
+                a[0] = buf[i * cluster_size : (i + 1) * cluster_size]
+                a[1] = False
+
+        self.modified = True
+        page_size = self.page_size
+        page = ((n + self.allocatable_cluster_offset)
+            * self.pages_per_cluster)
+        pages = count * self.pages_per_cluster
+        counters = self.counters
+        counters["clusters_written"] += count
+        counters["pages_written"] += pages
+        counters["bytes_written"] += pages * self.raw_page_size
+        if self.trace != None:
+            for i in range(count):
+                self.trace.record("cluster_write",
+                          n + i + self.allocatable_cluster_offset)
+        if self.watch != None:
+            offset = self.allocatable_cluster_offset
+            self.watch["written"].update(range(n + offset,
+                               n + offset + count))
+        self.f.seek(page * self.raw_page_size)
+        if self.spare_size == 0:
+            self.f.write(buf)
+            return
+        pad = None
+        out = []
+        for off in range(0, len(buf), page_size):
+            data = buf[off : off + page_size]
+            out.append(data)
+            ecc = b"".join([bytes(s) for s in ecc_calculate_page(data)])
+            if pad == None:
+                pad = b"\0" * (self.spare_size - len(ecc))
+            out.append(ecc)
+            out.append(pad)
+        self.f.write(b"".join(out))
+
     def flush_alloc_cluster_cache(self):
         if self.alloc_cluster_cache == None:
             return
         for (n, a) in list(self.alloc_cluster_cache.items()):
             [buf, dirty] = a
             if dirty:
+                self.counters["cluster_cache_writebacks"] += 1
                 n += self.allocatable_cluster_offset
                 self.write_cluster(n, buf)
                 a[1] = False
@@ -957,11 +1292,58 @@ class ps2mc(object):
         (fat, cluster) = self.read_fat_cluster(fat_cluster)
         return (fat, offset, cluster)
 
+    def read_fat_table(self):
+        """Return a copy of the whole FAT as an array.
+
+        The FAT clusters that aren't already cached are read directly,
+        without going through the FAT cache."""
+
+        epc = self.entries_per_cluster
+        end = self.allocatable_cluster_end
+        table = array.array('I')
+        for i in range(div_round_up(end, epc)):
+            indirect_cluster = self.indirect_fat_cluster_list[i // epc]
+            cluster = self._read_fat_cluster(indirect_cluster)[i % epc]
+            v = self.fat_cache.get(cluster)
+            if v != None:
+                table.extend(v[0])
+            else:
+                table.extend(unpack_fat(self.read_cluster(cluster)))
+        del table[end:]
+        return table
+
+    def write_fat_table(self, table):
+        """Replace the whole FAT with the entries of table.
+
+        The table must have an entry for every allocatable cluster,
+        as returned by read_fat_table().  The FAT clusters are written
+        through the FAT cache."""
+
+        epc = self.entries_per_cluster
+        end = self.allocatable_cluster_end
+        if len(table) != end:
+            raise error("internal error: write_fat_table:"
+                      " %d != %d" % (len(table), end))
+        for i in range(div_round_up(end, epc)):
+            (fat, cluster) = self.read_fat_cluster(i)
+            n = min(epc, end - i * epc)
+            fat[:n] = table[i * epc : i * epc + n]
+            self._write_fat_cluster(cluster, fat)
+        if self.pending_changes != None:
+            self.pending_changes["fat_changed"].update(range(end))
+        self.fat_cursor = 0
+
     def lookup_fat(self, n):
+        if self.trace != None:
+            self.trace.record("fat_lookup", n)
         (fat, offset, cluster) = self.read_fat(n)
         return fat[offset]
 
     def set_fat(self, n, value):
+        if self.trace != None:
+            self.trace.record("fat_set", n)
+        if self.pending_changes != None:
+            self.pending_changes["fat_changed"].add(n)
         (fat, offset, cluster) = self.read_fat(n)
         fat[offset] = value
         self._write_fat_cluster(cluster, fat)
@@ -986,10 +1368,46 @@ class ps2mc(object):
                 self._write_fat_cluster(cluster, fat)
                 ret = self.fat_cursor * epc + offset
                 # print "@@@ allocated", ret
+                self.counters["clusters_allocated"] += 1
+                self._notify("fat_changed", ret)
                 return ret
             self.fat_cursor += 1
         return None
     
+    def allocate_clusters(self, count):
+        """Allocate count clusters and link them into a chain.
+
+        Returns the list of clusters in chain order, or None if there
+        aren't enough free clusters, in which case none are left
+        allocated."""
+
+        clusters = []
+        for i in range(count):
+            n = self.allocate_cluster()
+            if n == None:
+                self.free_clusters(clusters)
+                return None
+            clusters.append(n)
+        self.link_clusters(clusters)
+        return clusters
+
+    def link_clusters(self, clusters):
+        """Link allocated clusters into a chain, in the order given."""
+
+        for i in range(len(clusters) - 1):
+            self.set_fat(clusters[i],
+                     clusters[i + 1] | PS2MC_FAT_ALLOCATED_BIT)
+
+    def free_clusters(self, clusters):
+        """Free clusters allocated by allocate_cluster()."""
+
+        epc = self.entries_per_cluster
+        for n in clusters:
+            self.set_fat(n, PS2MC_FAT_CHAIN_END_UNALLOC)
+            self.counters["clusters_freed"] += 1
+            if n // epc < self.fat_cursor:
+                self.fat_cursor = n // epc
+
     def fat_chain(self, first_cluster):
         return fat_chain(self.lookup_fat, first_cluster)
 
@@ -1106,6 +1524,7 @@ class ps2mc(object):
         if changed:
             dir.write_raw_ent(dirloc[1], ent,
                       (modified and not is_dir))
+            self._notify("dirent_modified", dirloc)
 
         
         if notify:
@@ -1200,6 +1619,7 @@ class ps2mc(object):
         ent[8] = name[:32].encode("ascii")
         dir.write_raw_ent(i, ent, True)
         dir.close()
+        self._notify("dirent_created", dirloc)
 
         if mode & DF_FILE:
             # print "@@@ ret", dirloc, ent
@@ -1248,6 +1668,8 @@ class ps2mc(object):
         else:
             ent[0] &= ~DF_EXISTS
         self.update_dirent_all(dirloc, None, ent)
+        if not truncate:
+            self._notify("dirent_deleted", dirloc)
         
         while cluster != PS2MC_FAT_CHAIN_END:
             if cluster // epc < self.fat_cursor:
@@ -1258,6 +1680,7 @@ class ps2mc(object):
                 break
             next_cluster &= ~PS2MC_FAT_ALLOCATED_BIT
             self.set_fat(cluster, next_cluster)
+            self.counters["clusters_freed"] += 1
             if next_cluster == PS2MC_FAT_CHAIN_END_UNALLOC:
                 break
             cluster = next_cluster
@@ -1461,9 +1884,41 @@ class ps2mc(object):
             dir[dirloc[1]] = new_ent
         finally:
             dir.close()
+        self._notify("dirent_modified", dirloc)
         self.flush()
         return ent
 
+    def rename(self, filename, newname):
+        """Rename a file or directory, leaving it in the same directory."""
+
+        if (newname in ["", ".", ".."] or "/" in newname
+            or len(newname.encode("ascii")) > 32):
+            raise io_error(EINVAL, "invalid name", newname)
+        (dirloc, ent, is_dir) = self.path_search(filename)
+        if dirloc == None:
+            raise path_not_found(filename)
+        if ent == None:
+            raise file_not_found(filename)
+        if dirloc == (0, 0):
+            raise io_error(EACCES, "can't rename root directory",
+                       filename)
+        parent = filename.rstrip("/").rsplit("/", 1)
+        if len(parent) == 1:
+            newpath = newname
+        else:
+            newpath = parent[0] + "/" + newname
+        if self.path_search(newpath)[1] != None:
+            raise io_error(EEXIST, "file exists", newpath)
+        dir = self._opendir_parent_dirloc(dirloc, "r+b")
+        try:
+            ent = dir[dirloc[1]]
+            ent[8] = newname.encode("ascii")
+            dir.write_raw_ent(dirloc[1], ent, False)
+        finally:
+            dir.close()
+        self._notify("dirent_modified", dirloc)
+        self.flush()
+
     def import_save_file(self, sf, ignore_existing, dirname = None):
         """Copy the contents a ps2_save_file object to a directory.
 
@@ -1588,6 +2043,171 @@ class ps2mc(object):
             sf.set_file(i, ent, data)
         return sf
 
+    def _read_chain(self, table, first_cluster, length):
+        """Read length bytes from a cluster chain, reading the
+        clusters directly from the image rather than through the
+        cache."""
+
+        offset = self.allocatable_cluster_offset
+        data = []
+        cluster = first_cluster
+        need = length
+        while need > 0:
+            if (cluster >= len(table)
+                or not table[cluster] & PS2MC_FAT_ALLOCATED_BIT):
+                raise corrupt("file length doesn't match cluster"
+                        " chain length", self.f)
+            buf = self.read_cluster(cluster + offset)
+            data.append(buf[:need])
+            need -= len(buf)
+            cluster = table[cluster] & PS2MC_FAT_CLUSTER_MASK
+        return b"".join(data)
+
+    def _write_chain(self, data):
+        """Allocate a chain of clusters and write data to it.
+
+        Returns the first cluster of the chain."""
+
+        count = div_round_up(len(data), self.cluster_size)
+        if count == 0:
+            return PS2MC_FAT_CHAIN_END
+        clusters = self.allocate_clusters(count)
+        if clusters == None:
+            raise io_error(ENOSPC, "out of space on image")
+        self.write_chain(clusters, data)
+        return clusters[0]
+
+    def write_chain(self, clusters, data):
+        """Write data to a chain of allocated clusters, padding the last
+        one with zeros.  Each run of consecutive clusters is written
+        with a single write."""
+
+        cluster_size = self.cluster_size
+        count = len(clusters)
+        data += b"\0" * (count * cluster_size - len(data))
+        start = 0
+        for i in range(1, count + 1):
+            if i == count or clusters[i] != clusters[i - 1] + 1:
+                self.write_allocatable_clusters(
+                    clusters[start],
+                    data[start * cluster_size : i * cluster_size])
+                start = i
+
+    def _copy_save(self, other, table, dirname, ignore_existing,
+               new_dirname):
+        (dir_dirloc, dirent, is_dir) = self.path_search(dirname)
+        if dir_dirloc is None:
+            raise path_not_found(dirname)
+        if dirent is None:
+            raise dir_not_found(dirname)
+        if not is_dir:
+            raise io_error(ENOTDIR, "not a directory", dirname)
+        if dir_dirloc == (0, 0):
+            raise io_error(EACCES, "can't copy root directory", dirname)
+        files = []
+        for ent in self._read_dir_entries(table, dirent[4],
+                          dirent[2])[2:]:
+            if not mode_is_file(ent[0]):
+                if ent[0] & DF_EXISTS:
+                    sys.stderr.write("warning: %s/%s is not a file,"
+                             " ignored.\n"
+                             % (dirent[8].decode("ascii"),
+                                ent[8].decode("ascii")))
+                continue
+            files.append(ent)
+
+        if new_dirname == None:
+            new_dirname = "/" + dirent[8].decode("ascii")
+        new_dirname = new_dirname.rstrip("/")
+        name = new_dirname.split("/")[-1]
+        if name == "":
+            raise path_not_found(new_dirname)
+        (root_dirloc, ent, is_dir) = other.path_search(new_dirname)
+        if root_dirloc == None:
+            raise path_not_found(new_dirname)
+        if ent != None:
+            if ignore_existing:
+                return False
+            raise io_error(EEXIST, "directory exists", new_dirname)
+
+        # Check for space first, so a save that doesn't fit is
+        # rejected before anything is written.
+        cluster_size = other.cluster_size
+        need = div_round_up((len(files) + 2) * PS2MC_DIRENT_LENGTH,
+                    cluster_size)
+        for ent in files:
+            need += div_round_up(ent[2], cluster_size)
+        if need * cluster_size > other.get_free_space():
+            raise io_error(ENOSPC, "out of space on image", new_dirname)
+
+        mode = DF_DIR | (dirent[0] & ~DF_FILE)
+        (new_dirloc, ent) = other.create_dir_entry(root_dirloc, name,
+                               mode)
+        try:
+            for ent in files:
+                data = self._read_chain(table, ent[4], ent[2])
+                mode = DF_FILE | (ent[0] & ~DF_DIR)
+                (dirloc, new_ent) = other.create_dir_entry(
+                    new_dirloc, ent[8].decode("ascii"), mode)
+                first = other._write_chain(data)
+                other.update_dirent(dirloc, None, first, ent[2],
+                            False)
+        except EnvironmentError:
+            try:
+                other.rmdir(new_dirname)
+            except EnvironmentError:
+                pass
+            raise
+
+        # set modes and timestamps to those of the original
+        dir = other._opendir_dirloc(new_dirloc, "r+b")
+        try:
+            for (i, ent) in enumerate(files):
+                dir[i + 2] = ent
+        finally:
+            dir.close()
+        dir = other._opendir_dirloc(root_dirloc, "r+b")
+        try:
+            dir[new_dirloc[1]] = dirent
+        finally:
+            dir.close()
+        return True
+
+    def copy_save_to(self, other, dirname, ignore_existing = False,
+             new_dirname = None):
+        """Copy a save directory to another memory card.
+
+        The files are copied directly from this card's clusters to
+        newly allocated clusters on other, an open ps2mc object,
+        keeping their modes and timestamps, without going through a
+        save file.  ignore_existing and new_dirname work as the
+        ignore_existing and dirname arguments of import_save_file()."""
+
+        return self.copy_saves_to(other, [dirname], ignore_existing,
+                      new_dirname) != []
+
+    def copy_saves_to(self, other, dirnames, ignore_existing = False,
+              new_dirname = None):
+        """Copy several save directories to another memory card.
+
+        Works like copy_save_to(), but reads the FAT once and only
+        flushes the other card once at the end.  Returns the list of
+        directories copied."""
+
+        if new_dirname != None and len(dirnames) > 1:
+            raise error("can only copy a single save to a new name")
+        self.flush()
+        table = self.read_fat_table()
+        copied = []
+        try:
+            for dirname in dirnames:
+                if self._copy_save(other, table, dirname,
+                           ignore_existing, new_dirname):
+                    copied.append(dirname)
+        finally:
+            other.flush()
+        return copied
+
     def _remove_dir(self, dirloc, ent, dirname):
         """Recurse over a directory tree to remove it.
         If not "", dirname must end with a slash (/)."""
@@ -1633,29 +2253,29 @@ class ps2mc(object):
 
     def get_free_space(self):
         """Returns the amount of free space in bytes."""
-        
-        free = 0
-        for i in range(self.allocatable_cluster_end):
-            if (self.lookup_fat(i) & PS2MC_FAT_ALLOCATED_BIT) == 0:
-                free += 1
-        return free * self.cluster_size
+
+        table = self.read_fat_table()
+        used = sum(a >> 31 for a in table)
+        return (len(table) - used) * self.cluster_size
 
     def get_allocatable_space(self):
         """Returns the total amount of allocatable space in bytes."""
         return self.allocatable_cluster_limit * self.cluster_size
     
-    def _check_file(self, fat, first_cluster, length):
+    def _check_chain(self, table, visited, first_cluster, length):
+        """Follow a chain in the FAT snapshot and mark its clusters."""
+
         cluster = first_cluster
+        n = len(table)
         i = 0
         while cluster != PS2MC_FAT_CHAIN_END:
-            if cluster < 0 or cluster >= len(fat):
+            if cluster < 0 or cluster >= n:
                 return "invalid cluster in chain"
-            if fat[cluster]:
+            if visited[cluster]:
                 return "cross linked chain"
             i += 1
-            # print cluster,
-            fat[cluster] = 1
-            next = self.lookup_fat(cluster)
+            visited[cluster] = 1
+            next = table[cluster]
             if next == PS2MC_FAT_CHAIN_END:
                 break
             if (next & PS2MC_FAT_ALLOCATED_BIT) == 0:
@@ -1668,75 +2288,84 @@ class ps2mc(object):
             return "chain continues after end of file"
         return None
 
-    def _check_dir(self, fat, dirloc, dirname, ent):
-        why = self._check_file(fat, ent[4],
-                       ent[2] * PS2MC_DIRENT_LENGTH)
+    def _read_dir_entries(self, table, first_cluster, length):
+        """Read the entries of a directory with a valid chain."""
+
+        data = []
+        cluster = first_cluster
+        need = length * PS2MC_DIRENT_LENGTH
+        while cluster != PS2MC_FAT_CHAIN_END and need > 0:
+            buf = self.read_allocatable_cluster(cluster)
+            data.append(buf[:need])
+            need -= len(buf)
+            cluster = table[cluster] & ~PS2MC_FAT_ALLOCATED_BIT
+        data = b"".join(data)
+        return [unpack_dirent(data[i : i + PS2MC_DIRENT_LENGTH])
+            for i in range(0, len(data), PS2MC_DIRENT_LENGTH)]
+
+    def _check_dir(self, table, visited, findings, dirloc, dirname, ent):
+        why = self._check_chain(table, visited, ent[4],
+                    ent[2] * PS2MC_DIRENT_LENGTH)
         if why != None:
-            print("bad directory:", dirname + ":", why)
-            return False
-        ret = True
+            findings.append(check_finding("bad directory", dirname, why))
+            return
         first_cluster = ent[4]
-        length = ent[2]
-        dir = self._directory(dirloc, first_cluster, length,
-                      "rb", dirname)
-        dot_ent = dir[0]
-        if dot_ent[8].decode("ascii") != ".":
-            print("bad directory:", dirname + ': missing "." entry')
-            ret = False
-        if (dot_ent[4], dot_ent[5]) != dirloc:
-            print("bad directory:", dirname + ': bad "." entry')
-            ret = False
-        if dir[1][8].decode("ascii") != "..":
-            print("bad directory:", (dirname
-                         + ': missing ".." entry'))
-            ret = False
-        for i in range(2, length):
-            ent = dir[i]
+        entries = self._read_dir_entries(table, first_cluster, ent[2])
+        if len(entries) < 1 or entries[0][8] != b".":
+            findings.append(check_finding("bad directory", dirname,
+                              'missing "." entry'))
+        if len(entries) >= 1 and (entries[0][4], entries[0][5]) != dirloc:
+            findings.append(check_finding("bad directory", dirname,
+                              'bad "." entry'))
+        if len(entries) < 2 or entries[1][8] != b"..":
+            findings.append(check_finding("bad directory", dirname,
+                              'missing ".." entry'))
+        for i in range(2, len(entries)):
+            ent = entries[i]
             mode = ent[0]
             if not (mode & DF_EXISTS):
                 continue
+            name = dirname + ent[8].decode("ascii")
             if mode & DF_DIR:
-                if not self._check_dir(fat, (first_cluster, i),
-                               dirname + ent[8].decode("ascii") + "/", ent):
-                    ret = False
+                self._check_dir(table, visited, findings,
+                        (first_cluster, i), name + "/", ent)
             else:
-                why = self._check_file(fat, ent[4], ent[2])
+                why = self._check_chain(table, visited,
+                            ent[4], ent[2])
                 if why != None:
-                    print("bad file:", (dirname + ent[8].decode("ascii") + ":"), why)
-                    ret = False
-                
-        dir.close()
-        return ret
-        
-    def check(self):
-        """Run a simple file system check.
+                    findings.append(check_finding("bad file",
+                                      name, why))
 
-        Any problems found are reported to stdout."""
-        
-        ret = True
+    def check_findings(self):
+        """Run a simple file system check.
 
-        fat_len = int(str(self.allocatable_cluster_end)) 
-        if not isinstance(fat_len, int):
-            raise error("Memory card image too big to check.")
+        Returns a list of check_finding objects describing the
+        problems found, in the order check() reports them."""
 
-        fat = array.array('B', [0]) * fat_len
+        table = self.read_fat_table()
+        visited = bytearray(len(table))
+        findings = []
 
         cluster = self.read_allocatable_cluster(0)
         ent = unpack_dirent(cluster[:PS2MC_DIRENT_LENGTH])
-        ret = self._check_dir(fat, (0, 0), "/", ent)
-
-        lost_clusters = 0
-        for i in range(self.allocatable_cluster_end):
-            a = self.lookup_fat(i)
-            if (a & PS2MC_FAT_ALLOCATED_BIT) and not fat[i]:
-                print(i, end=' ')
-                lost_clusters += 1
-        if lost_clusters > 0:
-            print()
-            print("found", lost_clusters, "lost clusters")
-            ret = False
-            
-        return ret
+        self._check_dir(table, visited, findings, (0, 0), "/", ent)
+
+        lost = [i for (i, a) in enumerate(table)
+            if (a & PS2MC_FAT_ALLOCATED_BIT) and not visited[i]]
+        if len(lost) > 0:
+            findings.append(check_finding("lost clusters", None,
+                              None, lost))
+        return findings
+
+    def check(self):
+        """Run a simple file system check.
+
+        Any problems found are reported to stdout."""
+
+        findings = self.check_findings()
+        for finding in findings:
+            print(finding)
+        return len(findings) == 0
 
     def _glob(self, dirname, components):
         pattern = components[0]
@@ -1814,12 +2443,374 @@ class ps2mc(object):
             dir.close()
         return length
             
+    def _dirty(self):
+        """Return true if there are changes that haven't been flushed."""
+
+        if self.modified:
+            return True
+        for cache in [self.fat_cache, self.alloc_cluster_cache]:
+            for (n, v) in cache.items():
+                if v[1]:
+                    return True
+        return False
+
+    def _watch_stat(self):
+        try:
+            st = os.fstat(self.f.fileno())
+        except (AttributeError, EnvironmentError, ValueError):
+            # not a real file, so the checksums are always compared
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _raw_cluster_crc(self, n):
+        size = self.pages_per_cluster * self.raw_page_size
+        self.f.seek(n * size)
+        counters = self.counters
+        counters["pages_read"] += self.pages_per_cluster
+        counters["bytes_read"] += size
+        return zlib.crc32(self.f.read(size))
+
+    def _raw_superblock(self):
+        self.f.seek(0)
+        return self.f.read(0x154)
+
+    def _fat_clusters(self):
+        """Map each FAT cluster to the number of its first entry."""
+
+        epc = self.entries_per_cluster
+        clusters = {}
+        for i in range(div_round_up(self.allocatable_cluster_end, epc)):
+            indirect = self.indirect_fat_cluster_list[i // epc]
+            clusters[self._read_fat_cluster(indirect)[i % epc]] = i * epc
+        return clusters
+
+    def _watch_root_length(self):
+        root = unpack_dirent(self.read_cluster(self.allocatable_cluster_offset)
+                     [:PS2MC_DIRENT_LENGTH])
+        return root[2]
+
+    def _watch_read_dir(self, table, first, length, entries, owner,
+                reuse = {}):
+        """Read the entries of one directory directly from the image.
+
+        Each entry is added to entries under its dirloc as its mode,
+        length, first cluster and modification time, and each cluster
+        holding the directory is mapped to first in owner.  reuse
+        maps a cluster and the index of its first entry to entries
+        already known, so the cluster isn't read again.  Returns the
+        directory's clusters and the first cluster, length and dirloc
+        of each of its subdirectories."""
+
+        per_cluster = self.cluster_size // PS2MC_DIRENT_LENGTH
+        offset = self.allocatable_cluster_offset
+        clusters = []
+        subdirs = []
+        cluster = first
+        i = 0
+        while i < length and cluster not in owner:
+            if (cluster >= len(table)
+                or not table[cluster] & PS2MC_FAT_ALLOCATED_BIT):
+                break
+            owner[cluster] = first
+            clusters.append(cluster)
+            end = min(i + per_cluster, length)
+            ents = reuse.get((cluster, i))
+            if ents == None or len(ents) != end - i:
+                buf = self.read_cluster(cluster + offset)
+                ents = []
+                for j in range(i, end):
+                    off = (j - i) * PS2MC_DIRENT_LENGTH
+                    ent = unpack_dirent(buf[off
+                                : off + PS2MC_DIRENT_LENGTH])
+                    ents.append((ent[0], ent[2], ent[4], ent[6]))
+            for (j, ent) in enumerate(ents, i):
+                entries[(first, j)] = ent
+                if j >= 2 and _watch_is_dir(ent[0]):
+                    subdirs.append((ent[2], ent[1], (first, j)))
+            i += per_cluster
+            cluster = table[cluster] & PS2MC_FAT_CLUSTER_MASK
+        return (clusters, subdirs)
+
+    def _watch_dirs(self, table):
+        """Read every directory directly from the image.
+
+        Returns a dictionary mapping the dirloc of every directory
+        entry to its mode, length, first cluster and modification
+        time, a dictionary mapping the first cluster of every
+        directory to the dirloc of its entry and its clusters, and
+        one mapping every directory cluster to the directory's first
+        cluster."""
+
+        entries = {}
+        dirs = {}
+        owner = {}
+        stack = [(0, self._watch_root_length(), None)]
+        while len(stack) > 0:
+            (first, length, dirloc) = stack.pop()
+            (clusters, subdirs) = self._watch_read_dir(table, first, length,
+                                   entries, owner)
+            dirs[first] = (dirloc, clusters)
+            stack.extend(subdirs)
+        return (entries, dirs, owner)
+
+    def _watch_snapshot(self, table, entries, dirs, owner):
+        fat_clusters = self._fat_clusters()
+        ifcs = div_round_up(len(fat_clusters), self.entries_per_cluster)
+        fixed = list(self.indirect_fat_cluster_list[:ifcs])
+        offset = self.allocatable_cluster_offset
+        watched = (fixed + list(fat_clusters)
+               + [n + offset for n in owner])
+        self.watch = {"stat": self._watch_stat(),
+                  "superblock": self._raw_superblock(),
+                  "crc": dict((n, self._raw_cluster_crc(n))
+                      for n in watched),
+                  "fixed": set(fixed),
+                  "fat_clusters": fat_clusters,
+                  "table": table,
+                  "entries": entries,
+                  "dirs": dirs,
+                  "owner": owner,
+                  "written": set()}
+
+    def _watch_start(self):
+        table = self.read_fat_table()
+        (entries, dirs, owner) = self._watch_dirs(table)
+        self._watch_snapshot(table, entries, dirs, owner)
+
+    def _watch_drop_dir(self, first):
+        """Remove a directory and its subdirectories from the snapshot."""
+
+        watch = self.watch
+        entries = watch["entries"]
+        owner = watch["owner"]
+        (dirloc, clusters) = watch["dirs"].pop(first)
+        for cluster in clusters:
+            del owner[cluster]
+        j = 0
+        while (first, j) in entries:
+            ent = entries.pop((first, j))
+            child = watch["dirs"].get(ent[2])
+            if (j >= 2 and _watch_is_dir(ent[0]) and child != None
+                and child[0] == (first, j)):
+                self._watch_drop_dir(ent[2])
+            j += 1
+
+    def _watch_update(self):
+        """Update the snapshot after this object's changes are flushed.
+
+        Only the FAT clusters and directories this object wrote to
+        are read again, so the changes aren't seen as another
+        program's the next time refresh_if_changed() is called."""
+
+        watch = self.watch
+        written = watch["written"]
+        watch["written"] = set()
+        offset = self.allocatable_cluster_offset
+        epc = self.entries_per_cluster
+        per_cluster = self.cluster_size // PS2MC_DIRENT_LENGTH
+        table = watch["table"]
+        fat_clusters = watch["fat_clusters"]
+        for n in written:
+            if n in fat_clusters:
+                first = fat_clusters[n]
+                count = min(epc, len(table) - first)
+                table[first : first + count] = (
+                    self._read_fat_cluster(n)[:count])
+
+        entries = watch["entries"]
+        dirs = watch["dirs"]
+        owner = watch["owner"]
+        old_clusters = set(owner)
+        todo = {}
+        for n in written:
+            first = owner.get(n - offset)
+            if first != None:
+                todo[first] = dirs[first][0]
+        while len(todo) > 0:
+            (first, dirloc) = todo.popitem()
+            if dirloc == None:
+                if offset in written or (0, 0) not in entries:
+                    length = self._watch_root_length()
+                else:
+                    # the length of the root directory is in its
+                    # first entry
+                    length = entries[(0, 0)][1]
+            else:
+                parent = entries.get(dirloc)
+                if (parent == None or parent[2] != first
+                    or not _watch_is_dir(parent[0])):
+                    # the directory has since been deleted
+                    continue
+                length = parent[1]
+            old = {}
+            reuse = {}
+            if first in dirs:
+                clusters = dirs.pop(first)[1]
+                for cluster in clusters:
+                    del owner[cluster]
+                j = 0
+                while (first, j) in entries:
+                    old[j] = entries.pop((first, j))
+                    j += 1
+                # the clusters that weren't written don't need to
+                # be read again
+                for (k, cluster) in enumerate(clusters):
+                    i = k * per_cluster
+                    if cluster + offset not in written:
+                        reuse[(cluster, i)] = [
+                            old[j] for j in range(i, min(i + per_cluster,
+                                         len(old)))]
+            (clusters, subdirs) = self._watch_read_dir(table, first,
+                                   length, entries,
+                                   owner, reuse)
+            dirs[first] = (dirloc, clusters)
+            for (j, ent) in old.items():
+                if (j < 2 or not _watch_is_dir(ent[0])
+                    or ent[2] not in dirs
+                    or dirs[ent[2]][0] != (first, j)):
+                    continue
+                new = entries.get((first, j))
+                if (new == None or not _watch_is_dir(new[0])
+                    or new[2] != ent[2]):
+                    self._watch_drop_dir(ent[2])
+            for (child, child_length, child_dirloc) in subdirs:
+                j = child_dirloc[1]
+                if (old.get(j) != entries[child_dirloc]
+                    or child not in dirs):
+                    todo[child] = child_dirloc
+
+        crc = watch["crc"]
+        new_clusters = set(owner)
+        for n in old_clusters - new_clusters:
+            del crc[n + offset]
+        for n in new_clusters - old_clusters:
+            written.add(n + offset)
+        for n in written:
+            if n in crc or n - offset in new_clusters:
+                crc[n] = self._raw_cluster_crc(n)
+        watch["superblock"] = self._raw_superblock()
+        watch["stat"] = self._watch_stat()
+
+    def _drop_file_clusters(self, table, first_cluster, length):
+        """Drop the clusters of a file from the cache."""
+
+        cluster = first_cluster
+        for i in range(div_round_up(length, self.cluster_size)):
+            if cluster >= len(table):
+                break
+            self.alloc_cluster_cache.remove(cluster)
+            next = table[cluster]
+            if (next == PS2MC_FAT_CHAIN_END
+                or not next & PS2MC_FAT_ALLOCATED_BIT):
+                break
+            cluster = next & PS2MC_FAT_CLUSTER_MASK
+
+    def refresh_if_changed(self):
+        """Pick up changes made to the image by another program.
+
+        The first call starts watching the image and returns False.
+        Later calls check whether the image file's modification time
+        or size has changed, and if so compare checksums of the
+        superblock, FAT and directory clusters with those taken last
+        time.  Only the cached FAT clusters, directories and files
+        affected by the changes are dropped, and the changes are
+        passed to the subscribers as dirent_created, dirent_modified,
+        dirent_deleted and fat_changed events.  Returns True if
+        anything changed.
+
+        Changes made through this object must have been flushed, and
+        no files may be open.  Flushing keeps the checksums up to date,
+        so the object's own changes aren't reported again."""
+
+        if self.watch == None:
+            self._watch_start()
+            return False
+        watch = self.watch
+        stat = self._watch_stat()
+        if stat != None and stat == watch["stat"]:
+            return False
+        if self._dirty() or len(watch["written"]) > 0:
+            raise io_error(EBUSY, "can't refresh with unflushed changes")
+        for (dir, files) in self.open_files.values():
+            if len(files) > 0:
+                raise io_error(EBUSY, "can't refresh with files open")
+
+        changed = set(n for (n, crc) in watch["crc"].items()
+                  if self._raw_cluster_crc(n) != crc)
+        watch["stat"] = stat
+        if len(changed) == 0:
+            return False
+        if (changed & watch["fixed"]
+            or self._raw_superblock() != watch["superblock"]):
+            self.watch = None
+            raise corrupt("Memory card reformatted by another program.",
+                      self.f)
+
+        if self.rootdir != None:
+            self.rootdir.real_close()
+            self.rootdir = None
+        fat_clusters = watch["fat_clusters"]
+        offset = self.allocatable_cluster_offset
+        for n in changed:
+            if n in fat_clusters:
+                self.fat_cache.remove(n)
+            else:
+                self.alloc_cluster_cache.remove(n - offset)
+
+        epc = self.entries_per_cluster
+        old_table = watch["table"]
+        table = self.read_fat_table()
+        for n in changed:
+            if n not in fat_clusters:
+                continue
+            first = fat_clusters[n]
+            for i in range(first, min(first + epc, len(table))):
+                if table[i] != old_table[i]:
+                    self.alloc_cluster_cache.remove(i)
+                    self._notify("fat_changed", i)
+
+        old_entries = watch["entries"]
+        (entries, dirs, owner) = self._watch_dirs(table)
+        for (dirloc, ent) in entries.items():
+            old = old_entries.get(dirloc)
+            if old == ent:
+                continue
+            exists = ent[0] & DF_EXISTS
+            if old == None or not old[0] & DF_EXISTS:
+                if not exists:
+                    continue
+                self._notify("dirent_created", dirloc)
+            elif not exists:
+                self._notify("dirent_deleted", dirloc)
+            else:
+                self._notify("dirent_modified", dirloc)
+            if mode_is_file(ent[0]):
+                self._drop_file_clusters(table, ent[2], ent[1])
+        for (dirloc, old) in old_entries.items():
+            if dirloc not in entries and old[0] & DF_EXISTS:
+                self._notify("dirent_deleted", dirloc)
+
+        self.fat_cursor = 0
+        self._watch_snapshot(table, entries, dirs, owner)
+        if self.pending_changes != None:
+            self._deliver_changes()
+        return True
+
     def flush(self):
+        self.counters["flushes"] += 1
+        if self.trace != None:
+            self.trace.flush()
+        modified = self.modified
         self.flush_alloc_cluster_cache()
         self.flush_fat_cache()
         if self.modified:
             self.write_superblock()
         self.f.flush()
+        if (self.watch != None
+            and (modified or len(self.watch["written"]) > 0)):
+            self._watch_update()
+        if self.pending_changes != None:
+            self._deliver_changes()
         
     def close(self):
         """Close all open files.
@@ -1854,6 +2845,8 @@ class ps2mc(object):
                 self.flush()
         finally:
             self.open_files = None
+            self.subscribers = None
+            self.pending_changes = None
             self.fat_cache = None
             self.f = None
             self.rootdir = None
@@ -111,13 +111,11 @@ def _ecc_check(s, ecc):
     #                    lp_comp, cp_comp)
 
     if lp_comp == 0x7F and cp_comp == 0x07:
-        print("corrected 1")
         # correctable 1 bit error in data
         s[lp1_diff] ^= 1 << (cp_diff >> 4)
         return ECC_CHECK_CORRECTED
     if ((cp_diff == 0 and lp0_diff == 0 and lp1_diff == 0)
             or _popcount(lp_comp) + _popcount(cp_comp) == 1):
-        print("corrected 2")
         # correctable 1 bit error in ECC
         # (and/or one of the unused bits was set)
         ecc[0] = computed[0]
@@ -0,0 +1,282 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Operations on memory card images as a whole, below the file system."""
+
+import array
+import struct
+from errno import ENOSPC
+
+from . import ps2mc
+from .round import div_round_up
+from .ps2mc_ecc import *
+from .ps2mc_dir import DF_EXISTS, DF_DIR, PS2MC_DIRENT_LENGTH
+
+# the number of pages read and written at a time
+CHUNK_PAGES = 512
+
+# the mode, length and first cluster fields of a directory entry
+_dirent_head = struct.Struct("<HHL8sL")
+_DIRENT_CLUSTER = 16
+
+def _spare(page, spare_size, ecc_cache):
+    """Return the spare area for a page, as write_page() would write it."""
+
+    spare = ecc_cache.get(page)
+    if spare != None:
+        return spare
+    spare = b"".join([bytes(s) for s in ecc_calculate_page(page)])
+    spare += b"\0" * (spare_size - len(spare))
+    if len(ecc_cache) < 4096:
+        ecc_cache[page] = spare
+    return spare
+
+def _remove_ecc(raw, page_size, spare_size, ecc_cache, stats):
+    """Strip the spare areas from a run of pages, correcting any
+    errors the ECC can correct."""
+
+    raw_page_size = page_size + spare_size
+    erased_spare = b"\xFF" * spare_size
+    buf = []
+    for offset in range(0, len(raw), raw_page_size):
+        page = raw[offset : offset + page_size]
+        spare = raw[offset + page_size : offset + raw_page_size]
+        if (spare != erased_spare
+            and spare != _spare(page, spare_size, ecc_cache)):
+            (status, page, spare) = ecc_check_page(page, spare)
+            if status == ECC_CHECK_CORRECTED:
+                stats["corrected"] += 1
+            elif status == ECC_CHECK_FAILED:
+                stats["failed"] += 1
+        buf.append(page)
+    return b"".join(buf)
+
+def _add_ecc(raw, page_size, spare_size, pages_per_erase_block,
+         ecc_cache):
+    """Add spare areas to a run of whole erase blocks."""
+
+    block_size = page_size * pages_per_erase_block
+    erased_block = b"\xFF" * block_size
+    erased_spare = b"\xFF" * spare_size
+    buf = []
+    for block in range(0, len(raw), block_size):
+        erased = raw[block : block + block_size] == erased_block
+        for offset in range(block, min(block + block_size, len(raw)),
+                    page_size):
+            page = raw[offset : offset + page_size]
+            buf.append(page)
+            if erased:
+                buf.append(erased_spare)
+            else:
+                buf.append(_spare(page, spare_size, ecc_cache))
+    return b"".join(buf)
+
+def convert_ecc(mc, out, with_ecc = None):
+    """Copy the image of a ps2mc object to the file out, adding or
+    removing the ECC spare areas.
+
+    By default the ECC is added if the image doesn't have it and
+    removed if it does.  The pages are copied in order without going
+    through the file system, so the layout of the new image is the same.
+    When removing ECC, errors the ECC can correct are corrected.  When
+    adding it, the pages of erase blocks that are entirely 0xFF are
+    given 0xFF spare areas, as they would have on an erased block.
+
+    Returns a dictionary with the number of pages copied, the number
+    corrected and the number with uncorrectable errors, which are
+    copied unchanged."""
+
+    if with_ecc == None:
+        with_ecc = mc.spare_size == 0
+    mc.flush()
+
+    page_size = mc.page_size
+    # ps2mc sets spare_size to 0 when the image has no ECC
+    spare_size = mc.spare_size
+    raw_page_size = page_size + spare_size
+    out_spare_size = 0
+    if with_ecc:
+        out_spare_size = div_round_up(page_size, 128) * 4
+    pages = mc.clusters_per_card * mc.pages_per_cluster
+    ppeb = mc.pages_per_erase_block
+    chunk_pages = max(CHUNK_PAGES // ppeb, 1) * ppeb
+    ecc_cache = {}
+    stats = {"pages": 0, "corrected": 0, "failed": 0}
+
+    f = mc.f
+    f.seek(0)
+    for first in range(0, pages, chunk_pages):
+        count = min(chunk_pages, pages - first)
+        raw = f.read(count * raw_page_size)
+        if len(raw) != count * raw_page_size:
+            raise EOFError("memory card image is truncated"
+                       " (page %05X)" % (first + len(raw)
+                             // raw_page_size))
+        if spare_size == out_spare_size:
+            out.write(raw)
+        elif spare_size != 0:
+            out.write(_remove_ecc(raw, page_size, spare_size,
+                          ecc_cache, stats))
+        else:
+            out.write(_add_ecc(raw, page_size, out_spare_size, ppeb,
+                       ecc_cache))
+        stats["pages"] += count
+    out.flush()
+    return stats
+
+def _read_clusters(mc, n, count, ecc_cache, stats):
+    """Read a run of allocatable clusters directly from the image,
+    correcting any errors the ECC can correct."""
+
+    raw_size = count * mc.pages_per_cluster * mc.raw_page_size
+    f = mc.f
+    f.seek((n + mc.allocatable_cluster_offset) * mc.pages_per_cluster
+           * mc.raw_page_size)
+    raw = f.read(raw_size)
+    if len(raw) != raw_size:
+        raise ps2mc.corrupt("attempted to read past EOF"
+                    " (cluster %d)" % n, f)
+    if mc.spare_size == 0:
+        return raw
+    return _remove_ecc(raw, mc.page_size, mc.spare_size, ecc_cache,
+               stats)
+
+def _dir_entries(mc, table):
+    """Find the directory entries that refer to clusters.
+
+    Returns a dictionary mapping each cluster holding part of a
+    directory to the offsets of the entries in it that exist."""
+
+    per_cluster = mc.cluster_size // PS2MC_DIRENT_LENGTH
+    root = mc.read_allocatable_cluster(0)
+    entries = {}
+    stack = [(0, _dirent_head.unpack_from(root)[2])]
+    while len(stack) > 0:
+        (cluster, length) = stack.pop()
+        i = 0
+        while i < length and cluster not in entries:
+            if (cluster >= len(table)
+                or not table[cluster] & ps2mc.PS2MC_FAT_ALLOCATED_BIT):
+                # a damaged directory, leave the rest of it alone
+                break
+            buf = mc.read_allocatable_cluster(cluster)
+            offsets = entries[cluster] = []
+            for j in range(min(per_cluster, length - i)):
+                off = j * PS2MC_DIRENT_LENGTH
+                (mode, _, n, _, first) = _dirent_head.unpack_from(buf,
+                                          off)
+                if not mode & DF_EXISTS:
+                    continue
+                offsets.append(off)
+                if i + j >= 2 and mode & DF_DIR:
+                    stack.append((first, n))
+            i += per_cluster
+            cluster = table[cluster] & ps2mc.PS2MC_FAT_CLUSTER_MASK
+    return entries
+
+def _cluster_runs(clusters, relocated, limit):
+    """Group clusters into (source, destination, count) runs that are
+    consecutive both before and after relocation."""
+
+    runs = []
+    for n in clusters:
+        m = relocated.get(n, n)
+        if len(runs) > 0:
+            (src, dst, count) = runs[-1]
+            if src + count == n and dst + count == m and count < limit:
+                runs[-1] = (src, dst, count + 1)
+                continue
+        runs.append((n, m, 1))
+    return runs
+
+def clone(mc, f, with_ecc = None, clusters_per_card = None):
+    """Copy the file system of a ps2mc object to a new image in f.
+
+    The new image is formatted with the same page and erase block
+    sizes, with ECC if with_ecc is true (by default if the image has
+    it) and with clusters_per_card clusters (by default the same
+    number).  The clusters in use and the FAT are then copied
+    directly, without going through the directories and files.
+    Clusters only move if they are past the end of a smaller card, in
+    which case they're moved to the first free clusters and the
+    directory entries that refer to them are updated.
+
+    Returns a dictionary with the number of clusters copied, the
+    number of pages corrected and the number with uncorrectable
+    errors (as for convert_ecc()), and the relocated clusters as a
+    dictionary mapping old cluster numbers to new ones."""
+
+    if with_ecc == None:
+        with_ecc = mc.spare_size != 0
+    if clusters_per_card == None:
+        clusters_per_card = mc.clusters_per_card
+    mc.flush()
+    table = mc.read_fat_table()
+    allocated = ps2mc.PS2MC_FAT_ALLOCATED_BIT
+    used = [n for n in range(len(table)) if table[n] & allocated]
+
+    params = (with_ecc, mc.page_size, mc.pages_per_erase_block,
+          clusters_per_card * mc.pages_per_cluster)
+    new = ps2mc.ps2mc(f, True, params)
+    try:
+        end = new.allocatable_cluster_end
+        relocated = {}
+        if len(used) > 0 and used[-1] >= end:
+            if len(used) > end:
+                raise ps2mc.io_error(ENOSPC, "the new card is too small"
+                             " (%d clusters in use, %d available)"
+                             % (len(used), end))
+            in_use = set(used)
+            free = (n for n in range(end) if n not in in_use)
+            for n in used:
+                if n >= end:
+                    relocated[n] = next(free)
+
+        new_table = array.array('I', [ps2mc.PS2MC_FAT_CLUSTER_MASK]) * end
+        for n in used:
+            v = table[n]
+            if v != ps2mc.PS2MC_FAT_CHAIN_END:
+                v &= ps2mc.PS2MC_FAT_CLUSTER_MASK
+                v = relocated.get(v, v) | allocated
+            new_table[relocated.get(n, n)] = v
+
+        entries = {}
+        if len(relocated) > 0:
+            entries = _dir_entries(mc, table)
+        cluster_size = mc.cluster_size
+        limit = max(CHUNK_PAGES // mc.pages_per_cluster, 1)
+        ecc_cache = {}
+        stats = {"clusters": len(used), "corrected": 0, "failed": 0,
+             "relocated": relocated}
+        for (src, dst, count) in _cluster_runs(used, relocated, limit):
+            buf = _read_clusters(mc, src, count, ecc_cache, stats)
+            if len(entries) > 0:
+                buf = bytearray(buf)
+                for i in range(count):
+                    for off in entries.get(src + i, []):
+                        off += i * cluster_size + _DIRENT_CLUSTER
+                        (first,) = struct.unpack_from("<L", buf, off)
+                        if first in relocated:
+                            struct.pack_into("<L", buf, off,
+                                     relocated[first])
+                buf = bytes(buf)
+            new.write_allocatable_clusters(dst, buf)
+        new.write_fat_table(new_table)
+        new.flush()
+    finally:
+        new.close()
+    return stats
@@ -0,0 +1,302 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Scan the ECC of every page of a memory card image.
+
+The image is split into runs of erase blocks that are checked in
+parallel by a pool of processes, each reading the image through its
+own read-only mmap.  Every 128 byte chunk of every page is classified
+as OK, corrected (a single bit error in the data or the ECC),
+uncorrectable, or erased (the page and its spare area are all 0xFF,
+as left by erasing a block), and the counts are collected per erase
+block.
+
+Scrubbing rewrites the pages with correctable errors found by a scan
+with the corrections applied, so they don't have to be corrected again
+on every read and a second bit error can't make them uncorrectable."""
+
+import os
+import mmap
+import array
+
+from .round import div_round_up
+from .ps2mc_ecc import *
+
+# the order of the counts in each erase block's statistics
+COUNTS = ["ok", "corrected", "failed", "erased"]
+
+_OK = 0
+_CORRECTED = 1
+_FAILED = 2
+_ERASED = 3
+
+class scan_geometry(object):
+    """The layout of the pages of an image."""
+
+    def __init__(self, page_size, spare_size, pages_per_erase_block,
+             pages):
+        self.page_size = page_size
+        self.spare_size = spare_size
+        self.pages_per_erase_block = pages_per_erase_block
+        self.pages = pages
+        self.raw_page_size = page_size + spare_size
+        self.erase_blocks = div_round_up(pages, pages_per_erase_block)
+
+def _check_chunk(chunk, ecc):
+    """Classify one 128 byte chunk."""
+
+    if bytes(ecc_calculate(chunk)) == ecc:
+        return _OK
+    a = array.array('B')
+    a.frombytes(chunk)
+    return [_OK, _CORRECTED, _FAILED][ecc_check(a, list(ecc))]
+
+def _scan_blocks(args):
+    """Scan the erase blocks from first to end.
+
+    Returns a list of (block, counts, corrected pages, failed pages)
+    tuples, one per erase block."""
+
+    (path, geometry, first, end) = args
+    page_size = geometry.page_size
+    raw_page_size = geometry.raw_page_size
+    chunks = div_round_up(page_size, 128)
+    erased = b"\xFF" * raw_page_size
+    ppeb = geometry.pages_per_erase_block
+
+    results = []
+    with open(path, "rb") as f:
+        m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            for block in range(first, end):
+                counts = [0, 0, 0, 0]
+                corrected = []
+                failed = []
+                start = block * ppeb
+                for n in range(start, min(start + ppeb, geometry.pages)):
+                    offset = n * raw_page_size
+                    raw = m[offset : offset + raw_page_size]
+                    if len(raw) != raw_page_size:
+                        # truncated image
+                        counts[_FAILED] += chunks
+                        failed.append(n)
+                        continue
+                    if raw == erased:
+                        counts[_ERASED] += chunks
+                        continue
+                    worst = _OK
+                    for i in range(chunks):
+                        r = _check_chunk(raw[i * 128 : i * 128 + 128],
+                                 raw[page_size + i * 3
+                                     : page_size + i * 3 + 3])
+                        counts[r] += 1
+                        worst = max(worst, r)
+                    if worst == _CORRECTED:
+                        corrected.append(n)
+                    elif worst == _FAILED:
+                        failed.append(n)
+                results.append((block, counts, corrected, failed))
+        finally:
+            m.close()
+    return results
+
+def _split(erase_blocks, jobs):
+    """Split the erase blocks into runs, a few for each process."""
+
+    runs = max(1, min(erase_blocks, jobs * 4))
+    size = div_round_up(erase_blocks, runs)
+    return [(first, min(first + size, erase_blocks))
+        for first in range(0, erase_blocks, size)]
+
+def scan_file(path, geometry, jobs = None):
+    """Scan the image in the file path and return a report.
+
+    jobs is the number of processes to use, by default one per CPU."""
+
+    if geometry.spare_size == 0:
+        raise ValueError("the image has no ECC data")
+    if jobs == None:
+        jobs = os.cpu_count() or 1
+    if jobs > 1:
+        import multiprocessing
+        if multiprocessing.current_process().daemon:
+            # the workers of a pool, like those of the fleet runner,
+            # can't start processes of their own
+            jobs = 1
+    runs = [(path, geometry, first, end)
+        for (first, end) in _split(geometry.erase_blocks, jobs)]
+    if jobs == 1 or len(runs) == 1:
+        results = list(map(_scan_blocks, runs))
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(runs)))
+        try:
+            results = pool.map(_scan_blocks, runs)
+        finally:
+            pool.close()
+            pool.join()
+    blocks = [r for run in results for r in run]
+    return make_report(path, geometry, blocks, jobs)
+
+def scan(mc, jobs = None):
+    """Scan the image of an open ps2mc object."""
+
+    geometry = scan_geometry(mc.page_size, mc.spare_size,
+                 mc.pages_per_erase_block,
+                 mc.clusters_per_card * mc.pages_per_cluster)
+    return scan_file(mc.f.name, geometry, jobs)
+
+def make_report(path, geometry, blocks, jobs):
+    totals = [0, 0, 0, 0]
+    corrected = []
+    failed = []
+    block_stats = []
+    for (block, counts, c, f) in blocks:
+        for i in range(len(totals)):
+            totals[i] += counts[i]
+        corrected += c
+        failed += f
+        stats = dict(zip(COUNTS, counts))
+        stats["block"] = block
+        block_stats.append(stats)
+
+    if totals[_FAILED]:
+        health = "bad"
+    elif totals[_CORRECTED]:
+        health = "degraded"
+    else:
+        health = "good"
+    return {"image": path,
+        "pages": geometry.pages,
+        "page_size": geometry.page_size,
+        "pages_per_erase_block": geometry.pages_per_erase_block,
+        "erase_blocks": geometry.erase_blocks,
+        "jobs": jobs,
+        "health": health,
+        "chunks": dict(zip(COUNTS, totals)),
+        "corrected_pages": corrected,
+        "failed_pages": failed,
+        "blocks": block_stats}
+
+def write_report(out, report, all_blocks = False):
+    """Write a report in human readable form."""
+
+    chunks = report["chunks"]
+    out.write("Scanned %d pages in %d erase blocks.\n"
+          % (report["pages"], report["erase_blocks"]))
+    out.write("chunks: %d ok, %d corrected, %d uncorrectable, %d erased\n"
+          % (chunks["ok"], chunks["corrected"], chunks["failed"],
+             chunks["erased"]))
+    for (name, key) in [("corrected pages", "corrected_pages"),
+                ("uncorrectable pages", "failed_pages")]:
+        pages = report[key]
+        if pages:
+            out.write("%s: %s\n" % (name, " ".join("%05x" % n
+                                 for n in pages)))
+    blocks = [b for b in report["blocks"]
+          if all_blocks or b["corrected"] or b["failed"]]
+    if blocks:
+        out.write("%6s %6s %10s %14s %7s\n"
+              % ("block", "ok", "corrected", "uncorrectable",
+                 "erased"))
+        for b in blocks:
+            out.write("%6d %6d %10d %14d %7d\n"
+                  % (b["block"], b["ok"], b["corrected"],
+                     b["failed"], b["erased"]))
+    out.write("health: %s\n" % report["health"])
+
+def _runs(pages):
+    """Group sorted page numbers into runs of consecutive pages."""
+
+    runs = []
+    for n in pages:
+        if runs and runs[-1][-1] == n - 1:
+            runs[-1].append(n)
+        else:
+            runs.append([n])
+    return runs
+
+def scrub_file(path, geometry, pages, dry_run = False):
+    """Rewrite the given pages with their ECC corrections applied.
+
+    Runs of consecutive pages are corrected and written back together,
+    in one pass from the start of the image to the end.  Pages that
+    turn out to be uncorrectable, or not to need correcting, are left
+    alone.  Returns the list of pages that were (or with dry_run,
+    would have been) rewritten."""
+
+    page_size = geometry.page_size
+    raw_page_size = geometry.raw_page_size
+    rewritten = []
+    with open(path, "rb" if dry_run else "r+b") as f:
+        for run in _runs(sorted(pages)):
+            f.seek(run[0] * raw_page_size)
+            raw = f.read(len(run) * raw_page_size)
+            out = []
+            for (i, n) in enumerate(run):
+                page = raw[i * raw_page_size : i * raw_page_size
+                       + page_size]
+                spare = raw[i * raw_page_size + page_size
+                        : (i + 1) * raw_page_size]
+                (status, new_page, new_spare) = ecc_check_page(page,
+                                           spare)
+                if status == ECC_CHECK_CORRECTED:
+                    rewritten.append(n)
+                    # ecc_check_page() only returns the ECC bytes
+                    spare = new_spare + spare[len(new_spare):]
+                    page = new_page
+                out.append(page)
+                out.append(spare)
+            if not dry_run:
+                f.seek(run[0] * raw_page_size)
+                f.write(b"".join(out))
+    return rewritten
+
+def scrub(mc, jobs = None, dry_run = False):
+    """Scan the image of an open ps2mc object and rewrite every page
+    with a correctable error.
+
+    Returns the scan report with the list of rewritten pages added
+    as "rewritten_pages"."""
+
+    geometry = scan_geometry(mc.page_size, mc.spare_size,
+                 mc.pages_per_erase_block,
+                 mc.clusters_per_card * mc.pages_per_cluster)
+    mc.flush()
+    report = scan_file(mc.f.name, geometry, jobs)
+    report["dry_run"] = dry_run
+    report["rewritten_pages"] = scrub_file(mc.f.name, geometry,
+                           report["corrected_pages"],
+                           dry_run)
+    return report
+
+def write_scrub_report(out, report):
+    """Write the result of scrub() in human readable form."""
+
+    pages = report["rewritten_pages"]
+    if report["dry_run"]:
+        verb = "Would rewrite"
+    else:
+        verb = "Rewrote"
+    out.write("%s %d corrected page%s.\n"
+          % (verb, len(pages), "" if len(pages) == 1 else "s"))
+    if pages:
+        out.write("pages: %s\n" % " ".join("%05x" % n for n in pages))
+    failed = report["failed_pages"]
+    if failed:
+        out.write("uncorrectable pages: %s\n"
+              % " ".join("%05x" % n for n in failed))
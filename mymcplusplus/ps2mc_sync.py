@@ -0,0 +1,249 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Compare and synchronize the saves on two memory cards.
+
+Saves are compared by their directory entries first: the modes,
+lengths and modification times of the save directory and its files.
+Only saves whose entries differ have their contents read and hashed,
+so comparing two cards with mostly the same saves costs little more
+than reading their directories.  Copying a save keeps its timestamps,
+so a save copied by sync() compares the same afterwards."""
+
+import hashlib
+from errno import ENOSPC, EEXIST
+
+from .round import div_round_up
+from .ps2mc_dir import *
+from . import ps2mc
+
+# the possible states of a save, as returned by diff()
+STATES = ["same", "only_a", "only_b", "changed"]
+
+# how sync() resolves a save that differs on the two cards
+CONFLICT_POLICIES = ["newer", "a", "b", "skip"]
+
+# how much of a file save_hash() reads at a time
+HASH_CHUNK_SIZE = 64 * 1024
+
+class save_diff(object):
+    """The state of one save on the two cards being compared.
+
+    newer is "a" or "b" for a changed save that was modified later
+    on one card than the other, otherwise None."""
+
+    def __init__(self, name, state, newer = None):
+        self.name = name
+        self.state = state
+        self.newer = newer
+
+    def __repr__(self):
+        return "save_diff(%r, %r, %r)" % (self.name, self.state,
+                          self.newer)
+
+def _saves(mc):
+    """Return the save directories on a card.
+
+    The result maps each name to a tuple of the directory entry and
+    the entries of the files in it."""
+
+    saves = {}
+    root = mc.dir_open("/")
+    try:
+        dirs = [ent for ent in list(root)[2:] if mode_is_dir(ent[0])]
+    finally:
+        root.close()
+    for ent in dirs:
+        name = ent[8].decode("ascii")
+        dir = mc.dir_open("/" + name)
+        try:
+            files = [e for e in list(dir)[2:] if e[0] & DF_EXISTS]
+        finally:
+            dir.close()
+        saves[name] = (ent, files)
+    return saves
+
+def _signature(save):
+    """The parts of a save's entries compared before its contents."""
+
+    (ent, files) = save
+    return (ent[0], ent[6],
+        sorted((e[8], e[0], e[2], e[6]) for e in files))
+
+def _modified(save):
+    """The time the save or any of its files was last modified."""
+
+    (ent, files) = save
+    return max(tod_to_time(e[6]) for e in [ent] + files)
+
+def save_hash(mc, name):
+    """Return a hash of the names and contents of the files in a save.
+
+    The files are read a piece at a time, so a large save is never
+    held in memory all at once."""
+
+    dirname = "/" + name
+    dir = mc.dir_open(dirname)
+    try:
+        files = sorted((ent for ent in list(dir)[2:]
+                if mode_is_file(ent[0])),
+                   key = lambda ent: ent[8])
+    finally:
+        dir.close()
+    h = hashlib.sha1()
+    for ent in files:
+        h.update(ent[8] + b"\0")
+        h.update(b"%d\0" % ent[2])
+        f = mc.open(dirname + "/" + ent[8].decode("ascii"), "rb")
+        try:
+            while True:
+                buf = f.read(HASH_CHUNK_SIZE)
+                if len(buf) == 0:
+                    break
+                h.update(buf)
+        finally:
+            f.close()
+    return h.digest()
+
+def _clusters(mc, save):
+    """The number of clusters a save takes up on a card."""
+
+    (ent, files) = save
+    cluster_size = mc.cluster_size
+    n = div_round_up((len(files) + 2) * PS2MC_DIRENT_LENGTH,
+             cluster_size)
+    for e in files:
+        n += div_round_up(e[2], cluster_size)
+    return n
+
+def _diff(a, b, saves_a, saves_b):
+    result = []
+    for name in sorted(set(saves_a) | set(saves_b)):
+        if name not in saves_b:
+            result.append(save_diff(name, "only_a"))
+            continue
+        if name not in saves_a:
+            result.append(save_diff(name, "only_b"))
+            continue
+        save_a = saves_a[name]
+        save_b = saves_b[name]
+        if (_signature(save_a) == _signature(save_b)
+            or save_hash(a, name) == save_hash(b, name)):
+            result.append(save_diff(name, "same"))
+            continue
+        time_a = _modified(save_a)
+        time_b = _modified(save_b)
+        newer = None
+        if time_a > time_b:
+            newer = "a"
+        elif time_b > time_a:
+            newer = "b"
+        result.append(save_diff(name, "changed", newer))
+    return result
+
+def diff(a, b):
+    """Compare the saves on two open ps2mc objects.
+
+    Returns a list of save_diff objects, one for every save on either
+    card, sorted by name."""
+
+    return _diff(a, b, _saves(a), _saves(b))
+
+def _temp_name(mc, name):
+    """Find an unused name to copy a save to before it replaces name."""
+
+    for i in range(1000):
+        temp = "%s~%d" % (name[:28], i)
+        if mc.path_search("/" + temp)[1] == None:
+            return temp
+    raise ps2mc.io_error(EEXIST, "no free temporary name", "/" + name)
+
+def _replace(src, dest, name, src_save, dest_save):
+    """Copy a save from src to dest, replacing any old copy.
+
+    The save is copied to a temporary directory first and only takes
+    the place of the old copy once it's complete, so a copy that fails
+    leaves the old one as it was."""
+
+    if dest_save == None:
+        src.copy_save_to(dest, "/" + name)
+        return
+    if (_clusters(dest, src_save) * dest.cluster_size
+        > dest.get_free_space()):
+        # check now, rather than after part of the save is copied
+        raise ps2mc.io_error(ENOSPC, "out of space on image",
+                     "/" + name)
+    temp = _temp_name(dest, name)
+    try:
+        src.copy_save_to(dest, "/" + name, new_dirname = "/" + temp)
+    except:
+        if dest.path_search("/" + temp)[1] != None:
+            dest.rmdir("/" + temp)
+        raise
+    dest.rmdir("/" + name)
+    dest.rename("/" + temp, name)
+
+def sync(a, b, to_a = True, to_b = True, conflict = "newer",
+     dry_run = False):
+    """Copy the saves that differ between two open ps2mc objects.
+
+    Saves on only one card are copied to the other.  Saves that
+    differ are copied according to the conflict policy: the newer copy
+    replaces the older one ("newer"), a's copy or b's copy always wins
+    ("a" or "b"), or the save is left alone on both cards ("skip").
+    to_a and to_b limit the direction saves are copied in.  A save is
+    replaced only once its new copy is complete, so the card needs room
+    for both copies at the same time.  Saves are never deleted, as
+    there's no record of what was on the cards when they were last
+    synchronized.
+
+    Returns a list of (save_diff, action) tuples for the saves that
+    differ, where action is "to_a", "to_b" or None if the save was
+    left alone.  With dry_run nothing is copied."""
+
+    if conflict not in CONFLICT_POLICIES:
+        raise ValueError("unknown conflict policy: %s" % conflict)
+    saves_a = _saves(a)
+    saves_b = _saves(b)
+    actions = []
+    for d in _diff(a, b, saves_a, saves_b):
+        if d.state == "same":
+            continue
+        if d.state == "only_a":
+            winner = "a"
+        elif d.state == "only_b":
+            winner = "b"
+        elif conflict == "newer":
+            winner = d.newer
+        elif conflict == "skip":
+            winner = None
+        else:
+            winner = conflict
+
+        action = None
+        if winner == "a" and to_b:
+            action = "to_b"
+        elif winner == "b" and to_a:
+            action = "to_a"
+        actions.append((d, action))
+        if dry_run or action == None:
+            continue
+        if action == "to_b":
+            _replace(a, b, d.name, saves_a[d.name], saves_b.get(d.name))
+        else:
+            _replace(b, a, d.name, saves_b[d.name], saves_a.get(d.name))
+    return actions
@@ -15,12 +15,15 @@
 # along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import sys
+import hashlib
 import binascii
 
 from .. import ps2mc_dir
 from .. import utils
 from . import ps2save
 from . import lzari
+from . import lzari_cache
 from ..round import round_up
 from .utils import *
 
@@ -28,30 +31,77 @@ from .utils import *
 FORMAT_ID = "max"
 
 PS2SAVE_MAX_MAGIC = b"Ps2PowerSave"
+FEED_SIZE = 16384        # compressed bytes fed to the decoder at a time
 
 
 def poll(hdr):
     return hdr.startswith(PS2SAVE_MAX_MAGIC)
 
 
-def load2(save, f):
-    (length, s) = save._compressed
-    save._compressed = None
+class _decompressor(object):
+    """Reads the decompressed data of a save.
 
-    if lzari is None:
-        raise ps2mc_dir.Error("The lzari module is needed to decompress MAX Drive saves.")
-    s = lzari.decode(s, length, "decompressing " + save.dirent[8].decode("ascii") + ": ")
+    The compressed data is fed to the decoder FEED_SIZE bytes at a
+    time as reads need it, rather than all at once, and what's read
+    is copied to a cache_writer if one is given."""
+
+    def __init__(self, s, length, progress, writer = None):
+        self.decoder = lzari.LzariDecoder(length, progress)
+        self.src = memoryview(s)
+        self.pos = 0
+        self.length = length
+        self.produced = 0
+        self.writer = writer
+
+    def read(self, n):
+        decoder = self.decoder
+        chunks = []
+        got = 0
+        while True:
+            chunks.append(decoder.read(n - got))
+            got += len(chunks[-1])
+            if got >= n or decoder.eof() or self.pos >= len(self.src):
+                break
+            decoder.feed(self.src[self.pos : self.pos + FEED_SIZE])
+            self.pos += FEED_SIZE
+            if self.pos >= len(self.src):
+                decoder.close()
+        data = b"".join(chunks)
+        self.produced += len(data)
+        if self.writer != None:
+            self.writer.write(data)
+        return data
+
+    def finish(self):
+        """Read the rest of the data, caching it all if it's complete."""
+
+        while self.produced < self.length:
+            n = min(FEED_SIZE, self.length - self.produced)
+            if len(self.read(n)) == 0:
+                break
+        if self.writer != None and self.produced == self.length:
+            self.writer.commit()
+
+    def close(self):
+        if self.writer != None:
+            self.writer.abort()
+            self.writer = None
+        self.src.release()
+
+
+def _load_files(save, f, decoder):
     dirlen = save.dirent[2]
     timestamp = save.dirent[3]
     off = 0
     for i in range(dirlen):
-        if len(s) - off < 36:
+        hdr = decoder.read(36)
+        if len(hdr) != 36:
             raise ps2save.Eof(f)
-        (l, name) = struct.unpack("<L32s", s[off: off + 36])
+        (l, name) = struct.unpack("<L32s", hdr)
         name = utils.zero_terminate(name)
         # print "%08x %08x %s" % (off, l, name)
         off += 36
-        data = s[off: off + l]
+        data = decoder.read(l)
         if len(data) != l:
             raise ps2save.Eof(f)
         save.set_file(i,
@@ -60,7 +110,37 @@ def load2(save, f):
                        name),
                       data)
         off += l
-        off = round_up(off + 8, 16) - 8
+        pad = round_up(off + 8, 16) - 8 - off
+        decoder.read(pad)
+        off += pad
+
+
+def load2(save, f):
+    (length, s) = save._compressed
+    save._compressed = None
+
+    if lzari is None:
+        raise ps2mc_dir.Error("The lzari module is needed to decompress MAX Drive saves.")
+    progress = "decompressing " + save.dirent[8].decode("ascii") + ": "
+    cache = lzari_cache.get_cache()
+    decoder = None
+    writer = None
+    if cache != None:
+        key = cache.decode_key(s, length)
+        decoder = cache.open(key)
+        if decoder != None:
+            sys.stderr.write("%scached\n" % progress)
+        else:
+            writer = cache.writer(key, length)
+    if decoder == None:
+        decoder = _decompressor(s, length, progress, writer)
+    s = None
+    try:
+        _load_files(save, f, decoder)
+        if writer != None:
+            decoder.finish()
+    finally:
+        decoder.close()
 
 
 def load(save, f, timestamp=None):
@@ -87,7 +167,29 @@ def load(save, f, timestamp=None):
     save._compressed = (length, s)
 
 
-def save(save, f):
+def _compress(save, length, level, progress):
+    # Compress the files as they're laid out rather than building
+    # the whole uncompressed image first.
+    encoder = lzari.LzariEncoder(level)
+    compressed = []
+    off = 0
+    for i in range(save.dirent[2]):
+        (ent, data) = save.get_file(i)
+        encoder.feed(struct.pack("<L32s", ent[2], ent[8]))
+        encoder.feed(data)
+        off += 36 + len(data)
+        pad = round_up(off + 8, 16) - 8 - off
+        encoder.feed(b"\0" * pad)
+        off += pad
+        compressed.append(encoder.read())
+        sys.stderr.write("%s%3d%%\r" % (progress, off * 100 // max(length, 1)))
+    encoder.close()
+    compressed.append(encoder.read())
+    sys.stderr.write("%s100%%\n" % progress)
+    return compressed
+
+
+def save(save, f, level = lzari.DEFAULT_LEVEL):
     if lzari is None:
         raise ps2mc_dir.Error("The lzari module is needed to decompress MAX Drive saves.")
 
@@ -99,25 +201,48 @@ def save(save, f):
             iconsysname = title[0] + " " + title[1].strip()
         else:
             iconsysname = title[0] + title[1].rstrip()
-    s = b""
     dirent = save.dirent
+    length = 0
     for i in range(dirent[2]):
         (ent, data) = save.get_file(i)
         if not ps2mc_dir.mode_is_file(ent[0]):
             raise ps2mc_dir.Error("Non-file in save file.")
-        s += struct.pack("<L32s", ent[2], ent[8])
-        s += data
-        s += b"\0" * (round_up(len(s) + 8, 16) - 8 - len(s))
-    length = len(s)
+        length = round_up(length + 36 + len(data) + 8, 16) - 8
+
     progress = "compressing " + dirent[8].decode("ascii") + ": "
-    compressed = lzari.encode(s, progress)
+    cache = lzari_cache.get_cache()
+    compressed = None
+    if cache != None:
+        digest = hashlib.sha1()
+        off = 0
+        for i in range(dirent[2]):
+            (ent, data) = save.get_file(i)
+            digest.update(struct.pack("<L32s", ent[2], ent[8]))
+            digest.update(data)
+            off += 36 + len(data)
+            pad = round_up(off + 8, 16) - 8 - off
+            digest.update(b"\0" * pad)
+            off += pad
+        key = cache.encode_key(digest, level)
+        c = cache.get(key)
+        if c != None:
+            sys.stderr.write("%scached\n" % progress)
+            compressed = [c]
+    if compressed == None:
+        compressed = _compress(save, length, level, progress)
+        if cache != None:
+            cache.put(key, b"".join(compressed))
+    clen = sum(len(c) for c in compressed)
+
     hdr = struct.pack("<12sL32s32sLLL", PS2SAVE_MAX_MAGIC,
                       0, dirent[8], iconsysname.encode("ascii"),
-                      len(compressed) + 4, dirent[2], length)
+                      clen + 4, dirent[2], length)
     crc = binascii.crc32(hdr)
-    crc = binascii.crc32(compressed, crc)
+    for c in compressed:
+        crc = binascii.crc32(c, crc)
     f.write(struct.pack("<12sL32s32sLLL", PS2SAVE_MAX_MAGIC,
                         crc & 0xFFFFFFFF, dirent[8], iconsysname.encode("ascii"),
-                        len(compressed) + 4, dirent[2], length))
-    f.write(compressed)
+                        clen + 4, dirent[2], length))
+    for c in compressed:
+        f.write(c)
     f.flush()
@@ -27,9 +27,10 @@ import array
 import binascii
 import string
 import time
-from bisect import bisect_right
 from math import log
 
+from ..round import round_down
+
 try:
     import ctypes
     import mymcsup
@@ -38,7 +39,8 @@ except ImportError:
 
 hexlify = binascii.hexlify
 
-__ALL__ = ['lzari_codec', 'string_to_bit_array', 'bit_array_to_string']
+__ALL__ = ['lzari_codec', 'LzariDecoder', 'LzariEncoder',
+           'string_to_bit_array', 'bit_array_to_string']
 
 #
 # Fundamental constants of the LZARI compression alogorithm.
@@ -64,6 +66,35 @@ MAX_CHAR = (256 + MAX_MATCH_LEN - MIN_MATCH_LEN + 1)
 
 MAX_SUFFIX_CHAIN = 50    # limit on how many identical suffixes to try to match
 
+#
+# Compression levels.  Each level gives the maximum number of earlier
+# positions tried when looking for a match, the match length that's
+# considered good enough to stop looking for a longer one and the
+# longest match whose positions are added to the dictionary.  All
+# levels produce valid compressed data, level 9 is the original
+# behaviour.
+#
+
+MIN_LEVEL = 1
+MAX_LEVEL = 9
+DEFAULT_LEVEL = MAX_LEVEL
+
+_levels = {
+    1: (2, 32, 4),
+    2: (4, 32, 8),
+    3: (8, 48, 16),
+    4: (16, 48, 24),
+    5: (32, MAX_MATCH_LEN, 32),
+    6: (64, MAX_MATCH_LEN, 48),
+    7: (128, MAX_MATCH_LEN, MAX_MATCH_LEN),
+    8: (1024, MAX_MATCH_LEN, MAX_MATCH_LEN),
+    9: (50000, MAX_MATCH_LEN, MAX_MATCH_LEN),
+}
+PROGRESS_INTERVAL = 16384    # bytes decoded between progress checks
+DECODE_MARGIN = 16        # compressed bytes needed to decode a symbol
+DECODE_LOOKAHEAD = (ARITH_BITS + 2 + 7) // 8    # bytes read past the end
+ENCODE_CHUNK = 16384        # bytes fed to LzariEncoder before compressing
+
 #def debug(value, msg):
 #    print "@@@ %s %04x" % (msg, value)
 debug = lambda value, msg: None
@@ -128,6 +159,42 @@ def _rehash_table2(src, chars, head, next, next2, hist_invalid):
         table2[key2] = p
     return table2
 
+def level_params(level):
+    """Return the (max_chain, nice_len, max_insert) parameters of a level."""
+    
+    params = _levels.get(level)
+    if params == None:
+        raise ValueError("invalid compression level (%r)" % (level,))
+    return params
+
+def _fenwick_build(freq):
+    """Build a Fenwick tree from a list of frequencies indexed from 1."""
+    
+    tree = list(freq)
+    n = len(tree) - 1
+    for i in range(1, n + 1):
+        j = i + (i & -i)
+        if j <= n:
+            tree[j] += tree[i]
+    return tree
+
+_FENWICK_TOP = 1 << (MAX_CHAR.bit_length() - 1)
+
+def _make_position_cum():
+    position_cum = [0] * (HIST_LEN + 1)
+    a = 0
+    for i in range(HIST_LEN, 0, -1):
+        a =  a + 10000 // (200 + i)
+        position_cum[i - 1] = a
+    return position_cum
+
+# The initial state of the model is the same for every call, so it's
+# only built once.  The position table is never modified and is shared.
+_initial_sym_freq = [0] + [1] * MAX_CHAR
+_initial_sym_tree = _fenwick_build(_initial_sym_freq)
+_position_cum = _make_position_cum()
+_initial_history = b"\x20" * (HIST_LEN - MAX_MATCH_LEN) + b"\0" * MAX_MATCH_LEN
+
 class lzari_codec(object):
     # despite the name this does not implement a codec compatible
     # with Python's codec system
@@ -137,24 +204,27 @@ class lzari_codec(object):
         self.low = 0
         if decode:
             self.code = 0
-            # reverse the order of sym_cum so bisect_right() can
-            # be used for faster searching
-            self.sym_cum = list(range(0, MAX_CHAR + 1))
+            self.in_acc = 0
+            self.in_bits = 0
+            self.in_pos = 0
         else:
             self.shifts = 0
-            self.char_to_symbol = list(range(1, MAX_CHAR + 1))
-            self.sym_cum = list(range(MAX_CHAR, -1, -1))
+            self.out_acc = 0
+            self.out_bits = 0
             self.next_table = [None] * HIST_LEN
             self.next2_table = [None] * HIST_LEN
+            self.inserted = bytearray(HIST_LEN)
             self.suffix_table = {}
 
+        # Symbols are kept sorted by decreasing frequency, the
+        # cumulative frequencies are maintained in a Fenwick tree
+        # (binary indexed tree) over sym_freq.
+        self.char_to_symbol = list(range(1, MAX_CHAR + 1))
         self.symbol_to_char = [0] + list(range(MAX_CHAR))
-        self.sym_freq = [0] + [1] * MAX_CHAR
-        self.position_cum = [0] * (HIST_LEN + 1)
-        a = 0
-        for i in range(HIST_LEN, 0, -1):
-            a =  a + 10000 // (200 + i)
-            self.position_cum[i - 1] = a
+        self.sym_freq = _initial_sym_freq[:]
+        self.sym_tree = _initial_sym_tree[:]
+        self.sym_total = MAX_CHAR
+        self.position_cum = _position_cum
         
     def search(self, table, x):
         c = 1
@@ -169,77 +239,109 @@ class lzari_codec(object):
                 break
         return c
 
-    def update_model_decode(self, symbol):
-        # A compatible implemention to the one used while compressing.
+    def update_model(self, symbol):
+        # Shared by the compressor and the decompressor, both sides
+        # must make exactly the same changes to the model.
         
         sym_freq = self.sym_freq
-        sym_cum = self.sym_cum
-        
-        if self.sym_cum[MAX_CHAR] >= MAX_CUM:
-            c = 0
-            for i in range(MAX_CHAR, 0, -1):
-                self.sym_cum[MAX_CHAR - i] = c
-                a = (self.sym_freq[i] + 1) // 2
-                self.sym_freq[i] = a
-                c += a
-            self.sym_cum[MAX_CHAR] = c
+        
+        if self.sym_total >= MAX_CUM:
+            total = 0
+            for i in range(1, MAX_CHAR + 1):
+                a = (sym_freq[i] + 1) // 2
+                sym_freq[i] = a
+                total += a
+            self.sym_tree = _fenwick_build(sym_freq)
+            self.sym_total = total
+
+        # Find the first symbol with the same frequency.  The
+        # frequencies are non-increasing so a binary search works.
         freq = sym_freq[symbol]
-        new_symbol = symbol
-        while self.sym_freq[new_symbol - 1] == freq:
-            new_symbol -= 1
-        # new_symbol = sym_freq.index(freq)
+        lo = 1
+        hi = symbol
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sym_freq[mid] > freq:
+                lo = mid + 1
+            else:
+                hi = mid
+        new_symbol = lo
         if new_symbol != symbol:
+            debug(new_symbol, "a")
             symbol_to_char = self.symbol_to_char
             swap_char = symbol_to_char[new_symbol]
             char = symbol_to_char[symbol]
             symbol_to_char[new_symbol] = char
             symbol_to_char[symbol] = swap_char
-        sym_freq[new_symbol] = freq + 1
-        for i in range(MAX_CHAR - new_symbol + 1, MAX_CHAR + 1):
-            sym_cum[i] += 1
-            
-    def update_model_encode(self, symbol):
-        sym_freq = self.sym_freq
-        sym_cum = self.sym_cum
-        
-        if sym_cum[0] >= MAX_CUM:
-            c = 0
-            for i in range(MAX_CHAR, 0, -1):
-                sym_cum[i] = c
-                a = (sym_freq[i] + 1) // 2
-                sym_freq[i] = a
-                c += a
-            sym_cum[0] = c
-        freq = sym_freq[symbol]
-        new_symbol = symbol
-        while sym_freq[new_symbol - 1] == freq:
-            new_symbol -= 1
-        if new_symbol != symbol:
-            debug(new_symbol, "a")
-            swap_char = self.symbol_to_char[new_symbol]
-            char = self.symbol_to_char[symbol]
-            self.symbol_to_char[new_symbol] = char
-            self.symbol_to_char[symbol] = swap_char
             self.char_to_symbol[char] = new_symbol
             self.char_to_symbol[swap_char] = symbol
-        sym_freq[new_symbol] += 1
-        for i in range(new_symbol):
-            sym_cum[i] += 1
+        sym_freq[new_symbol] = freq + 1
+        sym_tree = self.sym_tree
+        i = new_symbol
+        while i <= MAX_CHAR:
+            sym_tree[i] += 1
+            i += i & -i
+        self.sym_total += 1
+
+    def input_bits(self, count):
+        """Return the next count bits of the compressed input.
+
+        Reading past the end of the input returns zero bits, as
+        the arithmetic coder looks a few bytes ahead of the last
+        symbol.  Reading further than that means the input is
+        truncated or corrupt."""
+        
+        acc = self.in_acc
+        bits = self.in_bits
+        while bits < count:
+            pos = self.in_pos
+            chunk = self.in_src[pos : pos + 4]
+            if len(chunk) != 4:
+                if pos >= len(self.in_src) + DECODE_LOOKAHEAD:
+                    raise ValueError("compressed input is corrupt")
+                chunk = chunk.ljust(4, b"\0")
+            acc = (acc << 32) | int.from_bytes(chunk, "big")
+            self.in_pos = pos + 4
+            bits += 32
+        bits -= count
+        self.in_bits = bits
+        self.in_acc = acc & ((1 << bits) - 1)
+        return acc >> bits
 
     def decode_char(self):
         high = self.high
         low = self.low
-        code = self.code
-        sym_cum = self.sym_cum
+        sym_tree = self.sym_tree
+        total = self.sym_total
         
         _range = high - low
-        max_cum_freq = sym_cum[MAX_CHAR]
-        n = ((code - low + 1) * max_cum_freq - 1) // _range
-        i = bisect_right(sym_cum, n, 1)
-        high = low + sym_cum[i] * _range // max_cum_freq
-        low += sym_cum[i - 1] * _range // max_cum_freq
-        symbol = MAX_CHAR + 1 - i
+        n = ((self.code - low + 1) * total - 1) // _range
+
+        # Search the tree for the symbol whose cumulative
+        # frequency range contains n.
+        m = total - n
+        if m < 1 or m > total:
+            raise ValueError("compressed input is corrupt")
+        symbol = 0
+        before = 0
+        bit = _FENWICK_TOP
+        while bit:
+            i = symbol + bit
+            if i <= MAX_CHAR and before + sym_tree[i] < m:
+                symbol = i
+                before += sym_tree[i]
+            bit >>= 1
+        symbol += 1
+        
+        cum = total - before
+        high = low + cum * _range // total
+        low += (cum - self.sym_freq[symbol]) * _range // total
 
+        # The code value is always shifted along with low, so only
+        # the difference between the two needs to be tracked while
+        # renormalizing.  All the new bits can then be read at once.
+        diff = self.code - low
+        shifts = 0
         while True:
             if low < QUADRANT2:
                 if low < QUADRANT1 or high > QUADRANT3:
@@ -247,46 +349,57 @@ class lzari_codec(object):
                         break
                 else:
                     low -= QUADRANT1
-                    code -= QUADRANT1
                     high -= QUADRANT1
             else:
                 low -= QUADRANT2
-                code -= QUADRANT2
                 high -= QUADRANT2
             low *= 2
             high *= 2
-            code = code * 2 + self.in_iter()
+            shifts += 1
 
+        if shifts:
+            diff = (diff << shifts) | self.input_bits(shifts)
         ret = self.symbol_to_char[symbol]
         self.high = high
         self.low = low
-        self.code = code
-        self.update_model_decode(symbol)
+        self.code = low + diff
+        self.update_model(symbol)
         return ret
     
     def decode_position(self):
-        _range = self.high - self.low
-        max_cum = self.position_cum[0]
-        pos = self.search(self.position_cum, ((self.code - self.low + 1) * max_cum - 1) // _range) - 1
-        self.high = (self.low + self.position_cum[pos] * _range // max_cum)
-        self.low += self.position_cum[pos + 1] * _range // max_cum
+        high = self.high
+        low = self.low
+        position_cum = self.position_cum
+        
+        _range = high - low
+        max_cum = position_cum[0]
+        pos = self.search(position_cum, ((self.code - low + 1) * max_cum - 1) // _range) - 1
+        high = low + position_cum[pos] * _range // max_cum
+        low += position_cum[pos + 1] * _range // max_cum
+        
+        diff = self.code - low
+        shifts = 0
         while True:
-            if self.low < QUADRANT2:
-                if (self.low < QUADRANT1
-                    or self.high > QUADRANT3):
-                    if self.high > QUADRANT2:
-                        return pos
+            if low < QUADRANT2:
+                if low < QUADRANT1 or high > QUADRANT3:
+                    if high > QUADRANT2:
+                        break
                 else:
-                    self.low -= QUADRANT1
-                    self.code -= QUADRANT1
-                    self.high -= QUADRANT1
+                    low -= QUADRANT1
+                    high -= QUADRANT1
             else:
-                self.low -= QUADRANT2
-                self.code -= QUADRANT2
-                self.high -= QUADRANT2
-            self.low *= 2
-            self.high *= 2
-            self.code = self.in_iter() + self.code * 2
+                low -= QUADRANT2
+                high -= QUADRANT2
+            low *= 2
+            high *= 2
+            shifts += 1
+
+        if shifts:
+            diff = (diff << shifts) | self.input_bits(shifts)
+        self.high = high
+        self.low = low
+        self.code = low + diff
+        return pos
 
     def add_suffix_1(self, pos, find):
         # naive implemention used for testing
@@ -312,6 +425,7 @@ class lzari_codec(object):
         
         src = self.src
         suffix_table = self.suffix_table
+        inserted = self.inserted
         max_match = min(self.max_match, len(src) - pos)
 
         mlen = -1
@@ -335,7 +449,10 @@ class lzari_codec(object):
             if find:
                 p = table2.get(key2, hist_invalid)
                 maxmlen = max_match - min_match2
-                while p > hist_invalid and mlen != maxmlen:
+                nicemlen = self.nice_len - min_match2
+                chain = self.max_chain
+                while (p > hist_invalid and mlen != maxmlen
+                       and mlen < nicemlen and chain > 0):
                     p3 = p + min_match2
                     if mpos == None and p3 <= pos:
                         mpos = p
@@ -343,6 +460,7 @@ class lzari_codec(object):
                     if p3 >= pos:
                         p = next2[p % HIST_LEN]
                         continue
+                    chain -= 1
                     rlen = _match(src, pos3, p3, mlen,
                               min(maxmlen, pos - p3))
                     if rlen != None:
@@ -354,11 +472,12 @@ class lzari_codec(object):
             elif find:
                 p = head
                 maxmlen = min(chars, max_match - MIN_MATCH_LEN)
+                nicemlen = self.nice_len - MIN_MATCH_LEN
+                chain = self.max_chain
                 i = 0
-                while (p > hist_invalid and i < 50000
-                       and mlen < maxmlen):
+                while (p > hist_invalid and i < chain
+                       and mlen < maxmlen and mlen < nicemlen):
                     assert i < count
-                    i += 1
                     p2 = p + MIN_MATCH_LEN
                     l2 = pos - p2
                     if mpos == None and l2 >= 0:
@@ -367,6 +486,7 @@ class lzari_codec(object):
                     if l2 <= 0:
                         p = next[p % HIST_LEN]
                         continue
+                    i += 1
                     if l2 > maxmlen:
                         l2 = maxmlen
                     m = mlen + 1
@@ -419,24 +539,41 @@ class lzari_codec(object):
             suffix_table[key] = [1, pos, {key2: pos}, len(key2)]
 
         p = pos - HIST_LEN
-        if p >= 0:
-            p2 = p + MIN_MATCH_LEN
-            key = src[p : p2]
-            a = suffix_table[key]
-            (count, head, table2, chars) = a
-            count -= 1
-            if count == 0:
-                assert head == p
-                del suffix_table[key]
-            else:
-                key2 = src[p2 : p2 + chars]
-                if table2[key2] == p:
-                    del table2[key2]
-                a[0] = count
+        if p >= 0 and inserted[modpos]:
+            self.remove_suffix(p)
+        inserted[modpos] = 1
         assert (mpos == None
             or src[pos : pos + mlen] == src[mpos : mpos + mlen])
         return (mpos, mlen)
 
+    def remove_suffix(self, p):
+        # remove a position that has fallen out of the history window
+        
+        src = self.src
+        suffix_table = self.suffix_table
+        p2 = p + MIN_MATCH_LEN
+        key = src[p : p2]
+        a = suffix_table[key]
+        (count, head, table2, chars) = a
+        count -= 1
+        if count == 0:
+            assert head == p
+            del suffix_table[key]
+        else:
+            key2 = src[p2 : p2 + chars]
+            if table2[key2] == p:
+                del table2[key2]
+            a[0] = count
+
+    def skip_suffix(self, pos):
+        # Like add_suffix(pos, False) but the position isn't added to
+        # the dictionaries, so can't be matched against later.
+        
+        modpos = pos % HIST_LEN
+        if pos >= HIST_LEN and self.inserted[modpos]:
+            self.remove_suffix(pos - HIST_LEN)
+        self.inserted[modpos] = 0
+
     def _add_suffix(self, pos, find):
         r = self.add_suffix_2(pos, find)
         start_pos = self.start_pos
@@ -452,22 +589,43 @@ class lzari_codec(object):
     add_suffix = add_suffix_2
     
     def output_bit(self, bit):
-        self.append_bit(bit)
-        bit ^= 1
-        for i in range(self.shifts):
-            self.append_bit(bit)
+        # Output the bit followed by any pending opposite bits.
+        # Bits are accumulated in an integer and moved to the output
+        # a whole byte at a time.
+        shifts = self.shifts
+        if bit:
+            bits = 1 << shifts
+        else:
+            bits = (1 << shifts) - 1
+        acc = (self.out_acc << (shifts + 1)) | bits
+        count = self.out_bits + shifts + 1
+        if count >= 8:
+            remainder = count & 7
+            self.out += (acc >> remainder).to_bytes(count >> 3, "big")
+            acc &= (1 << remainder) - 1
+            count = remainder
+        self.out_acc = acc
+        self.out_bits = count
         self.shifts = 0
         
     def encode_char(self, char):
         low = self.low
         high = self.high
-        sym_cum = self.sym_cum
+        sym_tree = self.sym_tree
+        total = self.sym_total
         
         symbol = self.char_to_symbol[char]
         range = high - low
+
+        # cumulative frequency of the symbols after this one
+        i = symbol - 1
+        cum = total
+        while i > 0:
+            cum -= sym_tree[i]
+            i &= i - 1
     
-        high = low + range * sym_cum[symbol - 1] // sym_cum[0]
-        low += range * sym_cum[symbol] // sym_cum[0]
+        high = low + range * cum // total
+        low += range * (cum - self.sym_freq[symbol]) // total
         debug(high, "high");
         debug(low, "low");
         while True:
@@ -487,7 +645,7 @@ class lzari_codec(object):
             high *= 2
         self.low = low
         self.high = high
-        self.update_model_encode(symbol)
+        self.update_model(symbol)
 
     def encode_position(self, position):
         position_cum = self.position_cum
@@ -519,40 +677,39 @@ class lzari_codec(object):
         self.low = low
         self.high = high
             
-    def encode(self, src, progress = None):
-        """Compress a string."""
-        
-        length = len(src)
-        if length == 0:
-            return b""
+    def encode_begin(self, src, max_match, level = DEFAULT_LEVEL):
+        """Start compressing.
 
-        out_array = array.array('B')
-        self.out_array = out_array
-        self.append_bit = out_array.append
+        The string src must contain at least the first
+        2 * max_match bytes of the input, unless it's the whole
+        input."""
         
         self.init(False)
-
-        max_match = min(MAX_MATCH_LEN, length)
+        self.out = bytearray()
         self.max_match = max_match
-        self.src = src = b"\x20" * max_match + src
-            
-        in_length = len(src)
-        
+        (self.max_chain, self.nice_len,
+         self.max_insert) = level_params(level)
+        self.src = b"\x20" * max_match + src
         self.start_pos = max_match
-        
         for in_pos in range(max_match):
             self.add_suffix(in_pos, False)
-        in_pos += 1
-        last_percent = -1
-        while in_pos < in_length:
-            if progress:
-                percent = (in_pos - max_match) * 100 // length
-                if percent != last_percent:
-                    sys.stderr.write("%s%3d%%\r"
-                             % (progress, percent))
-                    last_percent = percent
+        self.in_pos = max_match
+
+    def encode_run(self, end):
+        """Compress the input up to position end.
+
+        A match may extend past end, so there must be at least
+        2 * MAX_MATCH_LEN bytes of input after end, unless it's
+        the end of the input."""
+        
+        src = self.src
+        add_suffix = self.add_suffix
+        skip_suffix = self.skip_suffix
+        max_insert = self.max_insert
+        in_pos = self.in_pos
+        while in_pos < end:
             debug(src[in_pos], "src")
-            (match_pos, match_len) = self.add_suffix(in_pos, True)
+            (match_pos, match_len) = add_suffix(in_pos, True)
             if match_len < MIN_MATCH_LEN:
                 self.encode_char(src[in_pos])
             else:
@@ -560,11 +717,48 @@ class lzari_codec(object):
                 debug(match_len, "match_len")
                 self.encode_char(256 - MIN_MATCH_LEN + match_len)
                 self.encode_position(in_pos - match_pos - 1)
-                for i in range(match_len - 1):
-                    in_pos += 1
-                    self.add_suffix(in_pos, False)
+                if match_len <= max_insert:
+                    for i in range(match_len - 1):
+                        in_pos += 1
+                        add_suffix(in_pos, False)
+                else:
+                    for i in range(match_len - 1):
+                        in_pos += 1
+                        skip_suffix(in_pos)
             in_pos += 1
-                
+        self.in_pos = in_pos
+
+    def encode_append(self, s):
+        """Add more input to be compressed.
+
+        Input that's no longer needed for matching is discarded.
+        It's always removed in multiples of HIST_LEN bytes, so
+        the positions stored in the dictionaries only need to be
+        adjusted, not rehashed."""
+        
+        delta = round_down(self.in_pos - HIST_LEN, HIST_LEN)
+        if delta > 0:
+            next = self.next_table
+            next2 = self.next2_table
+            for i in range(HIST_LEN):
+                if next[i] is not None:
+                    next[i] -= delta
+                if next2[i] is not None:
+                    next2[i] -= delta
+            for a in self.suffix_table.values():
+                a[1] -= delta
+                table2 = a[2]
+                for key2 in table2:
+                    table2[key2] -= delta
+            self.in_pos -= delta
+            self.start_pos -= delta
+            self.src = self.src[delta:] + s
+        else:
+            self.src += s
+
+    def encode_finish(self):
+        """Flush out the final bits of the compressed output."""
+        
         self.shifts += 1
         if self.low < QUADRANT1:
             self.output_bit(0)
@@ -575,71 +769,294 @@ class lzari_codec(object):
         #    count, head, table2, chars = v
         #    print hexlify(k), count, head, len(table2), chars
             
-        if progress:
-            sys.stderr.write("%s100%%\n" % progress)
+        if self.out_bits:
+            self.out.append((self.out_acc << (8 - self.out_bits)) & 0xFF)
+            self.out_acc = 0
+            self.out_bits = 0
+
+    def take_output(self):
+        """Return the compressed output produced so far."""
         
-        return bit_array_to_string(out_array)
+        out = self.out
+        self.out = bytearray()
+        return bytes(out)
+
+    def encode(self, src, progress = None, level = DEFAULT_LEVEL):
+        """Compress a string."""
         
-    def decode(self, src, out_length, progress = None):
-        """Decompress a string."""
+        length = len(src)
+        if length == 0:
+            return b""
+
+        max_match = min(MAX_MATCH_LEN, length)
+        self.encode_begin(src, max_match, level)
+        in_length = len(self.src)
+        
+        last_percent = -1
+        while self.in_pos < in_length:
+            if progress:
+                percent = (self.in_pos - max_match) * 100 // length
+                if percent != last_percent:
+                    sys.stderr.write("%s%3d%%\r"
+                             % (progress, percent))
+                    last_percent = percent
+            self.encode_run(min(self.in_pos + PROGRESS_INTERVAL,
+                        in_length))
+        self.encode_finish()
+        self.src = None
+
+        if progress:
+            sys.stderr.write("%s100%%\n" % progress)
         
-        a = string_to_bit_array(src)
-        a.fromlist([0] * 32)     # add some extra bits 
-        self.in_iter = iter(a).__next__
+        return self.take_output()
 
-        out = array.array('B', b"\0") * out_length
-        outpos = 0
+    def decode_begin(self, src):
+        """Start decompressing.
+
+        The string src must contain at least the first 
+        DECODE_MARGIN bytes of the compressed input, unless it's
+        the whole input."""
         
         self.init(True)
+        self.in_src = src
+        self.code = self.input_bits(ARITH_BITS + 2)
+        self.history = bytearray(_initial_history)
+        self.hist_pos = HIST_LEN - MAX_MATCH_LEN
 
-        self.code = 0
-        for i in range(ARITH_BITS + 2):
-            self.code += self.code + self.in_iter()
-
-        hist_pos = HIST_LEN - MAX_MATCH_LEN
-        history = [0x20] * hist_pos + [0] * MAX_MATCH_LEN
+    def decode_run(self, out, count, in_limit = sys.maxsize):
+        """Decompress count bytes appending them to out.
 
+        Stops early if the input position passes in_limit.  Since
+        the last match can be longer than needed, up to
+        MAX_MATCH_LEN - 1 more bytes than count can be produced."""
+        
+        history = self.history
+        hist_pos = self.hist_pos
         decode_char = self.decode_char
-        last_percent = -1
-        last_time = time.time()
-        while outpos < out_length:
-            if progress:
-                percent = outpos * 100 // out_length
-                if percent != last_percent:
-                    now = time.time()
-                    if now - last_time >= 1:
-                        sys.stderr.write("%s%3d%%\r"
-                            % (progress, percent))
-                        last_percent = percent
-                        last_time = now
+        decode_position = self.decode_position
+        end = len(out) + count
+        while len(out) < end and self.in_pos <= in_limit:
             char = decode_char()
-            if char >= 0x100:
-                pos = self.decode_position()
-                length = char - 0x100 + MIN_MATCH_LEN
-                base = (hist_pos - pos - 1) % HIST_LEN
-                for off in range(length):
-                    a = history[(base + off) % HIST_LEN]
-                    out[outpos] = a
-                    outpos += 1
-                    history[hist_pos] = a
-                    hist_pos = (hist_pos + 1) % HIST_LEN
-            else:
-                out[outpos] = char
-                outpos += 1
+            if char < 0x100:
+                out.append(char)
                 history[hist_pos] = char
                 hist_pos = (hist_pos + 1) % HIST_LEN
+                continue
+            pos = decode_position()
+            length = char - 0x100 + MIN_MATCH_LEN
+            base = (hist_pos - pos - 1) % HIST_LEN
+            if (pos >= length - 1
+                and base + length <= HIST_LEN
+                and hist_pos + length <= HIST_LEN):
+                # The match doesn't overlap the bytes it produces
+                # and neither end wraps around, copy it in one go.
+                a = history[base : base + length]
+                history[hist_pos : hist_pos + length] = a
+                out += a
+                hist_pos = (hist_pos + length) % HIST_LEN
+                continue
+            for off in range(length):
+                a = history[(base + off) % HIST_LEN]
+                out.append(a)
+                history[hist_pos] = a
+                hist_pos = (hist_pos + 1) % HIST_LEN
+        self.hist_pos = hist_pos
+        
+    def decode(self, src, out_length, progress = None):
+        """Decompress a string."""
+        
+        out = bytearray()
+        self.decode_begin(src)
+
+        last_time = time.time()
+        while len(out) < out_length:
+            if progress:
+                now = time.time()
+                if now - last_time >= 1:
+                    sys.stderr.write("%s%3d%%\r"
+                        % (progress,
+                           len(out) * 100 // out_length))
+                    last_time = now
+            self.decode_run(out, min(PROGRESS_INTERVAL,
+                         out_length - len(out)))
         
-        self.in_iter = None
+        self.in_src = None
+        self.history = None
         if progress:
             sys.stderr.write("%s100%%\n" % progress)
-        return out.tobytes()
+        del out[out_length:]
+        return bytes(out)
+
+class LzariDecoder(object):
+    """An incremental LZARI decompressor.
+
+    Compressed data is passed to feed() as it becomes available and
+    the decompressed data is retrieved with read().  Only a small
+    window of either is kept in memory.  The length of the
+    decompressed data must be known in advance."""
+    
+    def __init__(self, out_length, progress = None):
+        self.out_length = out_length
+        self.progress = progress
+        self._codec = lzari_codec()
+        self._in = bytearray()
+        self._out = bytearray()
+        self._produced = 0
+        self._started = False
+        self._closed = False
+        self._last_time = time.time()
+
+    def feed(self, s):
+        """Add more compressed data."""
+        
+        if self._closed:
+            raise ValueError("feed() called after close()")
+        codec = self._codec
+        if self._started and codec.in_pos >= HIST_LEN:
+            # discard the input that's already been consumed
+            del self._in[:codec.in_pos]
+            codec.in_pos = 0
+        self._in += s
+
+    def close(self):
+        """Signal that there is no more compressed data."""
+        
+        self._closed = True
+
+    def _decode(self, want):
+        codec = self._codec
+        if self._closed:
+            in_limit = sys.maxsize
+        else:
+            in_limit = len(self._in) - DECODE_MARGIN
+        if not self._started:
+            if in_limit < 0:
+                return
+            codec.decode_begin(self._in)
+            self._started = True
+        out = self._out
+        while (len(out) < want and self._produced < self.out_length
+               and codec.in_pos <= in_limit):
+            count = min(PROGRESS_INTERVAL, want - len(out),
+                    self.out_length - self._produced)
+            l = len(out)
+            codec.decode_run(out, count, in_limit)
+            self._produced += len(out) - l
+            if self.progress:
+                now = time.time()
+                if now - self._last_time >= 1:
+                    sys.stderr.write("%s%3d%%\r"
+                        % (self.progress, self._produced * 100
+                           // self.out_length))
+                    self._last_time = now
+        if self._produced > self.out_length:
+            # the last match ran past the end of the output
+            del out[len(out) - (self._produced - self.out_length):]
+            self._produced = self.out_length
+        if self.progress and self.eof():
+            sys.stderr.write("%s100%%\n" % self.progress)
+            self.progress = None
+
+    def eof(self):
+        """Return true if all the decompressed data has been produced."""
+        
+        return self._produced >= self.out_length
+
+    def read(self, n = -1):
+        """Read up to n bytes of decompressed data.
+
+        Fewer bytes are returned if more compressed data needs
+        to be fed first, or if the end of the data is reached.
+        If n is negative all the data currently available is
+        returned."""
+
+        if n < 0:
+            n = self.out_length
+        out = self._out
+        if len(out) < n:
+            self._decode(n)
+        ret = bytes(out[:n])
+        del out[:n]
+        return ret
+
+class LzariEncoder(object):
+    """An incremental LZARI compressor.
+
+    Uncompressed data is passed to feed() and the compressed data
+    is retrieved with read().  The close() method must be called
+    after the last of the data has been fed so the rest of the
+    compressed data can be produced."""
+    
+    def __init__(self, level = DEFAULT_LEVEL):
+        level_params(level)
+        self.level = level
+        self._codec = None
+        self._pending = []
+        self._pending_len = 0
+        self._out = bytearray()
+        self._closed = False
+
+    def feed(self, s):
+        """Add more data to be compressed."""
+        
+        if self._closed:
+            raise ValueError("feed() called after close()")
+        self._pending.append(bytes(s))
+        self._pending_len += len(s)
+        if self._pending_len >= ENCODE_CHUNK:
+            self._encode(False)
+
+    def close(self):
+        """Signal that there is no more data."""
+        
+        if not self._closed:
+            self._closed = True
+            self._encode(True)
+
+    def _encode(self, final):
+        codec = self._codec
+        s = b"".join(self._pending)
+        if codec is None:
+            if not final and len(s) <= 2 * MAX_MATCH_LEN:
+                return
+            self._pending = []
+            self._pending_len = 0
+            if len(s) == 0:
+                return
+            codec = self._codec = lzari_codec()
+            codec.encode_begin(s, min(MAX_MATCH_LEN, len(s)),
+                       self.level)
+        else:
+            self._pending = []
+            self._pending_len = 0
+            codec.encode_append(s)
+        if final:
+            codec.encode_run(len(codec.src))
+            codec.encode_finish()
+            codec.src = None
+        else:
+            codec.encode_run(len(codec.src) - 2 * MAX_MATCH_LEN)
+        self._out += codec.take_output()
+
+    def read(self, n = -1):
+        """Read up to n bytes of compressed data.
+
+        If n is negative all the compressed data currently available
+        is returned."""
+
+        out = self._out
+        if n < 0:
+            n = len(out)
+        ret = bytes(out[:n])
+        del out[:n]
+        return ret
 
 if mymcsup == None:
     def decode(src, out_length, progress = None):
         return lzari_codec().decode(src, out_length, progress)
     
-    def encode(src, progress = None):
-        return lzari_codec().encode(src, progress)
+    def encode(src, progress = None, level = DEFAULT_LEVEL):
+        return lzari_codec().encode(src, progress, level)
 else:
     mylzari_decode = mymcsup.mylzari_decode
     mylzari_encode = mymcsup.mylzari_encode
@@ -652,7 +1069,9 @@ else:
             raise ValueError("compressed input is corrupt")
         return ctypes.string_at(out, out_length)
 
-    def encode(src, progress = None):
+    def encode(src, progress = None, level = DEFAULT_LEVEL):
+        if level != DEFAULT_LEVEL:
+            return lzari_codec().encode(src, progress, level)
         (r, compressed, comp_len) = mylzari_encode(src, len(src),
                                progress)
         # print r, compressed.value, comp_len
@@ -685,106 +1104,17 @@ def main2(args):
     print("time:", now[0] - start[0], now[1] - start[1], now[4] - start[4])
 
 
-def _get_hotshot_lineinfo(filename):
-    import hotshot.log
-    log = hotshot.log.LogReader(filename)
-    timings = {}
-    for what, loc, tdelta in log:
-        if what == hotshot.log.LINE:
-            a = timings.get(loc)
-            if a == None:
-                timings[loc] = [1, tdelta]
-            else:
-                a[0] += 1
-                a[1] += tdelta
-    return list(timings.items())
-
-def _dump_hotshot_lineinfo(log):
-    a = sorted(_get_hotshot_lineinfo(log))
-    total_count = sum((time[0]
-               for (loc, time) in a))
-    total_time = sum((time[1]
-              for (loc, time) in a))
-    for (loc, [count, time]) in a:
-        print(("%8d %6.3f%%  %8d %6.3f%%"
-               % (time, time * 100.0 / total_time,
-              count, count * 100.0 / total_count)), end=' ')
-        print("%s:%d(%s)" % loc)
-
-def _dump_hotshot_lineinfo2(log):
-    cur = None
-    a = sorted(_get_hotshot_lineinfo(log))
-    total_count = sum((time[0]
-               for (loc, time) in a))
-    total_time = sum((time[1]
-              for (loc, time) in a))
-    for ((filename, lineno, fn), [count, time]) in a:
-        if cur != filename:
-            if cur != None and f != None:
-                for line in f:
-                    print(line[:-1])
-                f.close()
-            try:
-                f = open(filename, "r")
-            except OSError:
-                f = None
-            cur = filename
-            l = 0
-            print("#", filename)
-        if f != None:
-            while l < lineno:
-                print(f.readline()[:-1])
-                l += 1
-        print ("# %8d %6.3f%%  %8d %6.3f%%"
-               % (time, time * 100.0 / total_time,
-              count, count * 100.0 / total_count))
-    if cur != None and f != None:
-        for line in f:
-            print(line[:-1])
-        f.close()
-    
 def main(args):
-    import os
-    
-    if args[1] == "pc":
-        import profile
-        pr = profile.Profile()
-        for i in range(5):
-            print(pr.calibrate(100000))
-        return
-    elif args[1] == "p":
-        import profile
-        ret = 0
-        # profile.Profile.bias = 5.26e-6
-        profile.runctx("ret = main2(args[1:])",
-                   globals(), locals())
-        return ret
-    elif args[1].startswith("h"):
-        import hotshot, hotshot.stats
-        import warnings
-
-        warnings.filterwarnings("ignore")
-        tmp = os.tempnam()
-        try:
-            l = args[1].startswith("hl")
-            p = hotshot.Profile(tmp, l)
-            ret = p.runcall(main2, args[1:])
-            p.close()
-            p = None
-            if l:
-                if args[1] == "hl2":
-                    _dump_hotshot_lineinfo2(tmp)
-                else:
-                    _dump_hotshot_lineinfo(tmp)
-            else:
-                hotshot.stats.load(tmp).print_stats()
-        finally:
-            try:
-                os.remove(tmp)
-            except OSError:
-                pass
+    if args[1] == "p":
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        ret = profiler.runcall(main2, args[1:])
+        stats = pstats.Stats(profiler)
+        stats.sort_stats("cumulative").print_stats(25)
         return ret
-            
+
     return main2(args)
 
 if __name__ == '__main__':
@@ -0,0 +1,261 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""An on-disk cache of LZARI compression results.
+
+Compressing and decompressing MAX Drive saves is slow, and the same
+saves tend to be converted over and over again.  Results are stored
+in a directory of files named by a hash of the input, so converting
+an unchanged save again only costs a hash and a file read.  The
+least recently used entries are removed when the total size of the
+cache grows over its limit.
+
+The cache is disabled unless enabled with set_cache() or the
+MYMCPLUSPLUS_LZARI_CACHE environment variable."""
+
+import os
+import hashlib
+import tempfile
+
+ENV_DIR = "MYMCPLUSPLUS_LZARI_CACHE"
+ENV_SIZE = "MYMCPLUSPLUS_LZARI_CACHE_SIZE"
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+_SUFFIX = ".lzc"
+
+
+def parse_size(s):
+    """Parse a size like "65536", "512K", "64M" or "1G"."""
+
+    s = s.strip().upper()
+    mult = 1
+    if s[-1:] in ("K", "M", "G"):
+        mult = 1024 ** ("KMG".index(s[-1]) + 1)
+        s = s[:-1]
+    try:
+        size = int(s) * mult
+    except ValueError:
+        raise ValueError("invalid cache size (%r)" % (s,))
+    if size < 0:
+        raise ValueError("invalid cache size (%r)" % (s,))
+    return size
+
+
+class lzari_cache(object):
+    """A size bounded directory of cached LZARI results."""
+
+    def __init__(self, path, max_size = DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok = True)
+
+    def encode_key(self, digest, level):
+        """Return the key of the compressed form of some data.
+
+        The digest is a hashlib object that's been updated with
+        the uncompressed data."""
+
+        return "e%d-%s" % (level, digest.hexdigest())
+
+    def decode_key(self, compressed, length):
+        """Return the key of the decompressed form of some data."""
+
+        return "d%d-%s" % (length, hashlib.sha1(compressed).hexdigest())
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + _SUFFIX)
+
+    def open(self, key):
+        """Return a file object reading the data cached under key,
+        or None."""
+
+        fn = self._filename(key)
+        try:
+            f = open(fn, "rb")
+        except EnvironmentError:
+            self.misses += 1
+            return None
+        try:
+            # the modification time is used to order the entries
+            os.utime(fn, None)
+        except EnvironmentError:
+            pass
+        self.hits += 1
+        return f
+
+    def get(self, key):
+        """Return the data cached under key, or None."""
+
+        f = self.open(key)
+        if f == None:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def writer(self, key, length):
+        """Return a cache_writer that caches the length bytes written
+        to it under key, or None if they can't be cached."""
+
+        if length > self.max_size:
+            return None
+        try:
+            return cache_writer(self, key)
+        except EnvironmentError:
+            return None
+
+    def put(self, key, data):
+        """Cache data under key, evicting old entries if needed."""
+
+        w = self.writer(key, len(data))
+        if w != None:
+            w.write(data)
+            w.commit()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(_SUFFIX):
+                continue
+            fn = os.path.join(self.path, name)
+            try:
+                st = os.stat(fn)
+            except EnvironmentError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+        return entries
+
+    def size(self):
+        """Return the total size of the cached data."""
+
+        return sum(ent[1] for ent in self._entries())
+
+    def trim(self, max_size = None):
+        """Remove least recently used entries until the cache fits."""
+
+        if max_size == None:
+            max_size = self.max_size
+        entries = self._entries()
+        total = sum(ent[1] for ent in entries)
+        entries.sort()
+        for (mtime, size, fn) in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(fn)
+            except EnvironmentError:
+                continue
+            total -= size
+
+    def clear(self):
+        """Remove all entries."""
+
+        self.trim(0)
+
+
+class cache_writer(object):
+    """Writes an entry to the cache as its data is produced.
+
+    The entry only appears in the cache once commit() is called, so
+    an entry that's abandoned part way through is never used."""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        (fd, self.tmpname) = tempfile.mkstemp(suffix = ".tmp",
+                              dir = cache.path)
+        self.f = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        if self.f == None:
+            return
+        try:
+            self.f.write(data)
+        except EnvironmentError:
+            self.abort()
+
+    def commit(self):
+        """Add the data written to the cache, evicting old entries
+        if needed."""
+
+        if self.f == None:
+            return
+        try:
+            self.f.close()
+            self.f = None
+            os.replace(self.tmpname, self.cache._filename(self.key))
+        except EnvironmentError:
+            self.abort()
+            return
+        self.tmpname = None
+        self.cache.trim()
+
+    def abort(self):
+        """Throw away the data written."""
+
+        if self.f != None:
+            try:
+                self.f.close()
+            except EnvironmentError:
+                pass
+            self.f = None
+        if self.tmpname != None:
+            try:
+                os.remove(self.tmpname)
+            except EnvironmentError:
+                pass
+            self.tmpname = None
+
+
+_cache = None
+_cache_checked = False
+
+
+def set_cache(path, max_size = None):
+    """Enable the cache in the directory path, or disable it if None."""
+
+    global _cache, _cache_checked
+    _cache_checked = True
+    if path == None:
+        _cache = None
+        return
+    if max_size == None:
+        max_size = _env_max_size()
+    _cache = lzari_cache(path, max_size)
+
+
+def _env_max_size():
+    size = os.environ.get(ENV_SIZE)
+    if size:
+        return parse_size(size)
+    return DEFAULT_MAX_SIZE
+
+
+def get_cache():
+    """Return the active cache, or None if caching isn't enabled."""
+
+    global _cache_checked
+    if not _cache_checked:
+        path = os.environ.get(ENV_DIR)
+        if path:
+            set_cache(path)
+        _cache_checked = True
+    return _cache
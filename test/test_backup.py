@@ -0,0 +1,128 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import io
+import os
+
+from mymcplus import backup, mymc, ps2mc, ps2mc_sync
+
+
+def open_card(path, mode="rb"):
+    f = open(path, mode)
+    return (f, ps2mc.ps2mc(f))
+
+
+def test_backup_restore(mc01_copy, tmpdir):
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+    store = tmpdir.join("store").strpath
+
+    (f, mc) = open_card(mc_file)
+    try:
+        stats = backup.backup(mc, store, "mc01")
+        assert (stats["saves"], stats["unchanged"], stats["objects"]) == (
+            2, 0, 5)
+        # the image hasn't changed, so nothing is read or stored
+        stats = backup.backup(mc, store, "mc01")
+        assert (stats["unchanged"], stats["objects"]) == (2, 0)
+    finally:
+        mc.close()
+        f.close()
+
+    (f, mc) = open_card(mc_file, "r+b")
+    try:
+        icon_sys = mc.open("/BESCES-50501REZ/icon.sys", "r+b")
+        icon_sys.write(b"X")
+        icon_sys.close()
+        stats = backup.backup(mc, store, "mc01")
+        assert (stats["unchanged"], stats["objects"]) == (1, 1)
+    finally:
+        mc.close()
+        f.close()
+
+    (first, second, third) = backup.runs(store, "mc01")
+    assert sum(len(files) for (dirpath, dirnames, files)
+               in os.walk(os.path.join(store, "objects"))) == 6
+
+    (f, mc) = open_card(mc_file)
+    try:
+        for (run, state) in [(None, "same"), (first, "changed")]:
+            out = io.BytesIO()
+            assert backup.restore(out, store, "mc01", run) == 2
+            restored = ps2mc.ps2mc(out)
+            try:
+                assert [d.state for d in ps2mc_sync.diff(mc, restored)] == [
+                    "same", state]
+                assert restored.check_findings() == []
+                # modes, sizes and timestamps are kept
+                (a, b) = [card.get_dirent("/BEDATA-SYSTEM/history")
+                          for card in [mc, restored]]
+                assert [a[i] for i in [0, 2, 3, 6]] == [
+                    b[i] for i in [0, 2, 3, 6]]
+            finally:
+                restored.close()
+    finally:
+        mc.close()
+        f.close()
+
+
+def test_backup_cmd(capsys, mc01_copy, tmpdir):
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+    store = tmpdir.join("store").strpath
+    restored = tmpdir.join("restored.ps2").strpath
+
+    assert mymc.main(["mymcplus", mc_file, "backup", "-n", "card",
+                      store]) == 0
+    (run,) = backup.runs(store, "card")
+    assert capsys.readouterr().out == (
+        "Backed up 2 saves (0 unchanged) as card/%s, adding 5 files"
+        " (4KB) to the store.\n" % run)
+
+    assert mymc.main(["mymcplus", restored, "restore", "-n", "nothing",
+                      store]) == 1
+    assert not os.path.exists(restored)
+    assert mymc.main(["mymcplus", restored, "restore", "-n", "card",
+                      "-e", store]) == 0
+    assert capsys.readouterr().out == "Restored 2 saves.\n"
+    assert mymc.main(["mymcplus", mc_file, "diff", restored]) == 0
+    assert os.path.getsize(restored) == 8 * 1024 * 1024
+
+
+def test_run_order(tmpdir):
+    ids = ["20260101T000000Z", "20260101T000000Z-002",
+           "20260101T000000Z-010", "20260101T000000Z-1000",
+           "20260101T000001Z"]
+    manifests = tmpdir.mkdir("manifests").mkdir("card")
+    for run in ids:
+        manifests.join(run + ".json").write("{}")
+    assert backup.runs(tmpdir.strpath, "card") == ids
+
+
+def test_run_same_second(monkeypatch, mc01_copy, tmpdir):
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+    store = tmpdir.join("store").strpath
+    monkeypatch.setattr(backup.time, "strftime",
+                        lambda format, t: "20260101T000000Z")
+
+    (f, mc) = open_card(mc_file)
+    try:
+        ids = [backup.backup(mc, store, "mc01")["run"] for i in range(3)]
+    finally:
+        mc.close()
+        f.close()
+    assert ids == ["20260101T000000Z", "20260101T000000Z-002",
+                   "20260101T000000Z-003"]
+    assert backup.runs(store, "mc01") == ids
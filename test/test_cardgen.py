@@ -0,0 +1,85 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import random
+
+from mymcplus import cardgen, mymc, ps2mc, ps2icon, ps2iconsys
+
+
+def generate(path, **kw):
+    with open(path, "w+b") as f:
+        names = cardgen.generate(f, **kw)
+    with open(path, "rb") as f:
+        digest = hashlib.md5(f.read()).hexdigest()
+    return names, digest
+
+
+def test_reproducible(tmpdir):
+    path = tmpdir.join("card.ps2").strpath
+    (names1, digest1) = generate(path, clusters=2048, seed=5, saves=6,
+                                 fragmentation=0.3)
+    (names2, digest2) = generate(path, clusters=2048, seed=5, saves=6,
+                                 fragmentation=0.3)
+    (names3, digest3) = generate(path, clusters=2048, seed=6, saves=6,
+                                 fragmentation=0.3)
+    assert len(names1) == 6
+    assert names1 == names2
+    assert digest1 == digest2
+    assert digest1 != digest3
+
+
+def test_valid_saves(tmpdir):
+    path = tmpdir.join("card.ps2").strpath
+    (names, digest) = generate(path, clusters=2048, with_ecc=False,
+                               seed=1, fill=0.5, fragmentation=0.5,
+                               files=(1, 2), sizes=(100, 20000))
+    with open(path, "rb") as f:
+        mc = ps2mc.ps2mc(f)
+        try:
+            assert mc.check()
+            free = mc.get_free_space()
+            total = mc.get_allocatable_space()
+            assert 0.4 < 1 - free / total < 0.6
+            for name in names:
+                icon_sys = ps2iconsys.IconSys(mc.get_icon_sys(name))
+                title = icon_sys.get_title("unicode")
+                assert title[0].startswith("ＳＹＮＴＨＥＴＩＣ")
+                sf = mc.export_save_file(name)
+                assert 3 <= len(sf) <= 4
+                icon = ps2icon.Icon(dict((ent[8].decode("ascii"), data)
+                                         for (ent, data) in sf)
+                                    [icon_sys.icon_file_normal])
+                assert icon.vertex_count == cardgen.ICON_VERTICES
+        finally:
+            mc.close()
+
+
+def test_rle_compress_texture():
+    plain = cardgen.make_icon(random.Random(0), compressed=False)
+    data = cardgen.make_icon(random.Random(0), compressed=True)
+    assert len(data) < len(plain)
+    assert ps2icon.Icon(data).texture == ps2icon.Icon(plain).texture
+
+
+def test_generate_cmd(capsys, tmpdir):
+    path = tmpdir.join("card.ps2").strpath
+    mymc.main(["mymcplus", path, "generate", "-c", "2048", "-n", "3",
+               "--files", "1-1", "--sizes", "1000-1000"])
+    assert capsys.readouterr().out == "Generated 3 saves.\n"
+    mymc.main(["mymcplus", path, "check"])
+    assert capsys.readouterr().out == "No errors found.\n"
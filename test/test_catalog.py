@@ -0,0 +1,136 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+
+from mymcplus import catalog, mymc
+
+
+def test_game_id():
+    assert catalog.game_id("BESCES-50501REZ") == "SCES-50501"
+    assert catalog.game_id("BASLUS-20312") == "SLUS-20312"
+    assert catalog.game_id("BISLPS_251.23X") == "SLPS-25123"
+    assert catalog.game_id("BEDATA-SYSTEM") == None
+
+
+def test_index(data, tmpdir):
+    library = tmpdir.mkdir("library")
+    shutil.copy(data.join("mc01.ps2").strpath, library.strpath)
+    library.mkdir("sub")
+    shutil.copy(data.join("mc01.ps2").strpath,
+                library.join("sub", "copy.mc2").strpath)
+    library.join("notes.txt").write("not a memory card")
+    library.join("broken.ps2").write("not a memory card either")
+
+    db = catalog.open_catalog(tmpdir.join("catalog.sqlite").strpath)
+    try:
+        stats = catalog.update(db, library.strpath, 2)
+        assert (stats["indexed"], stats["unchanged"], stats["failed"]) == (
+            2, 0, 1)
+        assert stats["errors"][0][0] == "broken.ps2"
+
+        results = catalog.search(db, ["SCES-50501"])
+        assert [(r["image"], r["name"], r["title"]) for r in results] == [
+            ("mc01.ps2", "BESCES-50501REZ", "Rez"),
+            (os.path.join("sub", "copy.mc2"), "BESCES-50501REZ", "Rez")]
+        assert results[0]["hash"] == results[1]["hash"]
+        assert results[0]["size"] == 54272
+        assert len(catalog.search(db, ["sces_505.01"])) == 2
+        assert [r["name"] for r in catalog.search(db, ["system config"])
+                ] == ["BEDATA-SYSTEM"] * 2
+        assert catalog.search(db, ["rez", "system"]) == []
+
+        # images that couldn't be read are tried again
+        stats = catalog.update(db, library.strpath, 1)
+        assert (stats["indexed"], stats["unchanged"], stats["failed"]) == (
+            0, 2, 1)
+        assert stats["errors"][0][0] == "broken.ps2"
+
+        # only changed images are read again
+        library.join("broken.ps2").remove()
+        mymc.main(["mymcplus", library.join("mc01.ps2").strpath,
+                   "delete", "BEDATA-SYSTEM"])
+        stats = catalog.update(db, library.strpath, 1)
+        assert (stats["indexed"], stats["unchanged"], stats["removed"]) == (
+            1, 1, 1)
+        assert [r["image"] for r in catalog.search(db, ["system"])] == [
+            os.path.join("sub", "copy.mc2")]
+    finally:
+        db.close()
+
+
+def test_search_cmd(capsys, data, tmpdir):
+    library = tmpdir.mkdir("library")
+    shutil.copy(data.join("mc01.ps2").strpath, library.strpath)
+
+    assert mymc.main(["mymcplus", library.strpath, "index"]) == 0
+    assert capsys.readouterr().out == (
+        "Indexed 1 images, 0 unchanged, 0 removed, 0 failed;"
+        " 2 saves in the catalog.\n")
+    assert library.join(catalog.CATALOG_NAME).check()
+
+    assert mymc.main(["mymcplus", library.strpath, "search", "rez"]) == 0
+    out = capsys.readouterr().out
+    assert out.startswith("mc01.ps2: BESCES-50501REZ")
+    assert out.rstrip().endswith("Rez")
+    assert mymc.main(["mymcplus", library.strpath, "search", "SLUS-20312"]
+                     ) == 1
+
+
+def test_dedupe_report(capsys, data, tmpdir):
+    library = tmpdir.mkdir("library")
+    for name in ["a.ps2", "b.ps2", "c.ps2"]:
+        shutil.copy(data.join("mc01.ps2").strpath,
+                    library.join(name).strpath)
+    mymc.main(["mymcplus", library.join("c.ps2").strpath,
+               "delete", "BEDATA-SYSTEM"])
+    tmpdir.join("extra").write("extra")
+    mymc.main(["mymcplus", library.join("c.ps2").strpath,
+               "add", "-d", "BESCES-50501REZ", tmpdir.join("extra").strpath])
+
+    db = catalog.open_catalog(library.join("catalog.sqlite").strpath)
+    try:
+        stats = catalog.update(db, library.strpath)
+        assert stats["hashed"] == 5
+        report = catalog.dedupe_report(db)
+        assert [[(c["image"], c["name"]) for c in group["copies"]]
+                for group in report["identical"]] == [
+            [("a.ps2", "BEDATA-SYSTEM"), ("b.ps2", "BEDATA-SYSTEM")],
+            [("a.ps2", "BESCES-50501REZ"), ("b.ps2", "BESCES-50501REZ")]]
+        assert report["reclaimable"] == {"b.ps2": 5120 + 54272}
+        (group,) = report["near_identical"]
+        assert group["name"] == "BESCES-50501REZ"
+        assert [v["images"] for v in group["versions"]] == [
+            ["c.ps2"], ["a.ps2", "b.ps2"]]
+
+        # only the save that changed is hashed again
+        mymc.main(["mymcplus", library.join("c.ps2").strpath,
+                   "remove", "BESCES-50501REZ/extra"])
+        stats = catalog.update(db, library.strpath)
+        assert (stats["indexed"], stats["hashed"]) == (1, 1)
+        assert catalog.dedupe_report(db)["near_identical"] == []
+    finally:
+        db.close()
+
+    capsys.readouterr()
+    assert mymc.main(["mymcplus", library.strpath, "dedupe-report"]) == 0
+    out = capsys.readouterr().out
+    assert out.endswith("Reclaimable space:\n"
+                        "      58KB b.ps2\n"
+                        "      53KB c.ps2\n"
+                        "     111KB total\n")
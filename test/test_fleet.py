@@ -0,0 +1,87 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import shutil
+
+from mymcplus import fleet, mymc
+
+
+def make_fleet(data, tmpdir):
+    shutil.copy(data.join("mc01.ps2").strpath, tmpdir.strpath)
+    sub = tmpdir.mkdir("sub")
+    shutil.copy(data.join("mc02.ps2").strpath, sub.strpath)
+    tmpdir.join("bad.ps2").write("not a memory card")
+    return [tmpdir.join("bad.ps2").strpath,
+            tmpdir.join("mc01.ps2").strpath,
+            sub.join("mc02.ps2").strpath]
+
+
+def test_find_cards(data, tmpdir):
+    cards = make_fleet(data, tmpdir)
+    pattern = tmpdir.join("**", "*.ps2").strpath
+    assert fleet.find_cards([pattern, pattern]) == cards
+    assert fleet.find_cards([tmpdir.join("*.ps2").strpath]) == cards[:2]
+
+
+def test_cards_check(capsys, data, tmpdir):
+    cards = make_fleet(data, tmpdir)
+    pattern = tmpdir.join("**", "*.ps2").strpath
+
+    assert mymc.main(["mymcplus", "--cards", pattern, "-j", "2",
+                      "check"]) == 1
+    captured = capsys.readouterr()
+    assert captured.out == "".join("%s: No errors found.\n" % card
+                                   for card in cards[1:])
+    assert captured.err == "%s: Not a PS2 memory card image\n" % cards[0]
+
+    assert mymc.main(["mymcplus", "--cards", cards[1], "df"]) == 0
+    assert capsys.readouterr().out.count(cards[1]) == 1
+
+    assert mymc.main(["mymcplus", "--cards", pattern, "--json",
+                      "check"]) == 1
+    summary = json.loads(capsys.readouterr().out)
+    assert (summary["total"], summary["failed"], summary["status"]) == (
+        3, 1, 1)
+    assert [(c["card"], c["status"]) for c in summary["cards"]] == [
+        (cards[0], 1), (cards[1], 0), (cards[2], 0)]
+
+
+def test_cards_backup(capsys, data, tmpdir):
+    import pytest
+    from mymcplus import backup
+
+    for (sub, card) in [("a", "mc01.ps2"), ("b", "mc02.ps2")]:
+        shutil.copy(data.join(card).strpath,
+                    tmpdir.mkdir(sub).join("Mcd001.ps2").strpath)
+    pattern = tmpdir.join("*", "Mcd001.ps2").strpath
+    store = tmpdir.join("store").strpath
+
+    assert mymc.main(["mymcplus", "--cards", pattern, "-j", "2",
+                      "backup", store]) == 0
+    capsys.readouterr()
+    assert sorted(os.listdir(os.path.join(store, "manifests"))) == [
+        "a_Mcd001", "b_Mcd001"]
+    saves = [[save["name"] for save in backup.load_manifest(
+        store, name)["saves"]] for name in ["a_Mcd001", "b_Mcd001"]]
+    assert saves[0] == ["BEDATA-SYSTEM", "BESCES-50501REZ"]
+    assert saves[1] != saves[0]
+
+    with pytest.raises(SystemExit):
+        mymc.main(["mymcplus", "--cards", pattern, "backup", "-n", "card",
+                   store])
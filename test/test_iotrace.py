@@ -0,0 +1,77 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+
+from mymcplus import iotrace, mymc
+
+
+def test_simulate_lru():
+    accesses = [(1, False), (2, False), (1, False), (3, True),
+                (2, False), None, (1, False)]
+    r = iotrace.simulate(accesses, 2, "lru")
+    assert r["hits"] == 1
+    assert r["misses"] == 5
+    # 3 is written without being read
+    assert r["reads"] == 4
+    assert r["writebacks"] == 1
+
+
+def test_simulate_fifo():
+    accesses = [(1, False), (2, False), (1, False), (3, False),
+                (1, False)]
+    assert iotrace.simulate(accesses, 2, "lru")["hits"] == 2
+    assert iotrace.simulate(accesses, 2, "fifo")["hits"] == 1
+
+
+def test_simulate_opt():
+    accesses = [(k, False) for k in [1, 2, 3, 1, 2, 4, 1, 2, 3, 4]]
+    lru = iotrace.simulate(accesses, 3, "lru")
+    opt = iotrace.simulate(accesses, 3, "opt")
+    assert opt["hits"] == 5
+    assert opt["hits"] > lru["hits"]
+
+
+def test_trace_replay(capsys, mc02_copy, data):
+    mc_file = mc02_copy.join("mc02.ps2").strpath
+    trace_file = mc02_copy.join("trace.ndjson").strpath
+    psu_file = data.join("BESCES-50501REZ.psu").strpath
+
+    mymc.main(["mymcplus", "--trace", trace_file, mc_file,
+               "import", psu_file])
+    capsys.readouterr()
+
+    with open(trace_file) as f:
+        records = iotrace.load(f)
+    assert records[0]["e"] == "open"
+    assert records[0]["fat_cache"] == 12
+    counts = iotrace.summarize(records)
+    for e in ["page_write", "cluster_cache_write", "fat_set", "flush"]:
+        assert counts[e] > 0
+
+    assert iotrace.main(["iotrace", "replay", "--json",
+                         "--fat-sizes", "12", "--cluster-sizes", "64",
+                         "-p", "lru", trace_file]) == 0
+    results = json.loads(capsys.readouterr().out)
+    assert [(r["cache"], r["size"]) for r in results] == [("fat", 12),
+                                                          ("cluster", 64)]
+    fat = results[0]["result"]
+    assert fat["accesses"] == (counts["fat_cache_read"]
+                               + counts["fat_cache_write"])
+    # the replay starts with an empty cache
+    assert fat["hits"] <= (counts["fat_cache_read_hit"]
+                           + counts["fat_cache_write"])
@@ -65,3 +65,76 @@ def test_encode_save():
     compressed = lzari.encode(data)
     assert len(compressed) == 3964
     assert compressed == compressed_correct
+
+
+def test_decode_save():
+    from data_lzari import max_data_raw as data
+    from data_lzari import max_data_compressed as compressed
+    s = lzari.decode(compressed, len(data))
+    assert s == data
+
+
+def test_roundtrip_binary():
+    import random
+    rng = random.Random(0x2A)
+    s = bytes(rng.getrandbits(8) for i in range(4000)) * 3
+    compressed = lzari.encode(s)
+    assert lzari.decode(compressed, len(s)) == s
+
+
+def test_encode_levels():
+    from data_lzari import max_data_raw as data
+    from data_lzari import max_data_compressed as compressed_correct
+    for level in range(lzari.MIN_LEVEL, lzari.MAX_LEVEL + 1):
+        compressed = lzari.encode(data, level=level)
+        assert lzari.decode(compressed, len(data)) == data
+    assert lzari.encode(data, level=lzari.MAX_LEVEL) == compressed_correct
+
+
+def test_encode_bad_level():
+    import pytest
+    with pytest.raises(ValueError):
+        lzari.encode(b"abc", level=0)
+
+
+def test_encoder_incremental():
+    from data_lzari import max_data_raw as data
+    from data_lzari import max_data_compressed as compressed_correct
+    encoder = lzari.LzariEncoder()
+    compressed = b""
+    for i in range(0, len(data), 1000):
+        encoder.feed(data[i : i + 1000])
+        compressed += encoder.read()
+    encoder.close()
+    compressed += encoder.read()
+    assert compressed == compressed_correct
+
+
+def test_decoder_incremental():
+    from data_lzari import max_data_raw as data
+    from data_lzari import max_data_compressed as compressed
+    decoder = lzari.LzariDecoder(len(data))
+    s = b""
+    for i in range(0, len(compressed), 100):
+        decoder.feed(compressed[i : i + 100])
+        s += decoder.read(512)
+    decoder.close()
+    s += decoder.read()
+    assert decoder.eof()
+    assert s == data
+
+
+def test_decode_truncated():
+    import pytest
+    from data_lzari import max_data_raw as data
+    from data_lzari import max_data_compressed as compressed
+    truncated = compressed[:len(compressed) // 2]
+    with pytest.raises(ValueError):
+        lzari.decode(truncated, len(data))
+
+    decoder = lzari.LzariDecoder(len(data))
+    decoder.feed(truncated)
+    decoder.read()
+    decoder.close()
+    with pytest.raises(ValueError):
+        decoder.read()
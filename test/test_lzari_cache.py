@@ -0,0 +1,138 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import hashlib
+
+import pytest
+
+from mymcplus import mymc
+from mymcplus.save import lzari_cache
+
+
+@pytest.fixture
+def no_global_cache(monkeypatch):
+    monkeypatch.delenv(lzari_cache.ENV_DIR, raising=False)
+    monkeypatch.setattr(lzari_cache, "_cache", None)
+    monkeypatch.setattr(lzari_cache, "_cache_checked", False)
+
+
+def test_parse_size():
+    assert lzari_cache.parse_size("1000") == 1000
+    assert lzari_cache.parse_size("64k") == 64 * 1024
+    assert lzari_cache.parse_size("2M") == 2 * 1024 * 1024
+    with pytest.raises(ValueError):
+        lzari_cache.parse_size("lots")
+
+
+def test_put_get(tmpdir):
+    cache = lzari_cache.lzari_cache(tmpdir.join("cache").strpath)
+    key = cache.decode_key(b"compressed", 100)
+    assert cache.get(key) is None
+    cache.put(key, b"decompressed")
+    assert cache.get(key) == b"decompressed"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    digest = hashlib.sha1(b"decompressed")
+    assert cache.encode_key(digest, 9) != cache.encode_key(digest, 1)
+
+
+def test_evict_lru(tmpdir):
+    cache = lzari_cache.lzari_cache(tmpdir.join("cache").strpath, 2500)
+    for (i, key) in enumerate(["a", "b", "c"]):
+        cache.put(key, b"x" * 1000)
+        fn = os.path.join(cache.path, key + ".lzc")
+        os.utime(fn, (i * 10, i * 10))
+    # the oldest entry has been removed to make room for "c"
+    assert cache.get("a") is None
+    # using "b" makes "c" the least recently used
+    assert cache.get("b") is not None
+    cache.put("d", b"x" * 1000)
+    assert cache.get("c") is None
+    assert cache.get("b") is not None
+    assert cache.size() == 2000
+
+
+def test_env(monkeypatch, no_global_cache, tmpdir):
+    path = tmpdir.join("cache").strpath
+    monkeypatch.setenv(lzari_cache.ENV_DIR, path)
+    monkeypatch.setenv(lzari_cache.ENV_SIZE, "1M")
+    cache = lzari_cache.get_cache()
+    assert cache.path == path
+    assert cache.max_size == 1024 * 1024
+
+
+def test_export_import_max_cached(capsys, no_global_cache, data, mc02_copy, tmpdir):
+    mc_file = data.join("mc01.ps2").strpath
+    cache_dir = tmpdir.join("cache").strpath
+
+    for i in range(2):
+        mymc.main(["mymcplus",
+                   "-i", "--lzari-cache", cache_dir, mc_file,
+                   "export", "-f", "-d", tmpdir.strpath, "-m",
+                   "BESCES-50501REZ"])
+        output = capsys.readouterr()
+        assert (output.err == "compressing BESCES-50501REZ: cached\n") == (i == 1)
+        max_file = tmpdir.join("BESCES-50501REZ.max").strpath
+        assert (hashlib.md5(open(max_file, "rb").read()).hexdigest()
+                == "3f63d38668a0a5a5fa508ab8c3bb469a")
+
+    mc_file = mc02_copy.join("mc02.ps2").strpath
+    for i in range(2):
+        mymc.main(["mymcplus",
+                   "-i", "--lzari-cache", cache_dir, mc_file,
+                   "import", "-d", "REZ%d" % i, max_file])
+        output = capsys.readouterr()
+        assert (output.err == "decompressing BESCES-50501REZ: cached\n") == (i == 1)
+    assert lzari_cache.get_cache().hits == 1
+
+
+def test_load_max_streamed(monkeypatch, no_global_cache, data, tmpdir):
+    from mymcplus.save import format_max_drive, lzari, ps2save
+
+    fed = []
+    feed = lzari.LzariDecoder.feed
+    def record_feed(self, s):
+        fed.append(len(s))
+        feed(self, s)
+    monkeypatch.setattr(lzari.LzariDecoder, "feed", record_feed)
+    monkeypatch.setattr(format_max_drive, "FEED_SIZE", 512)
+    lzari_cache.set_cache(tmpdir.join("cache").strpath)
+
+    def load():
+        sf = ps2save.PS2SaveFile()
+        f = open(data.join("BESCES-50501REZ.max").strpath, "rb")
+        try:
+            format_max_drive.load(sf, f)
+            (length, compressed) = sf._compressed
+            return ([sf.get_file(i)[1] for i in range(len(sf))],
+                    lzari.decode(compressed, length))
+        finally:
+            f.close()
+
+    (files, decompressed) = load()
+    # the compressed data is fed to the decoder a piece at a time
+    assert len(fed) > 1 and max(fed) == 512
+    # and all of the decompressed data was cached
+    (entry,) = os.listdir(lzari_cache.get_cache().path)
+    assert open(os.path.join(lzari_cache.get_cache().path, entry),
+                "rb").read() == decompressed
+
+    del fed[:]
+    assert load()[0] == files
+    assert fed == []
+    assert lzari_cache.get_cache().hits == 1
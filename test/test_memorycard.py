@@ -15,6 +15,8 @@
 # along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+
 from mymcplus import mymc
 
 
@@ -421,3 +423,205 @@ def test_import_psv_ps1(monkeypatch, capsys, data, mc02_copy):
     assert output.err == ""
 
     assert md5(mc_file) == "c9f26130a5de7548248a5fec80593a4d"
+
+
+def test_stats(capsys, data, mc02_copy):
+    mc_file = mc02_copy.join("mc02.ps2").strpath
+    psu_file = data.join("BESCES-50501REZ.psu").strpath
+
+    mymc.main(["mymcplus",
+               "--stats", mc_file,
+               "import", psu_file])
+
+    output = capsys.readouterr()
+    assert output.out == "Importing " + psu_file + " to BESCES-50501REZ\n"
+    stats = dict((name, int(value)) for (name, value)
+                 in (line.split() for line in output.err.splitlines()))
+    assert stats["clusters_allocated"] > 0
+    assert stats["clusters_freed"] == 0
+    assert stats["pages_written"] > 0
+    assert stats["superblock_writes"] >= 1
+    assert stats["ecc_pages_failed"] == 0
+    assert stats["ecc_pages_checked"] == stats["pages_read"]
+
+
+def test_stats_ecc_corrected(capsys, mc01_copy):
+    from mymcplus import ps2mc
+
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+    with open(mc_file, "rb") as f:
+        mc = ps2mc.ps2mc(f)
+        page = mc.allocatable_cluster_offset * mc.pages_per_cluster
+        offset = page * mc.raw_page_size + 10
+        mc.close()
+
+    # flip a bit in the first page of the root directory
+    with open(mc_file, "r+b") as f:
+        f.seek(offset)
+        b = f.read(1)[0]
+        f.seek(offset)
+        f.write(bytes([b ^ 0x10]))
+
+    with open(mc_file, "rb") as f:
+        mc = ps2mc.ps2mc(f)
+        stats = mc.stats()
+        mc.close()
+
+    assert stats["ecc_pages_corrected"] == 1
+    assert stats["ecc_pages_failed"] == 0
+    assert stats["cluster_cache_misses"] > 0
+    assert capsys.readouterr().out == ""
+
+
+def test_profile(capsys, data, tmpdir):
+    import pstats
+    prof_file = tmpdir.join("ls.prof").strpath
+
+    mymc.main(["mymcplus",
+               "--timings", "--profile-output", prof_file,
+               data.join("mc01.ps2").strpath,
+               "ls"])
+
+    output = capsys.readouterr()
+    assert len(output.out.splitlines()) == 4
+    phases = [line.split()[0] for line in output.err.splitlines()]
+    assert phases == ["open", "command", "close", "total"]
+
+    stats = pstats.Stats(prof_file)
+    assert any(fn == "do_ls" for (filename, lineno, fn) in stats.stats)
+
+
+def test_scan(capsys, mc01_copy):
+    import json
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+
+    # two bit errors in one chunk of page 0x40 can't be corrected
+    with open(mc_file, "r+b") as f:
+        for offset in (0x40 * 528 + 5, 0x40 * 528 + 9):
+            f.seek(offset)
+            b = f.read(1)[0]
+            f.seek(offset)
+            f.write(bytes([b ^ 0x04]))
+
+    assert mymc.main(["mymcplus", mc_file, "scan", "-j", "2",
+                      "--json"]) == 1
+    report = json.loads(capsys.readouterr().out)
+    assert report["health"] == "bad"
+    assert report["erase_blocks"] == 1024
+    assert len(report["blocks"]) == 1024
+    assert report["failed_pages"] == [0x40]
+    assert report["blocks"][4]["failed"] == 1
+    chunks = report["chunks"]
+    assert sum(chunks.values()) == 16384 * 4
+
+    assert mymc.main(["mymcplus", mc_file, "scan", "-j", "1"]) == 1
+    output = capsys.readouterr().out
+    assert "uncorrectable pages: 00040\n" in output
+    assert output.endswith("health: bad\n")
+
+
+def test_scrub(capsys, mc01_copy):
+    import json
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+
+    # a bit error in the data of page 0x40, and one in the ECC of 0x41
+    with open(mc_file, "r+b") as f:
+        for offset in (0x40 * 528 + 5, 0x41 * 528 + 512 + 4):
+            f.seek(offset)
+            b = f.read(1)[0]
+            f.seek(offset)
+            f.write(bytes([b ^ 0x01]))
+    damaged = md5(mc_file)
+
+    assert mymc.main(["mymcplus", mc_file, "scrub", "-n", "-j", "1"]) == 0
+    output = capsys.readouterr().out
+    assert output.startswith("Would rewrite ")
+    assert "00040 00041" in output
+    assert md5(mc_file) == damaged
+
+    assert mymc.main(["mymcplus", mc_file, "scrub", "-j", "1",
+                      "--json"]) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert not report["dry_run"]
+    assert 0x40 in report["rewritten_pages"]
+    assert 0x41 in report["rewritten_pages"]
+
+    mymc.main(["mymcplus", mc_file, "scan", "-j", "1", "--json"])
+    report = json.loads(capsys.readouterr().out)
+    assert report["health"] == "good"
+
+    mymc.main(["mymcplus", mc_file, "check"])
+    assert capsys.readouterr().out == "No errors found.\n"
+
+
+def test_convert_ecc(capsys, mc01_copy, tmpdir):
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+    mc2_file = tmpdir.join("mc01.mc2").strpath
+    ps2_file = tmpdir.join("mc01-ecc.ps2").strpath
+
+    # page 1 of mc01.ps2 has a correctable error in its ECC
+    assert mymc.main(["mymcplus", mc_file, "convert-ecc", mc2_file]) == 0
+    assert capsys.readouterr().out == "Corrected 1 page.\n"
+    assert os.path.getsize(mc2_file) == os.path.getsize(mc_file) // 528 * 512
+
+    mymc.main(["mymcplus", mc2_file, "check"])
+    assert capsys.readouterr().out == "No errors found.\n"
+
+    assert mymc.main(["mymcplus", mc2_file, "convert-ecc", "--add",
+                      ps2_file]) == 0
+    assert capsys.readouterr().out == ""
+    assert os.path.getsize(ps2_file) == os.path.getsize(mc_file)
+
+    # the same as scrubbing the original
+    mymc.main(["mymcplus", mc_file, "scrub", "-j", "1"])
+    capsys.readouterr()
+    assert md5(ps2_file) == md5(mc_file)
+
+
+def test_copy(capsys, mc01_copy, mc02_copy):
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+    dest_file = mc02_copy.join("mc02.ps2").strpath
+
+    mymc.main(["mymcplus", mc_file, "copy", dest_file, "BES*"])
+    assert capsys.readouterr().out == ("Copied BESCES-50501REZ to "
+                                       + dest_file + "\n")
+
+    mymc.main(["mymcplus", mc_file, "copy", "-i", dest_file,
+               "BESCES-50501REZ"])
+    assert capsys.readouterr().out == ("BESCES-50501REZ: already in "
+                                       + dest_file + ", ignored.\n")
+
+    mymc.main(["mymcplus", mc_file, "mkdir", "BEDATA-SYSTEM/sub"])
+    mymc.main(["mymcplus", mc_file, "copy", "-d", "SYSTEM-COPY", dest_file,
+               "BEDATA-SYSTEM"])
+    captured = capsys.readouterr()
+    assert captured.out == ("Copied BEDATA-SYSTEM to " + dest_file + "\n")
+    assert captured.err == ("warning: BEDATA-SYSTEM/sub is not a file,"
+                            " ignored.\n")
+
+    mymc.main(["mymcplus", dest_file, "check"])
+    assert capsys.readouterr().out == "No errors found.\n"
+
+
+def test_watch(monkeypatch, capsys, mc01_copy):
+    import time
+    from mymcplus import ps2mc
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+
+    # another program changes the card while it's being watched
+    def sleep(secs):
+        with open(mc_file, "r+b") as f:
+            mc = ps2mc.ps2mc(f)
+            mc.mkdir("/NEWDIR")
+            mc.rmdir("/BEDATA-SYSTEM")
+            mc.close()
+    monkeypatch.setattr(time, "sleep", sleep)
+    monkeypatch.setattr(time, "strftime", lambda fmt, t: "12:00:00")
+
+    assert mymc.main(["mymcplus", mc_file, "watch", "-c", "1"]) == 0
+    assert capsys.readouterr().out == (
+        "12:00:00 modified /\n"
+        "12:00:00 deleted  /BEDATA-SYSTEM\n"
+        "12:00:00 deleted  /BEDATA-SYSTEM/history\n"
+        "12:00:00 deleted  /BEDATA-SYSTEM/icon.sys\n"
+        "12:00:00 created  /NEWDIR\n")
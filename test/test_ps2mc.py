@@ -0,0 +1,342 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import pytest
+
+from mymcplus import ps2mc
+
+
+def open_mc(tmpdir):
+    f = open(tmpdir.join("mc01.ps2").strpath, "r+b")
+    return f, ps2mc.ps2mc(f, True)
+
+
+def test_subscribe(mc01_copy):
+    (f, mc) = open_mc(mc01_copy)
+    batches = []
+    try:
+        mc.subscribe(lambda mc, changes: batches.append(changes))
+        mc.mkdir("/NEWDIR")
+        mc.flush()
+        assert len(batches) >= 1
+        changes = {}
+        for batch in batches:
+            for (event, keys) in batch.items():
+                changes.setdefault(event, set()).update(keys)
+        assert "flush" in batches[-1]
+        (dirloc, ent, is_dir) = mc.path_search("/NEWDIR")
+        assert dirloc in changes["dirent_created"]
+        assert ent[4] in changes["cluster_written"]
+        assert ent[4] in changes["fat_changed"]
+
+        del batches[:]
+        mc.rmdir("/NEWDIR")
+        mc.flush()
+        deleted = set()
+        for batch in batches:
+            deleted |= batch.get("dirent_deleted", set())
+        assert dirloc in deleted
+    finally:
+        mc.close()
+        f.close()
+
+
+def test_subscribe_events(mc01_copy):
+    (f, mc) = open_mc(mc01_copy)
+    batches = []
+    try:
+        mc.subscribe(lambda mc, changes: batches.append(changes),
+                     ["dirent_deleted"])
+        mc.mkdir("/NEWDIR")
+        mc.flush()
+        # none of the subscribed events happened
+        assert batches == []
+
+        mc.rmdir("/NEWDIR")
+        mc.flush()
+        assert len(batches) == 1
+        assert list(batches[0].keys()) == ["dirent_deleted"]
+
+        with pytest.raises(ValueError):
+            mc.subscribe(print, ["no_such_event"])
+    finally:
+        mc.close()
+        f.close()
+
+
+def test_unsubscribe(mc01_copy):
+    (f, mc) = open_mc(mc01_copy)
+    batches = []
+    callback = lambda mc, changes: batches.append(changes)
+    try:
+        mc.subscribe(callback)
+        mc.unsubscribe(callback)
+        assert mc.pending_changes is None
+        mc.mkdir("/NEWDIR")
+        mc.flush()
+        assert batches == []
+    finally:
+        mc.close()
+        f.close()
+
+
+def test_read_fat_table(mc01_copy):
+    (f, mc) = open_mc(mc01_copy)
+    try:
+        mc.mkdir("/NEWDIR")
+        table = mc.read_fat_table()
+        assert len(table) == mc.allocatable_cluster_end
+        assert list(table) == [mc.lookup_fat(i) for i in range(len(table))]
+    finally:
+        mc.close()
+        f.close()
+
+
+def test_check_findings(mc01_copy, capsys):
+    (f, mc) = open_mc(mc01_copy)
+    try:
+        assert mc.check_findings() == []
+        for i in (500, 501):
+            mc.set_fat(i, ps2mc.PS2MC_FAT_CHAIN_END)
+        (dirloc, ent, is_dir) = mc.path_search(
+            "/BESCES-50501REZ/BESCES-50501REZ")
+        ent[2] += 5000
+        mc.update_dirent_all(dirloc, None, ent)
+
+        findings = mc.check_findings()
+        assert [(x.kind, x.path, x.why, x.clusters) for x in findings] == [
+            ("bad file", "/BESCES-50501REZ/BESCES-50501REZ",
+             "chain ends before end of file", None),
+            ("lost clusters", None, None, [500, 501])]
+
+        assert not mc.check()
+        assert capsys.readouterr().out == (
+            "bad file: /BESCES-50501REZ/BESCES-50501REZ:"
+            " chain ends before end of file\n"
+            "500 501 \n"
+            "found 2 lost clusters\n")
+    finally:
+        mc.close()
+        f.close()
+
+
+def test_format_template(monkeypatch):
+    import io
+    monkeypatch.setattr(ps2mc, "_format_templates", {})
+    params = (True, ps2mc.PS2MC_STANDARD_PAGE_SIZE,
+              ps2mc.PS2MC_STANDARD_PAGES_PER_ERASE_BLOCK, 4096)
+
+    def format(tod):
+        monkeypatch.setattr(ps2mc, "tod_now", lambda: tod)
+        f = io.BytesIO()
+        mc = ps2mc.ps2mc(f, True, params)
+        assert mc.check_findings() == []
+        assert mc.get_free_space() == mc.get_allocatable_space() - 1024
+        mc.close()
+        return f.getvalue()
+
+    image1 = format((42, 37, 22, 20, 4, 2018))
+    assert list(ps2mc._format_templates) == [params]
+    image2 = format((42, 37, 22, 20, 4, 2018))
+    assert image1 == image2
+
+    # only the root directory's timestamps differ
+    image3 = format((0, 0, 0, 1, 1, 2020))
+    diff = [i for i in range(len(image1)) if image1[i] != image3[i]]
+    mc = ps2mc.ps2mc(io.BytesIO(image3))
+    root = mc.allocatable_cluster_offset * 2 * mc.raw_page_size
+    mc.close()
+    assert len(diff) > 0
+    assert root <= min(diff) and max(diff) < root + 2 * mc.raw_page_size
+
+    # the templates kept are limited by their total size
+    monkeypatch.setattr(ps2mc, "FORMAT_TEMPLATE_CACHE_SIZE",
+                        len(image1) * 5 // 4)
+    small = params = params[:3] + (2048,)
+    format((0, 0, 0, 1, 1, 2020))
+    assert list(ps2mc._format_templates) == [small]
+    params = params[:3] + (8192,)
+    format((0, 0, 0, 1, 1, 2020))
+    assert list(ps2mc._format_templates) == [small]
+    ps2mc.clear_format_templates()
+    assert ps2mc._format_templates == {}
+
+
+def test_clone_shrink():
+    import io
+    from mymcplus import cardgen, ps2mc_image
+
+    f = io.BytesIO()
+    names = cardgen.generate(f, clusters=4096, seed=3, saves=8,
+                             sizes=(100000, 200000))
+    mc = ps2mc.ps2mc(f)
+    dirs = {}
+    for name in names:
+        dirs[name] = mc.get_dirent("/" + name)[4]
+    # leave only the saves at the end of the card
+    for name in names[:6]:
+        mc.rmdir("/" + name)
+    saves = dict((name, mc.export_save_file("/" + name))
+                 for name in names[6:])
+
+    out = io.BytesIO()
+    stats = ps2mc_image.clone(mc, out, False, 1504)
+    mc.close()
+    assert stats["failed"] == 0
+    assert all(dirs[name] in stats["relocated"] for name in names[6:])
+
+    new = ps2mc.ps2mc(out)
+    try:
+        assert new.spare_size == 0
+        assert new.clusters_per_card == 1504
+        assert new.check_findings() == []
+        for (name, sf) in saves.items():
+            assert (new.get_dirent("/" + name)[4]
+                    == stats["relocated"][dirs[name]])
+            assert ([(ent[8], data) for (ent, data)
+                     in new.export_save_file("/" + name)]
+                    == [(ent[8], data) for (ent, data) in sf])
+    finally:
+        new.close()
+
+
+def test_copy_save_to(mc01_copy):
+    import io
+    (f, mc) = open_mc(mc01_copy)
+    dest = ps2mc.ps2mc(io.BytesIO(), True,
+                       (True, ps2mc.PS2MC_STANDARD_PAGE_SIZE,
+                        ps2mc.PS2MC_STANDARD_PAGES_PER_ERASE_BLOCK,
+                        ps2mc.PS2MC_STANDARD_PAGES_PER_CARD))
+    try:
+        assert mc.copy_saves_to(dest, ["/BESCES-50501REZ",
+                                       "/BEDATA-SYSTEM"]) == [
+            "/BESCES-50501REZ", "/BEDATA-SYSTEM"]
+        assert not mc.copy_save_to(dest, "/BEDATA-SYSTEM", True)
+        with pytest.raises(EnvironmentError):
+            mc.copy_save_to(dest, "/BEDATA-SYSTEM")
+        assert mc.copy_save_to(dest, "/BESCES-50501REZ",
+                               new_dirname="/COPY")
+        assert dest.check_findings() == []
+
+        for (name, new_name) in [("/BESCES-50501REZ", "/BESCES-50501REZ"),
+                                 ("/BEDATA-SYSTEM", "/BEDATA-SYSTEM"),
+                                 ("/BESCES-50501REZ", "/COPY")]:
+            ent = mc.get_dirent(name)
+            new_ent = dest.get_dirent(new_name)
+            assert [new_ent[i] for i in (0, 2, 3, 6)] == [
+                ent[i] for i in (0, 2, 3, 6)]
+            assert ([(ent[:4], ent[5:], data) for (ent, data)
+                     in dest.export_save_file(new_name)]
+                    == [(ent[:4], ent[5:], data) for (ent, data)
+                        in mc.export_save_file(name)])
+    finally:
+        dest.close()
+        mc.close()
+        f.close()
+
+
+def test_refresh_if_changed(mc01_copy):
+    (f, mc) = open_mc(mc01_copy)
+    (f2, other) = open_mc(mc01_copy)
+    batches = []
+    try:
+        mc.subscribe(lambda mc, changes: batches.append(changes))
+        assert not mc.refresh_if_changed()
+        assert not mc.refresh_if_changed()
+        # cache the root directory and a file's contents
+        assert len(mc.dir_open("/")) == 4
+        assert mc.get_icon_sys("/BESCES-50501REZ") != None
+
+        other.mkdir("/NEWDIR")
+        other.rmdir("/BESCES-50501REZ")
+        other.flush()
+        assert mc.refresh_if_changed()
+        assert not mc.refresh_if_changed()
+        changes = batches[-1]
+        assert (0, 4) in changes["dirent_created"]
+        assert (0, 3) in changes["dirent_deleted"]
+        assert len(changes["fat_changed"]) > 0
+        names = [ent[8] for ent in mc.dir_open("/")
+                 if ent[0] & ps2mc.DF_EXISTS]
+        assert names == [b".", b"..", b"BEDATA-SYSTEM", b"NEWDIR"]
+
+        # the object's own changes aren't picked up again
+        mc.mkdir("/MINE")
+        del batches[:]
+        assert not mc.refresh_if_changed()
+        assert batches == []
+        assert mc.check_findings() == []
+    finally:
+        other.close()
+        f2.close()
+        mc.close()
+        f.close()
+
+
+def test_watch_flush(monkeypatch, mc01_copy):
+    (f, mc) = open_mc(mc01_copy)
+    try:
+        assert not mc.refresh_if_changed()
+        written = set()
+        read = set()
+        write_cluster = mc.write_cluster
+        read_cluster = mc.read_cluster
+        raw_cluster_crc = mc._raw_cluster_crc
+        def record_write(n, buf):
+            written.add(n)
+            return write_cluster(n, buf)
+        def record_read(n):
+            read.add(n)
+            return read_cluster(n)
+        def record_crc(n):
+            read.add(n)
+            return raw_cluster_crc(n)
+        monkeypatch.setattr(mc, "write_cluster", record_write)
+        monkeypatch.setattr(mc, "read_cluster", record_read)
+        monkeypatch.setattr(mc, "_raw_cluster_crc", record_crc)
+
+        def check_snapshot():
+            # the same as scanning the whole card again
+            watch = mc.watch
+            mc._watch_start()
+            for key in ["crc", "table", "entries", "dirs", "owner",
+                        "superblock", "stat"]:
+                assert watch[key] == mc.watch[key]
+
+        mcf = mc.open("/BESCES-50501REZ/icon.sys", "r+b")
+        read.clear()
+        mcf.write(b"X")
+        mcf.close()
+        mc.flush()
+        # only the clusters written were looked at again
+        assert len(read) > 0 and read <= written
+        check_snapshot()
+
+        mc.mkdir("/NEWDIR")
+        mcf = mc.open("/NEWDIR/file", "wb")
+        mcf.write(b"x" * 5000)
+        mcf.close()
+        mc.flush()
+        check_snapshot()
+        mc.remove("/NEWDIR/file")
+        mc.rmdir("/NEWDIR")
+        mc.flush()
+        check_snapshot()
+        assert not mc.refresh_if_changed()
+    finally:
+        mc.close()
+        f.close()
@@ -0,0 +1,139 @@
+#
+# This file is part of mymc+, based on mymc by Ross Ridge.
+#
+# mymc+ is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mymc+ is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mymc+.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import io
+
+import pytest
+
+from mymcplus import mymc, ps2mc, ps2mc_image, ps2mc_sync
+from mymcplus.ps2mc_dir import DF_EXISTS
+
+
+def open_cards(tmpdir):
+    f = open(tmpdir.join("mc01.ps2").strpath, "r+b")
+    a = ps2mc.ps2mc(f)
+    out = io.BytesIO()
+    ps2mc_image.convert_ecc(a, out)
+    return (f, a, ps2mc.ps2mc(out))
+
+
+def touch(mc):
+    icon_sys = mc.open("/BESCES-50501REZ/icon.sys", "r+b")
+    icon_sys.write(b"X")
+    icon_sys.close()
+
+
+def states(result):
+    return [(d.name, d.state, d.newer) for d in result]
+
+
+def test_diff(mc01_copy):
+    (f, a, b) = open_cards(mc01_copy)
+    try:
+        assert states(ps2mc_sync.diff(a, b)) == [
+            ("BEDATA-SYSTEM", "same", None),
+            ("BESCES-50501REZ", "same", None)]
+
+        # different timestamps, but the same contents
+        b.set_dirent("/BESCES-50501REZ",
+                     (None, None, None, None, None, None,
+                      (0, 0, 0, 1, 1, 2020), None, None))
+        assert states(ps2mc_sync.diff(a, b))[1] == (
+            "BESCES-50501REZ", "same", None)
+
+        touch(b)
+        b.rmdir("/BEDATA-SYSTEM")
+        assert states(ps2mc_sync.diff(a, b)) == [
+            ("BEDATA-SYSTEM", "only_a", None),
+            ("BESCES-50501REZ", "changed", "b")]
+    finally:
+        b.close()
+        a.close()
+        f.close()
+
+
+def test_sync(mc01_copy):
+    (f, a, b) = open_cards(mc01_copy)
+    try:
+        touch(b)
+        a.rmdir("/BEDATA-SYSTEM")
+
+        actions = ps2mc_sync.sync(a, b, conflict="skip")
+        assert [(d.name, action) for (d, action) in actions] == [
+            ("BEDATA-SYSTEM", "to_a"), ("BESCES-50501REZ", None)]
+
+        actions = ps2mc_sync.sync(a, b, to_a=False, dry_run=True)
+        assert [(d.name, action) for (d, action) in actions] == [
+            ("BESCES-50501REZ", None)]
+
+        actions = ps2mc_sync.sync(a, b)
+        assert [(d.name, action) for (d, action) in actions] == [
+            ("BESCES-50501REZ", "to_a")]
+        assert all(d.state == "same" for d in ps2mc_sync.diff(a, b))
+        assert a.check_findings() == []
+        icon_sys = a.open("/BESCES-50501REZ/icon.sys", "rb")
+        assert icon_sys.read(1) == b"X"
+        icon_sys.close()
+    finally:
+        b.close()
+        a.close()
+        f.close()
+
+
+def test_diff_cmd(capsys, mc01_copy, tmpdir):
+    mc_file = mc01_copy.join("mc01.ps2").strpath
+    other_file = tmpdir.join("other.mc2").strpath
+    mymc.main(["mymcplus", mc_file, "convert-ecc", other_file])
+    mymc.main(["mymcplus", other_file, "delete", "BEDATA-SYSTEM"])
+    capsys.readouterr()
+
+    assert mymc.main(["mymcplus", mc_file, "diff", other_file]) == 1
+    assert capsys.readouterr().out == ("Only in %s: BEDATA-SYSTEM\n"
+                                       % mc_file)
+    mymc.main(["mymcplus", mc_file, "sync", other_file])
+    assert capsys.readouterr().out == ("Copied BEDATA-SYSTEM to %s\n"
+                                       % other_file)
+    assert mymc.main(["mymcplus", mc_file, "diff", other_file]) == 0
+
+
+def test_sync_failed_copy(mc01_copy):
+    (f, a, b) = open_cards(mc01_copy)
+    try:
+        touch(b)
+
+        def fail(*args):
+            raise ps2mc.corrupt("bad cluster")
+        b._read_chain = fail
+
+        with pytest.raises(ps2mc.corrupt):
+            ps2mc_sync.sync(a, b)
+        # a still has its own copy, and nothing else
+        assert states(ps2mc_sync.diff(a, b)) == [
+            ("BEDATA-SYSTEM", "same", None),
+            ("BESCES-50501REZ", "changed", "b")]
+        assert a.check_findings() == []
+
+        del b._read_chain
+        ps2mc_sync.sync(a, b)
+        assert [e[8] for e in a.dir_open("/") if e[0] & DF_EXISTS] == [
+            b".", b"..", b"BEDATA-SYSTEM", b"BESCES-50501REZ"]
+        assert all(d.state == "same" for d in ps2mc_sync.diff(a, b))
+        assert a.check_findings() == []
+    finally:
+        b.close()
+        a.close()
+        f.close()